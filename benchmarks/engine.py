@@ -0,0 +1,633 @@
+"""
+Measure the end-to-end throughput of a `WorkflowNyuki`, booted with an
+in-memory stand-in for `MongoStorage` and a fake bus (no Mongo, MQTT or
+Redis needed). Synthetic topic events go through `workflow_event()` like
+bus events would.
+
+Workloads:
+    - factory: a single factory task (set, copy, sub, extract, lookup...)
+    - selector: a factory task, then a task_selector choosing a branch
+    - chain: a trigger_workflow task starting (and waiting for) a child
+      workflow of another service, through the HTTP API
+    - chain-local: the same on the nyuki's own service, started in-process
+
+Measured: triggers/sec, event to workflow end latency (p50/p99), memory per
+running workflow (tracemalloc, separate pass) and event loop lag. The
+command fails if the workflows of a pass do not all end in time.
+
+    python -m benchmarks.engine [-w factory selector] [-n 2000]
+        [--save results.json] [--compare previous.json]
+"""
+import gc
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import tempfile
+import tracemalloc
+from copy import deepcopy
+from time import perf_counter
+from uuid import uuid4
+from aiohttp import web, ClientSession
+
+from tukio import get_broker, EXEC_TOPIC
+from tukio.workflow import WorkflowExecState
+
+from nyuki.services import Service
+from nyuki.workflow import workflow as workflow_module
+from nyuki.workflow.db.workflow_templates import required_keys
+from nyuki.workflow.rules import FactoryRuleCache
+from nyuki.workflow.workflow import WorkflowNyuki
+from nyuki.workflow.tasks.utils import runtime
+
+
+SERVICE = 'bench'
+# Service of the remote chain workload, routed back to the bench nyuki
+REMOTE_SERVICE = 'bench-remote'
+TOPIC = 'bench/events'
+
+
+class MemoryCollection:
+
+    """
+    Stand-in for `DataProcessingCollection`/`TriggerCollection`.
+    """
+
+    def __init__(self):
+        self._rules = {}
+
+    async def index(self):
+        pass
+
+    async def get(self):
+        return [deepcopy(rule) for rule in self._rules.values()]
+
+    async def get_one(self, rule_id):
+        return deepcopy(self._rules.get(rule_id))
+
+    async def pairs(self, lookup_id):
+        lookup = self._rules.get(lookup_id)
+        if lookup is not None:
+            return [(row['value'], row['replace']) for row in lookup['table']]
+
+    async def insert(self, data):
+        self._rules[data['id']] = deepcopy(data)
+
+    async def delete(self, rule_id=None):
+        if rule_id is None:
+            self._rules.clear()
+        else:
+            self._rules.pop(rule_id, None)
+
+
+class MemoryQueue:
+
+    """
+    Stand-in for `WorkflowQueueCollection`.
+    """
+
+    def __init__(self):
+        self._triggers = []
+
+    async def index(self):
+        pass
+
+    async def count(self):
+        return len(self._triggers)
+
+    async def push(self, template_id, data, priority=0):
+        self._triggers.append({
+            'template_id': template_id, 'data': data, 'priority': priority,
+        })
+
+    async def pop(self, count):
+        triggers = self._triggers[:count]
+        del self._triggers[:count]
+        return triggers
+
+
+class MemoryStorage:
+
+    """
+    In-memory stand-in for `MongoStorage`, returning copies like Mongo would.
+    Written history documents are only counted.
+    """
+
+    def __init__(self):
+        self._templates = {}
+        self.regexes = MemoryCollection()
+        self.lookups = MemoryCollection()
+        self.triggers = MemoryCollection()
+        self.workflow_queue = MemoryQueue()
+        self.written = {'workflows': 0, 'tasks': 0}
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    async def index(self):
+        pass
+
+    def add_template(self, template):
+        self._templates[template['id']] = {
+            'version': 1, 'state': 'active', 'tags': [], **template,
+        }
+
+    async def get_template(self, tid, draft=False, version=None):
+        return deepcopy(self._templates.get(tid))
+
+    async def get_required_keys(self, tid, draft=False, version=None):
+        template = self._templates.get(tid)
+        if not template:
+            return
+        return {
+            'version': template['version'], 'draft': False,
+            'keys': required_keys(template['tasks']),
+        }
+
+    async def get_templates(self, template_id=None, full=False):
+        return [
+            deepcopy(template) for template in self._templates.values()
+            if template_id is None or template['id'] == template_id
+        ]
+
+    async def get_for_topic(self, topic):
+        return [
+            deepcopy(template) for template in self._templates.values()
+            if topic in template.get('topics') or []
+        ]
+
+    async def insert_instances(self, instances, tasks=()):
+        self.written['workflows'] += len(instances)
+        self.written['tasks'] += len(tasks) + sum(
+            len(instance['template']['tasks']) for instance in instances
+        )
+
+
+class FakeBus(Service):
+
+    """
+    Bus delivering the publications to the local subscribers only.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.published = 0
+        self._subscriptions = {}
+
+    def configure(self, *args, **kwargs):
+        pass
+
+    async def start(self, *args, **kwargs):
+        pass
+
+    async def stop(self, *args, **kwargs):
+        pass
+
+    def init_reporting(self):
+        pass
+
+    async def subscribe(self, topic, callback):
+        self._subscriptions.setdefault(topic, set()).add(callback)
+
+    async def unsubscribe(self, topic, callback=None):
+        if callback is None:
+            self._subscriptions.pop(topic, None)
+        else:
+            self._subscriptions.get(topic, set()).discard(callback)
+
+    async def publish(self, data, topic=None, previous_uid=None):
+        self.published += 1
+        for callback in list(self._subscriptions.get(topic, ())):
+            asyncio.ensure_future(callback(topic, deepcopy(data)))
+
+
+class Gateway:
+
+    """
+    Route 'http://{http_host}/{service}/api/...' requests (as sent by the
+    trigger_workflow task) to the nyuki's API whatever the service, like the
+    reverse proxy would.
+    """
+
+    def __init__(self, api_port, loop):
+        self._api = 'http://127.0.0.1:{}'.format(api_port)
+        self._loop = loop
+        self._session = None
+        self._handler = None
+        self._server = None
+
+    async def proxy(self, request):
+        url = '{}/{}'.format(self._api, request.match_info['path'])
+        async with self._session.request(
+            request.method, url, params=request.query,
+            headers=request.headers, data=await request.read(),
+        ) as resp:
+            return web.Response(
+                status=resp.status, body=await resp.read(),
+                content_type=resp.content_type,
+            )
+
+    async def start(self, port):
+        self._session = ClientSession(loop=self._loop)
+        app = web.Application(loop=self._loop)
+        app.router.add_route('*', '/{service}/api/{path:.*}', self.proxy)
+        self._handler = app.make_handler(access_log=None)
+        self._server = await self._loop.create_server(
+            self._handler, '127.0.0.1', port
+        )
+
+    async def stop(self):
+        self._server.close()
+        await self._handler.shutdown()
+        await self._session.close()
+
+
+async def _no_migrations(**kwargs):
+    pass
+
+
+class BenchNyuki(WorkflowNyuki):
+
+    """
+    Keep the time at which each workflow was triggered.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.triggered_at = {}
+        self._event_times = {}
+
+    async def workflow_event(self, efrom, data):
+        task = asyncio.Task.current_task()
+        self._event_times[task] = perf_counter()
+        try:
+            await super().workflow_event(efrom, data)
+        finally:
+            del self._event_times[task]
+
+    def new_workflow(self, template, instance, **kwargs):
+        triggered = self._event_times.get(asyncio.Task.current_task())
+        if triggered is not None:
+            self.triggered_at[instance.uid] = triggered
+        return super().new_workflow(template, instance, **kwargs)
+
+
+def factory_rules():
+    return [
+        {'type': 'set', 'fieldname': 'origin', 'value': 'benchmark'},
+        {'type': 'copy', 'fieldname': 'message', 'copy': 'raw'},
+        {'type': 'extract', 'fieldname': 'message', 'regex_id': 'code'},
+        {'type': 'sub', 'fieldname': 'message', 'regex_id': 'digits',
+         'repl': '#'},
+        {'type': 'lookup', 'fieldname': 'level', 'lookup_id': 'levels'},
+        {'type': 'arithmetic', 'fieldname': 'score', 'operator': '*',
+         'operand1': '@count', 'operand2': 2},
+        {'type': 'condition-block', 'conditions': [
+            {'type': 'if', 'condition': "(@level == 'CRITICAL')", 'rules': [
+                {'type': 'set', 'fieldname': 'escalate', 'value': True},
+            ]},
+            {'type': 'else', 'rules': [
+                {'type': 'set', 'fieldname': 'escalate', 'value': False},
+            ]},
+        ]},
+    ]
+
+
+def workloads():
+    """
+    Return the workload templates, the first of each list being triggered.
+    """
+    factory = {
+        'id': str(uuid4()), 'title': 'factory', 'topics': [TOPIC],
+        'policy': 'start-new',
+        'tasks': [{
+            'id': 'factory', 'name': 'factory',
+            'config': {'rules': factory_rules()},
+        }],
+        'graph': {'factory': []},
+    }
+
+    selector = {
+        'id': str(uuid4()), 'title': 'selector', 'topics': [TOPIC],
+        'policy': 'start-new',
+        'tasks': [
+            {'id': 'factory', 'name': 'factory',
+             'config': {'rules': factory_rules()}},
+            {'id': 'selector', 'name': 'task_selector', 'config': {'rules': [
+                {'type': 'condition-block', 'conditions': [
+                    {'type': 'if', 'condition': '(@escalate == True)',
+                     'rules': [{'type': 'task-selector', 'tasks': ['high']}]},
+                    {'type': 'else',
+                     'rules': [{'type': 'task-selector', 'tasks': ['low']}]},
+                ]},
+            ]}},
+            {'id': 'high', 'name': 'factory', 'config': {'rules': [
+                {'type': 'set', 'fieldname': 'branch', 'value': 'high'},
+            ]}},
+            {'id': 'low', 'name': 'factory', 'config': {'rules': [
+                {'type': 'set', 'fieldname': 'branch', 'value': 'low'},
+            ]}},
+        ],
+        'graph': {
+            'factory': ['selector'], 'selector': ['high', 'low'],
+            'high': [], 'low': [],
+        },
+    }
+
+    child = {
+        'id': str(uuid4()), 'title': 'chain child', 'topics': [],
+        'policy': 'start-new',
+        'tasks': [{
+            'id': 'factory', 'name': 'factory',
+            'config': {'rules': factory_rules()},
+        }],
+        'graph': {'factory': []},
+    }
+
+    def chain(service):
+        return {
+            'id': str(uuid4()), 'title': 'chain', 'topics': [TOPIC],
+            'policy': 'start-new',
+            'tasks': [{
+                'id': 'trigger', 'name': 'trigger_workflow',
+                'config': {
+                    'template': {'service': service, 'id': child['id']},
+                },
+            }],
+            'graph': {'trigger': []},
+        }
+
+    return {
+        'factory': [factory],
+        'selector': [selector],
+        'chain': [chain(REMOTE_SERVICE), child],
+        'chain-local': [chain(SERVICE), child],
+    }
+
+
+def make_event(i):
+    return {
+        'message': 'Alarm {} raised with code E{:04d}'.format(i, i % 10000),
+        'severity': 'critical' if i % 3 == 0 else 'minor',
+        'count': i % 50,
+    }
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(pct / 100 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class Bench:
+
+    def __init__(self, api_port=15558, gateway_port=15559):
+        self.loop = asyncio.get_event_loop()
+        self._config = tempfile.NamedTemporaryFile('w', suffix='.json')
+        json.dump({
+            'log': {'version': 1, 'root': {'level': 'ERROR'}},
+            'bus': {'name': SERVICE},
+            'api': {'port': api_port, 'host': '127.0.0.1'},
+            'http_host': '127.0.0.1:{}'.format(gateway_port),
+            'mongo': {'host': 'memory', 'database': 'bench'},
+            'topics': [TOPIC],
+        }, self._config)
+        self._config.flush()
+        self.gateway_port = gateway_port
+        self.nyuki = None
+        self.gateway = None
+        self.ended = None
+        self.expected = 0
+        self.latencies = []
+        self.errors = 0
+
+    async def boot(self):
+        workflow_module.run_migrations = _no_migrations
+        self.nyuki = BenchNyuki(config=self._config.name)
+        logging.getLogger().setLevel(logging.ERROR)
+        self.nyuki.storage = MemoryStorage()
+        self.nyuki.rules = FactoryRuleCache(self.nyuki.storage)
+        runtime.rules = self.nyuki.rules
+        bus = FakeBus(SERVICE)
+        self.nyuki._services.services['bus'] = bus
+        runtime.bus = bus
+        self.nyuki.progress._publish = bus.publish
+
+        for service, config in self.nyuki.config.items():
+            if service in self.nyuki._services.all:
+                self.nyuki._services.get(service).configure(**config)
+        await self.nyuki._services.start()
+        await self.nyuki.setup()
+
+        storage = self.nyuki.storage
+        await storage.regexes.insert({
+            'id': 'code', 'name': 'code', 'pattern': r'(?P<code>E\d{4})',
+        })
+        await storage.regexes.insert({
+            'id': 'digits', 'name': 'digits', 'pattern': r'\d+',
+        })
+        await storage.lookups.insert({
+            'id': 'levels', 'title': 'levels', 'table': [
+                {'value': 'critical', 'replace': 'CRITICAL'},
+                {'value': 'minor', 'replace': 'MINOR'},
+            ],
+        })
+        self.gateway = Gateway(self.nyuki.api._port, self.loop)
+        await self.gateway.start(self.gateway_port)
+        get_broker().register(self._exec_event, topic=EXEC_TOPIC)
+
+    async def shutdown(self):
+        await self.gateway.stop()
+        await self.nyuki.teardown()
+        await self.nyuki._services.stop()
+        self._config.close()
+
+    async def _exec_event(self, event):
+        if event.data['type'] not in (
+            WorkflowExecState.END.value, WorkflowExecState.ERROR.value
+        ):
+            return
+        if event.data['type'] == WorkflowExecState.ERROR.value:
+            self.errors += 1
+        uid = event.source.as_dict()['workflow_exec_id']
+        triggered = self.nyuki.triggered_at.pop(uid, None)
+        if triggered is None:
+            # Child workflow
+            return
+        self.latencies.append(perf_counter() - triggered)
+        if len(self.latencies) >= self.expected and not self.ended.done():
+            self.ended.set_result(None)
+
+    def load(self, templates):
+        storage = self.nyuki.storage
+        storage._templates.clear()
+        for template in templates:
+            storage.add_template(template)
+
+    def _start(self, templates, events):
+        """
+        Load `templates` and expect `events` root workflows to end. The
+        workflows of a previous pass still running are not counted.
+        """
+        self.load(templates)
+        self.nyuki.triggered_at.clear()
+        self.latencies = []
+        self.errors = 0
+        self.expected = events
+        self.ended = asyncio.Future()
+
+    async def _wait(self, timeout=120):
+        """
+        Wait for all the expected root workflows to end, return False if
+        they did not in time.
+        """
+        try:
+            await asyncio.wait_for(asyncio.shield(self.ended), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return len(self.latencies) == self.expected
+
+    async def _lag(self, samples, interval=0.01):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(interval)
+            samples.append(max(self.loop.time() - start - interval, 0))
+
+    async def run(self, templates, events, concurrency):
+        """
+        Fire `events` events, at most `concurrency` being dispatched at once.
+        """
+        self._start(templates, events)
+        lag = []
+        lag_task = asyncio.ensure_future(self._lag(lag))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fire(i):
+            async with semaphore:
+                await self.nyuki.workflow_event(TOPIC, make_event(i))
+
+        start = perf_counter()
+        await asyncio.gather(*[fire(i) for i in range(events)])
+        complete = await self._wait()
+        elapsed = perf_counter() - start
+        lag_task.cancel()
+
+        return {
+            'events': events,
+            'completed': len(self.latencies),
+            'complete': complete,
+            'errors': self.errors,
+            'elapsed': round(elapsed, 3),
+            'triggers_per_sec': round(len(self.latencies) / elapsed, 1),
+            'latency_p50_ms': round(percentile(self.latencies, 50) * 1e3, 2),
+            'latency_p99_ms': round(percentile(self.latencies, 99) * 1e3, 2),
+            'loop_lag_p50_ms': round((percentile(lag, 50) or 0) * 1e3, 2),
+            'loop_lag_p99_ms': round((percentile(lag, 99) or 0) * 1e3, 2),
+            'loop_lag_max_ms': round(max(lag or [0]) * 1e3, 2),
+        }
+
+    async def memory(self, templates, events):
+        """
+        Memory held per running workflow, sampled while `events` workflows
+        are running. None if they did not all end.
+        """
+        self._start(templates, events)
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        samples = []
+
+        async def sample():
+            while True:
+                running = len(self.nyuki.running_workflows)
+                if running >= 10:
+                    current = tracemalloc.get_traced_memory()[0]
+                    samples.append((current - baseline) / running)
+                await asyncio.sleep(0.005)
+
+        sampler = asyncio.ensure_future(sample())
+        await asyncio.gather(*[
+            self.nyuki.workflow_event(TOPIC, make_event(i))
+            for i in range(events)
+        ])
+        complete = await self._wait()
+        sampler.cancel()
+        tracemalloc.stop()
+        if not complete:
+            return None
+        return round(percentile(samples, 50) or 0)
+
+
+def compare(results, previous):
+    for name, result in results.items():
+        before = previous.get(name)
+        if not before:
+            continue
+        print('{} vs previous run:'.format(name))
+        for key, value in result.items():
+            old = before.get(key)
+            if isinstance(value, bool) or \
+                    not isinstance(value, (int, float)) or not old:
+                continue
+            print('  {:<20} {:>12} -> {:<12} ({:+.1f}%)'.format(
+                key, old, value, (value - old) / old * 100
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '-w', '--workloads', nargs='+',
+        default=['factory', 'selector', 'chain', 'chain-local'],
+    )
+    parser.add_argument('-n', '--events', type=int, default=1000)
+    parser.add_argument('-c', '--concurrency', type=int, default=100)
+    parser.add_argument('-m', '--memory-events', type=int, default=200)
+    parser.add_argument('--save', help='write the results into this file')
+    parser.add_argument('--compare', help='previous results file')
+    args = parser.parse_args()
+
+    bench = Bench()
+    loop = bench.loop
+    loop.run_until_complete(bench.boot())
+    templates = workloads()
+    results = {}
+    incomplete = []
+    try:
+        for name in args.workloads:
+            # The chain workloads are much slower (HTTP requests, twice the
+            # workflows)
+            events = args.events
+            if name.startswith('chain'):
+                events //= 10
+            result = loop.run_until_complete(
+                bench.run(templates[name], events, args.concurrency)
+            )
+            result['memory_per_workflow'] = loop.run_until_complete(
+                bench.memory(templates[name], args.memory_events)
+            )
+            results[name] = result
+            print('{}: {}'.format(name, json.dumps(result, indent=2)))
+            if not result['complete'] or \
+                    result['memory_per_workflow'] is None:
+                incomplete.append(name)
+    finally:
+        loop.run_until_complete(bench.shutdown())
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if incomplete:
+        sys.exit('Workflows did not all end in time: {}'.format(
+            ', '.join(incomplete)
+        ))
+
+
+if __name__ == '__main__':
+    main()
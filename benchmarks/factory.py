@@ -0,0 +1,357 @@
+"""
+Micro-benchmarks of the factory rules (`nyuki.utils.transform`) and their
+conditions (`nyuki.utils.evaluate`), by group:
+    - rules: each rule type applied to a 1 KB payload
+    - conditions: parsing, evaluation and condition blocks
+    - tracking: `TraceableDict` overhead, each diff mode against untracked
+    - pipelines: `Converter` pipelines of 1 to 200 rules over 1 KB to 10 MB
+      payloads, and a copy of the bulk of the payload, in each diff mode
+
+Each result is the best time per call (in microseconds) over a few runs of
+a calibrated number of calls, on a fresh (shallow) copy of the payload.
+Results are saved as JSON to be compared with a later run: the comparison
+exits with an error if a benchmark got slower than the threshold.
+
+    python -m benchmarks.factory [-g rules pipelines] [--quick]
+        [--save results.json] [--compare previous.json] [--threshold 30]
+"""
+import sys
+import json
+import argparse
+import platform
+from time import perf_counter
+from uuid import uuid4
+
+from nyuki.utils.evaluate import ConditionBlock, compile_condition, safe_eval
+from nyuki.utils.transform import Converter, DiffMode, TraceableDict
+
+
+KB = 1024
+MB = 1024 * KB
+SIZES = [('1KB', KB), ('100KB', 100 * KB), ('1MB', MB), ('10MB', 10 * MB)]
+QUICK_SIZES = SIZES[:2]
+RULE_COUNTS = [1, 10, 50, 200]
+
+# Each measure runs at least this long (seconds), keeping the best run
+RUN_TIME = 0.05
+REPEAT = 5
+
+
+def make_payload(size=KB):
+    """
+    Alarm-like payload of about `size` bytes (as JSON), most of it in a list
+    of contacts no rule touches.
+    """
+    payload = {
+        'subject': 'Alarm raised on device dev42 at 12:00',
+        'message': 'Disk usage above 95% on /var, reference REF-0042',
+        'level': 'minor',
+        'region': 'EU-West',
+        'number': '+33612345678',
+        'priority': 3,
+        'latency': 742.5,
+        'scores': [i * 1.5 for i in range(50)],
+        'tags': ['tag{}'.format(i) for i in range(50)],
+        'labels': ['tag{}'.format(i) for i in range(25, 75)],
+        'meta': {'source': 'probe', 'site': 'paris'},
+        'extra': {'owner': 'noc', 'site': 'lyon'},
+        'contacts': [],
+    }
+    base = len(json.dumps(payload))
+    contact = {
+        'uid': str(uuid4()),
+        'name': 'contact 00000',
+        'phones': ['+33600000000', '+33611111111'],
+        'status': 'pending',
+    }
+    count = max(0, size - base) // (len(json.dumps(contact)) + 2)
+    payload['contacts'] = [
+        {**contact, 'uid': str(uuid4()), 'name': 'contact {}'.format(i)}
+        for i in range(count)
+    ]
+    return payload
+
+
+def make_table(size=1000):
+    return {'value{}'.format(i): 'replace{}'.format(i) for i in range(size)}
+
+
+CONDITION = "(@level == 'minor' and @priority > 2) or 'dev42' in @subject"
+
+RULES = {
+    'set': {'type': 'set', 'fieldname': 'status', 'value': 'new'},
+    'copy': {'type': 'copy', 'fieldname': 'subject', 'copy': 'title'},
+    'unset': {'type': 'unset', 'fieldname': 'region'},
+    'lower': {'type': 'lower', 'fieldname': 'region'},
+    'upper': {'type': 'upper', 'fieldname': 'region'},
+    'extract': {
+        'type': 'extract', 'fieldname': 'subject',
+        'pattern': r'device (?P<device>\w+)',
+    },
+    'extract-no-literal': {
+        'type': 'extract', 'fieldname': 'message',
+        'pattern': r'Ticket (?P<ticket>\d+)',
+    },
+    'sub': {
+        'type': 'sub', 'fieldname': 'message', 'pattern': r'\d+',
+        'repl': '#',
+    },
+    'lookup-exact': {
+        'type': 'lookup', 'fieldname': 'level',
+        'table': {**make_table(), 'minor': 'MINOR'},
+    },
+    'lookup-icase': {
+        'type': 'lookup', 'fieldname': 'region', 'icase': True,
+        'table': {**make_table(), 'eu-west': 'europe'},
+    },
+    'lookup-prefix': {
+        'type': 'lookup', 'fieldname': 'number', 'mode': 'prefix',
+        'table': {
+            **{'+{}'.format(i): 'country{}'.format(i) for i in range(1000)},
+            '+336': 'FR mobile',
+        },
+    },
+    'lookup-range': {
+        'type': 'lookup', 'fieldname': 'latency', 'mode': 'range',
+        'table': {str(i * 10): 'bucket{}'.format(i) for i in range(1000)},
+    },
+    'arithmetic': {
+        'type': 'arithmetic', 'fieldname': 'score', 'operator': '*',
+        'operand1': '@priority', 'operand2': 2,
+    },
+    'arithmetic-list': {
+        'type': 'arithmetic', 'fieldname': 'scores', 'operator': '*',
+        'operand1': '@scores', 'operand2': 2,
+    },
+    'union-list': {
+        'type': 'union', 'fieldname': 'tags',
+        'operand1': '@tags', 'operand2': '@labels',
+    },
+    'union-dict': {
+        'type': 'union', 'fieldname': 'meta',
+        'operand1': '@meta', 'operand2': '@extra',
+    },
+    'condition-block': {
+        'type': 'condition-block', 'conditions': [
+            {'type': 'if', 'condition': "@level == 'major'", 'rules': [
+                {'type': 'set', 'fieldname': 'status', 'value': 'urgent'},
+            ]},
+            {'type': 'elif', 'condition': CONDITION, 'rules': [
+                {'type': 'set', 'fieldname': 'status', 'value': 'watch'},
+            ]},
+            {'type': 'else', 'rules': []},
+        ],
+    },
+}
+
+
+def make_rules(count):
+    """
+    Pipeline of `count` rules, cycling through the rule types.
+    """
+    rules = list(RULES.values())
+    return {'rules': (rules * (count // len(rules) + 1))[:count]}
+
+
+def measure(func, payload=None):
+    """
+    Best time of `func(copy of payload)`, in microseconds.
+    """
+    def run(number):
+        copies = [dict(payload or {}) for _ in range(number)]
+        start = perf_counter()
+        for data in copies:
+            func(data)
+        return perf_counter() - start
+
+    # Calibrate the number of calls per run
+    number = 1
+    while True:
+        elapsed = run(number)
+        if elapsed >= RUN_TIME or number >= 100000:
+            break
+        number = min(100000, max(
+            number * 2, int(number * RUN_TIME / max(elapsed, 1e-9))
+        ))
+
+    best = min(elapsed, *(run(number) for _ in range(REPEAT - 1)))
+    return {'us': round(best / number * 1e6, 3), 'calls': number}
+
+
+def bench_rules():
+    results = {}
+    payload = make_payload(KB)
+    for name, rule in RULES.items():
+        converter = Converter.from_dict({'rules': [rule]})
+        for mode in (DiffMode.FULL, DiffMode.NONE):
+            results['rules/{}/{}'.format(name, mode.value)] = measure(
+                lambda data: converter.apply(data, mode), payload
+            )
+    return results
+
+
+def bench_conditions():
+    results = {}
+    payload = make_payload(KB)
+
+    results['conditions/compile'] = measure(
+        lambda data: compile_condition.__wrapped__(CONDITION)
+    )
+    results['conditions/compile-cached'] = measure(
+        lambda data: compile_condition(CONDITION)
+    )
+    evaluate = compile_condition(CONDITION)
+    results['conditions/evaluate'] = measure(evaluate, payload)
+    results['conditions/safe-eval'] = measure(
+        lambda data: safe_eval(CONDITION, data), payload
+    )
+
+    class Block(ConditionBlock):
+        def condition_validated(self, condition, data):
+            pass
+
+    conditions = [
+        {'type': 'if' if i == 0 else 'elif',
+         'condition': '@priority == {}'.format(i + 10), 'rules': []}
+        for i in range(10)
+    ] + [{'type': 'else', 'rules': []}]
+    block = Block(conditions)
+    results['conditions/block-10-to-else'] = measure(block.apply, payload)
+    results['conditions/block-build'] = measure(
+        lambda data: Block(conditions)
+    )
+    return results
+
+
+def bench_tracking():
+    results = {}
+    payload = make_payload(KB)
+    keys = ['subject', 'message', 'level', 'region', 'number']
+
+    def untracked(data):
+        for key in keys:
+            data[key] = 'updated'
+        data['new'] = 'added'
+        del data['priority']
+
+    results['tracking/untracked'] = measure(untracked, payload)
+    for values in (True, False):
+        def tracked(data):
+            tracker = TraceableDict(data, values)
+            untracked(tracker)
+            return tracker.changes
+        name = 'values' if values else 'no-values'
+        results['tracking/{}'.format(name)] = measure(tracked, payload)
+
+    def rollback(data):
+        tracker = TraceableDict(data)
+        untracked(tracker)
+        tracker.rollback()
+
+    results['tracking/rollback'] = measure(rollback, payload)
+    return results
+
+
+def bench_pipelines(sizes=SIZES, counts=RULE_COUNTS):
+    results = {}
+    for size_name, size in sizes:
+        payload = make_payload(size)
+        pipelines = [
+            ('{}-rules'.format(count), make_rules(count)) for count in counts
+        ]
+        # A rule touching the bulk of the payload, recorded in the diffs
+        pipelines.append(('copy-contacts', {'rules': [
+            {'type': 'copy', 'fieldname': 'contacts', 'copy': 'recipients'},
+        ]}))
+        for pipeline, rules in pipelines:
+            converter = Converter.from_dict(rules)
+            for mode in DiffMode:
+                name = 'pipelines/{}/{}/{}'.format(
+                    size_name, pipeline, mode.value
+                )
+                results[name] = measure(
+                    lambda data: converter.apply(data, mode), payload
+                )
+                print('{:<40} {:>12.1f} us'.format(name, results[name]['us']))
+    return results
+
+
+GROUPS = {
+    'rules': bench_rules,
+    'conditions': bench_conditions,
+    'tracking': bench_tracking,
+    'pipelines': bench_pipelines,
+}
+
+
+def compare(results, previous, threshold):
+    """
+    Print the time change of each benchmark ran both times, and return the
+    names of the ones slower by more than `threshold` percent.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = previous.get(name)
+        if not before or not before.get('us'):
+            continue
+        change = (result['us'] - before['us']) / before['us'] * 100
+        slower = change > threshold
+        if slower:
+            regressions.append(name)
+        print('{:<40} {:>12} -> {:<12} ({:+.1f}%){}'.format(
+            name, before['us'], result['us'], change,
+            ' REGRESSION' if slower else ''
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '-g', '--groups', nargs='+', choices=list(GROUPS),
+        default=list(GROUPS),
+    )
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='pipelines over payloads of up to 100 KB only',
+    )
+    parser.add_argument('--save', help='write the results into this file')
+    parser.add_argument('--compare', help='previous results file')
+    parser.add_argument(
+        '--threshold', type=float, default=30,
+        help='slowdown (percent) reported as a regression',
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for group in args.groups:
+        if group == 'pipelines':
+            results.update(bench_pipelines(
+                QUICK_SIZES if args.quick else SIZES
+            ))
+            continue
+        group_results = GROUPS[group]()
+        for name, result in sorted(group_results.items()):
+            print('{:<40} {:>12.3f} us'.format(name, result['us']))
+        results.update(group_results)
+
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous:
+            previous = json.load(previous)['results']
+        regressions = compare(results, previous, args.threshold)
+        if regressions:
+            print('{} regression(s) above {}%'.format(
+                len(regressions), args.threshold
+            ))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
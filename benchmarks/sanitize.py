@@ -0,0 +1,99 @@
+"""
+Compare the BSON-safe encoder used to store workflow history against the
+previous recursive implementation, on realistic ~1 MB workflow reports.
+
+    python -m benchmarks.sanitize
+"""
+import timeit
+from copy import deepcopy
+from datetime import datetime, timezone
+from uuid import uuid4
+from bson import BSON
+
+from nyuki.utils.serialize import bson_safe
+
+
+def legacy_sanitize(obj):
+    """
+    Recursive implementation used before `bson_safe`.
+    """
+    types = [dict, list, tuple, str, int, float, bool, type(None), datetime]
+    if type(obj) not in types:
+        obj = 'Internal server data: {}'.format(type(obj))
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            obj[key] = legacy_sanitize(value)
+    elif isinstance(obj, list):
+        for item in obj:
+            item = legacy_sanitize(item)
+    return obj
+
+
+def make_report(tasks=20, contacts=150):
+    """
+    Build a workflow report shaped like the ones stored in history.
+    """
+    now = datetime.now(timezone.utc)
+
+    def data():
+        return {
+            'uid': str(uuid4()),
+            'subject': 'Alarm raised on device {}'.format(uuid4()),
+            'body': 'lorem ipsum dolor sit amet ' * 20,
+            'priority': 3,
+            'ratio': 0.75,
+            'acked': False,
+            'date': now,
+            'contacts': [
+                {
+                    'uid': str(uuid4()),
+                    'name': 'contact {}'.format(i),
+                    'phones': ['+33600000000', '+33611111111'],
+                    'status': 'pending',
+                    'date': now,
+                }
+                for i in range(contacts)
+            ],
+            'handle': object(),
+        }
+
+    return {
+        'id': str(uuid4()),
+        'start': now,
+        'end': now,
+        'state': 'finished',
+        'template': {
+            'id': str(uuid4()),
+            'title': 'benchmark',
+            'graph': {},
+            'tasks': [
+                {
+                    'template': {'id': str(i), 'name': 'factory', 'config': {}},
+                    'id': str(uuid4()),
+                    'start': now,
+                    'end': now,
+                    'state': 'finished',
+                    'inputs': data(),
+                    'outputs': data(),
+                    'reporting': None,
+                }
+                for i in range(tasks)
+            ],
+        },
+    }
+
+
+def main(number=20):
+    report = make_report()
+    size = len(BSON.encode(bson_safe(report)))
+    print('Report size: {:.2f} MB'.format(size / 1024 / 1024))
+
+    copies = [deepcopy(report) for _ in range(number)]
+    legacy = timeit.timeit(lambda: legacy_sanitize(copies.pop()), number=number)
+    current = timeit.timeit(lambda: bson_safe(report), number=number)
+    print('legacy_sanitize: {:.2f} ms/report'.format(legacy / number * 1000))
+    print('bson_safe:       {:.2f} ms/report'.format(current / number * 1000))
+
+
+if __name__ == '__main__':
+    main()
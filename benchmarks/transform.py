@@ -0,0 +1,164 @@
+"""
+Compare the in-place change tracking of the factory rules (for each diff
+mode) against the previous whole-dict deep copy, for a 30 rules factory
+over payloads of growing size.
+Then measure 40 extract rules on a long email body, with and without the
+required literal prefilter of the regex rules.
+
+    python -m benchmarks.transform
+"""
+import timeit
+from copy import deepcopy
+from uuid import uuid4
+
+from nyuki.utils.transform import Converter, DiffMode
+
+
+class LegacyTraceableDict(dict):
+
+    """
+    Deep copy of the data, tracked, as used before `TraceableDict` wrote
+    through to the data.
+    """
+
+    def __init__(self, dict2):
+        super().__init__(deepcopy(dict2))
+        self.changes = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.changes.append({
+                'action': 'add', 'key': key, 'value': deepcopy(value)
+            })
+        elif self[key] != value:
+            self.changes.append({
+                'action': 'update', 'key': key,
+                'old_value': deepcopy(self[key]),
+                'new_value': deepcopy(value)
+            })
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.changes.append({
+            'action': 'remove', 'key': key, 'value': deepcopy(self[key])
+        })
+        super().__delitem__(key)
+
+    def update(self, dict2=None, **kwargs):
+        for key in dict2:
+            self[key] = dict2[key]
+
+
+def legacy_apply(converter, data):
+    diff = {'rules': []}
+    for rule in converter.rules:
+        tracker = LegacyTraceableDict(data)
+        rule.apply.__wrapped__(rule, tracker)
+        data.clear()
+        data.update(tracker)
+        diff['rules'].append({'type': rule.TYPENAME, 'changes': tracker.changes})
+    return diff
+
+
+def make_rules(count=30):
+    rules = [
+        {'type': 'set', 'fieldname': 'status', 'value': 'new'},
+        {'type': 'copy', 'fieldname': 'subject', 'copy': 'title'},
+        {'type': 'extract', 'fieldname': 'subject',
+         'pattern': r'device (?P<device>\w+)'},
+        {'type': 'sub', 'fieldname': 'title', 'pattern': r'\d+',
+         'repl': '#'},
+        {'type': 'lookup', 'fieldname': 'level',
+         'table': {'minor': 'MINOR', 'major': 'MAJOR'}},
+        {'type': 'arithmetic', 'fieldname': 'score', 'operator': '*',
+         'operand1': '@priority', 'operand2': 2},
+    ]
+    return {'rules': (rules * (count // len(rules) + 1))[:count]}
+
+
+def make_payload(contacts):
+    return {
+        'subject': 'Alarm raised on device dev42 at 12:00',
+        'level': 'minor',
+        'priority': 3,
+        'contacts': [
+            {
+                'uid': str(uuid4()),
+                'name': 'contact {}'.format(i),
+                'phones': ['+33600000000', '+33611111111'],
+                'status': 'pending',
+            }
+            for i in range(contacts)
+        ],
+    }
+
+
+def make_extract_rules(count=40):
+    rules = []
+    for i in range(count):
+        if i % 2:
+            pattern = r'Reference{0}: (?P<ref{0}>\w+)'.format(i)
+        else:
+            pattern = r'(?P<qty{0}>\d+) units of item{0}\b'.format(i)
+        rules.append({
+            'type': 'extract', 'fieldname': 'body', 'pattern': pattern
+        })
+    return {'rules': rules}
+
+
+def make_email(lines=400):
+    body = [
+        'Line {} of a long email body, with numbers 12 34 and words.'.format(i)
+        for i in range(lines)
+    ]
+    # Only a few rules match
+    body.insert(lines // 2, '3 units of item0')
+    body.append('Reference1: ABC123')
+    return {'body': '\n'.join(body)}
+
+
+def extract_benchmark(number=50):
+    converter = Converter.from_dict(make_extract_rules())
+    email = make_email()
+    literals = [rule._literal for rule in converter.rules]
+    timings = []
+    for prefilter in (False, True):
+        for rule, literal in zip(converter.rules, literals):
+            rule._literal = literal if prefilter else None
+        timings.append(timeit.timeit(
+            lambda: converter.apply(dict(email)), number=number
+        ))
+    print(
+        '{} KB email, {} extract rules: search {:.2f} ms, '
+        'prefiltered {:.2f} ms'.format(
+            len(email['body']) // 1024, len(converter.rules),
+            *(timing / number * 1000 for timing in timings)
+        )
+    )
+
+
+def main(number=20):
+    converter = Converter.from_dict(make_rules())
+    for contacts in (10, 100, 1000, 4000):
+        payload = make_payload(contacts)
+        size = len(repr(payload))
+        # Keep the copies alive, not to measure their deallocation
+        copies = iter([deepcopy(payload) for _ in range(number)])
+        timings = [timeit.timeit(
+            lambda: legacy_apply(converter, next(copies)), number=number
+        )]
+        for mode in DiffMode:
+            copies = iter([deepcopy(payload) for _ in range(number)])
+            timings.append(timeit.timeit(
+                lambda: converter.apply(next(copies), mode), number=number
+            ))
+        print(
+            '{:>5} KB payload: legacy {:8.2f} ms, full {:5.2f} ms, '
+            'summary {:5.2f} ms, none {:5.2f} ms'.format(
+                size // 1024, *(timing / number * 1000 for timing in timings)
+            )
+        )
+    extract_benchmark()
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-from .api import Response, Api, resource, content_type, HTTPBreak
+from .api import Response, Api, resource, content_type, streamed, HTTPBreak
@@ -37,6 +37,15 @@ def content_type(content_type):
     return decorated
 
 
+def streamed(func):
+    """
+    Decorator for methods reading the request body as a stream, the body is
+    then not loaded beforehand to check its content.
+    """
+    func.STREAMED = True
+    return func
+
+
 class HTTPBreak(Exception):
 
     def __init__(self, status, body=None):
@@ -94,8 +103,11 @@ async def mw_capability(app, capa_handler):
                     )
                     return Response({'error': 'Wrong or Missing content-type'}, status=400)
 
+            # Streamed bodies are only read by the handler
+            streamed = getattr(capa_handler, 'STREAMED', False)
+
             # Check application/json is really a JSON body
-            if 'application/json' in required_types:
+            if 'application/json' in required_types and not streamed:
                 try:
                     await request.json()
                 except json.decoder.JSONDecodeError:
@@ -106,7 +118,7 @@ async def mw_capability(app, capa_handler):
                     )
 
             # Check multipart/form-data is really a post form
-            if 'multipart/form-data' in required_types:
+            if 'multipart/form-data' in required_types and not streamed:
                 try:
                     await request.post()
                 except ValueError as exc:
@@ -126,7 +138,7 @@ async def mw_capability(app, capa_handler):
             reporting.exception(exc)
             raise
 
-        if capa_resp and isinstance(capa_resp, Response):
+        if capa_resp and isinstance(capa_resp, web.StreamResponse):
             return capa_resp
         return Response()
 
@@ -156,6 +168,7 @@ class ResourceClass:
                 async_handler.CONTENT_TYPE = getattr(
                     handler, 'CONTENT_TYPE', self.content_type
                 )
+                async_handler.STREAMED = getattr(handler, 'STREAMED', False)
                 route = resource.add_route(method, async_handler)
                 log.debug('Added route: %s', route)
 
@@ -1,9 +1,15 @@
+import time
+import zlib
+import pickle
 import asyncio
 import logging
+import msgpack
+from datetime import datetime, timedelta, timezone
 from socket import error as SocketError
 from aioredis import create_reconnecting_redis, RedisError
 
 from nyuki.services import Service
+from nyuki.utils import serialize_object
 
 
 log = logging.getLogger(__name__)
@@ -22,11 +28,161 @@ def memsafe(coro):
     return wrapper
 
 
+class CodecError(Exception):
+    pass
+
+
+class CheckpointCodec:
+
+    """
+    Base codec used to share checkpoints (e.g. workflow reports) in memory.
+    Every entry is prefixed with a small header:
+        b'NYK' | version (1 byte) | codec id (1 byte) | flags (1 byte)
+    Payloads bigger than `compress_threshold` bytes are zlib-compressed.
+    Entries without header are legacy pickles, only loaded if allowed.
+    """
+
+    MAGIC = b'NYK'
+    VERSION = 1
+    HEADER_SIZE = len(MAGIC) + 3
+    COMPRESSED = 0x01
+
+    # Unique identifier of the codec written in the header
+    CODEC_ID = None
+
+    def __init__(self, compress_threshold=4096, compress_level=6,
+                 legacy_pickle=True):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.legacy_pickle = legacy_pickle
+        self.stats = {
+            'encoded': 0,
+            'decoded': 0,
+            'legacy_decoded': 0,
+            'compressed': 0,
+            'raw_bytes': 0,
+            'stored_bytes': 0,
+            'encode_time': 0.0,
+            'decode_time': 0.0,
+        }
+
+    def dumps(self, obj):
+        raise NotImplementedError
+
+    def loads(self, payload):
+        raise NotImplementedError
+
+    def encode(self, obj):
+        """
+        Serialize `obj` into a versioned bytes entry.
+        """
+        start = time.perf_counter()
+        payload = self.dumps(obj)
+        raw_size = len(payload)
+        flags = 0
+        if self.compress_threshold is not None \
+                and raw_size > self.compress_threshold:
+            payload = zlib.compress(payload, self.compress_level)
+            flags |= self.COMPRESSED
+            self.stats['compressed'] += 1
+
+        header = self.MAGIC + bytes((self.VERSION, self.CODEC_ID, flags))
+        data = header + payload
+        elapsed = time.perf_counter() - start
+
+        self.stats['encoded'] += 1
+        self.stats['raw_bytes'] += raw_size
+        self.stats['stored_bytes'] += len(data)
+        self.stats['encode_time'] += elapsed
+        log.debug(
+            'Encoded checkpoint: %d bytes (%d raw) in %.3f ms',
+            len(data), raw_size, elapsed * 1000,
+        )
+        return data
+
+    def decode(self, data):
+        """
+        Deserialize a bytes entry, whatever the codec used to write it.
+        """
+        start = time.perf_counter()
+        if not data.startswith(self.MAGIC):
+            # Entry written before the codec existed (pickle)
+            if self.legacy_pickle is not True:
+                raise CodecError('legacy pickled entries are not allowed')
+            self.stats['legacy_decoded'] += 1
+            return pickle.loads(data)
+
+        version, codec_id, flags = data[len(self.MAGIC):self.HEADER_SIZE]
+        if version > self.VERSION:
+            raise CodecError('unsupported entry version {}'.format(version))
+        try:
+            codec = CODECS_BY_ID[codec_id]
+        except KeyError:
+            raise CodecError('unknown codec id {}'.format(codec_id))
+
+        payload = data[self.HEADER_SIZE:]
+        if flags & self.COMPRESSED:
+            payload = zlib.decompress(payload)
+        if codec is type(self):
+            obj = self.loads(payload)
+        else:
+            obj = codec().loads(payload)
+
+        self.stats['decoded'] += 1
+        self.stats['decode_time'] += time.perf_counter() - start
+        return obj
+
+
+class MsgpackCodec(CheckpointCodec):
+
+    """
+    Compact msgpack serialization, datetimes are stored as an extension type.
+    Unknown objects are serialized as strings (see `serialize_object`).
+    """
+
+    CODEC_ID = 1
+    DATETIME_EXT = 1
+
+    def _default(self, obj):
+        if isinstance(obj, datetime):
+            offset = obj.utcoffset()
+            return msgpack.ExtType(self.DATETIME_EXT, msgpack.packb([
+                obj.year, obj.month, obj.day,
+                obj.hour, obj.minute, obj.second, obj.microsecond,
+                int(offset.total_seconds()) if offset is not None else None,
+            ]))
+        return serialize_object(obj)
+
+    def _ext_hook(self, code, data):
+        if code != self.DATETIME_EXT:
+            return msgpack.ExtType(code, data)
+        *fields, offset = msgpack.unpackb(data)
+        tzinfo = None
+        if offset == 0:
+            tzinfo = timezone.utc
+        elif offset is not None:
+            tzinfo = timezone(timedelta(seconds=offset))
+        return datetime(*fields, tzinfo=tzinfo)
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, default=self._default, use_bin_type=True)
+
+    def loads(self, payload):
+        return msgpack.unpackb(payload, ext_hook=self._ext_hook, raw=False)
+
+
+CODECS = {
+    'msgpack': MsgpackCodec,
+}
+CODECS_BY_ID = {codec.CODEC_ID: codec for codec in CODECS.values()}
+
+
 class Memory(Service):
 
     def __init__(self, nyuki):
         self.store = None
         self.config = {}
+        self.codec = MsgpackCodec()
         self.service = nyuki.config['service']
         self.loop = nyuki.loop or asyncio.get_event_loop()
 
@@ -42,6 +198,9 @@ class Memory(Service):
 
     def configure(self, *args, **kwargs):
         self.config = kwargs
+        codec = dict(kwargs.get('codec', {}))
+        codec_cls = CODECS[codec.pop('name', 'msgpack')]
+        self.codec = codec_cls(**codec)
 
     async def start(self, *args, **kwargs):
         """
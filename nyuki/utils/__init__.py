@@ -1,4 +1,4 @@
 from .dtutils import from_isoformat, utcnow
 from .evaluate import safe_eval, ConditionBlock
-from .serialize import serialize_object
+from .serialize import serialize_object, bson_safe
 from .transform import Converter
@@ -1,7 +1,9 @@
-import re
+import io
 import ast
-from collections import defaultdict
 import logging
+import operator
+import tokenize
+from functools import lru_cache
 
 
 log = logging.getLogger(__name__)
@@ -38,19 +40,166 @@ OPERATORS = [
 
 CONTEXTS = [ast.Load]
 
-AUTHORIZED_TYPES = EXPRESSIONS + OPERATORS + CONTEXTS
+# Literals are all parsed as `ast.Constant` from Python 3.8
+CONSTANT = getattr(ast, 'Constant', ast.Num)
 
+AUTHORIZED_TYPES = EXPRESSIONS + OPERATORS + CONTEXTS + [CONSTANT]
 
-def safe_eval(expr):
+
+# Variables are swapped for names with this prefix before parsing
+VARIABLE_PREFIX = '_nyuki_var_'
+
+UNARY_OPS = {
+    ast.Invert: operator.invert,
+    ast.Not: operator.not_,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+COMPARE_OPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+}
+
+
+def _substitute_variables(expr):
+    """
+    Swap the `@variable` placeholders (outside of strings) for valid Python
+    names.
+    """
+    tokens = []
+    placeholder = False
+    readline = io.StringIO(expr).readline
+    try:
+        for token in tokenize.generate_tokens(readline):
+            if token.type == tokenize.OP and token.string == '@':
+                placeholder = True
+                continue
+            if placeholder:
+                if token.type != tokenize.NAME:
+                    raise SyntaxError('invalid variable in {}'.format(expr))
+                token = (tokenize.NAME, VARIABLE_PREFIX + token.string)
+                placeholder = False
+            tokens.append(token[:2])
+    except tokenize.TokenError as exc:
+        # Unbalanced brackets, like the parser would report it
+        raise SyntaxError(
+            'invalid condition {}: {}'.format(expr, exc.args[0])
+        ) from exc
+    return tokenize.untokenize(tokens)
+
+
+def _compile_node(node, expr):
+    """
+    Return a function of the data evaluating an authorized AST node.
+    """
+    if type(node) not in AUTHORIZED_TYPES and type(node) is not ast.Name:
+        raise TypeError("forbidden type {} found in {}".format(node, expr))
+
+    if isinstance(node, ast.Name):
+        if not node.id.startswith(VARIABLE_PREFIX):
+            raise TypeError("forbidden type {} found in {}".format(node, expr))
+        key = node.id[len(VARIABLE_PREFIX):]
+        return lambda data: data.get(key)
+
+    if isinstance(node, (ast.Num, ast.Str, ast.NameConstant, CONSTANT)):
+        # Constant values: numbers, strings, True/False/None
+        value = ast.literal_eval(node)
+        return lambda data: value
+
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        items = [_compile_node(item, expr) for item in node.elts]
+        container = {ast.List: list, ast.Tuple: tuple, ast.Set: set}
+        build = container[type(node)]
+        return lambda data: build(item(data) for item in items)
+
+    if isinstance(node, ast.Dict):
+        keys = [_compile_node(key, expr) for key in node.keys]
+        values = [_compile_node(value, expr) for value in node.values]
+        pairs = list(zip(keys, values))
+        return lambda data: {key(data): value(data) for key, value in pairs}
+
+    if isinstance(node, ast.UnaryOp):
+        _check_operator(node.op, expr)
+        func = UNARY_OPS[type(node.op)]
+        operand = _compile_node(node.operand, expr)
+        return lambda data: func(operand(data))
+
+    if isinstance(node, ast.BoolOp):
+        _check_operator(node.op, expr)
+        values = [_compile_node(value, expr) for value in node.values]
+        if isinstance(node.op, ast.And):
+            def evaluate(data):
+                for value in values:
+                    result = value(data)
+                    if not result:
+                        return result
+                return result
+        else:
+            def evaluate(data):
+                for value in values:
+                    result = value(data)
+                    if result:
+                        return result
+                return result
+        return evaluate
+
+    # ast.Compare, possibly chained (a < b < c)
+    for op in node.ops:
+        _check_operator(op, expr)
+    left = _compile_node(node.left, expr)
+    comparisons = [
+        (COMPARE_OPS[type(op)], _compile_node(comparator, expr))
+        for op, comparator in zip(node.ops, node.comparators)
+    ]
+    if len(comparisons) == 1:
+        (func, right), = comparisons
+        return lambda data: func(left(data), right(data))
+
+    def evaluate(data):
+        current = left(data)
+        for func, comparator in comparisons:
+            value = comparator(data)
+            if not func(current, value):
+                return False
+            current = value
+        return True
+    return evaluate
+
+
+def _check_operator(op, expr):
+    if type(op) not in AUTHORIZED_TYPES:
+        raise TypeError("forbidden type {} found in {}".format(op, expr))
+
+
+@lru_cache(maxsize=1024)
+def compile_condition(expr):
+    """
+    Parse an expression once and return a function evaluating it (as a
+    bool) against a data dict, `@variable` placeholders being read from the
+    data at evaluation time (None if missing).
+    Only the authorized operations are allowed (no call to functions, no
+    variable assignement...).
+    """
+    tree = ast.parse(_substitute_variables(expr).strip(), mode='eval').body
+    evaluate = _compile_node(tree, expr)
+    return lambda data: bool(evaluate(data))
+
+
+def safe_eval(expr, data=None):
     """
     Ensures an expression only defines authorized operations (no call to
     functions, no variable assignement...) and evaluates it.
     """
-    tree = ast.parse(expr, mode='eval').body
-    for node in ast.walk(tree):
-        if not type(node) in AUTHORIZED_TYPES:
-            raise TypeError("forbidden type {} found in {}".format(node, expr))
-    return bool(eval(expr))
+    return compile_condition(expr)(data or {})
 
 
 class ConditionBlock:
@@ -74,39 +223,12 @@ class ConditionBlock:
                 raise TypeError("last condition must be 'elif' or 'else',"
                                 " got '{}'".format(conditions[-1]))
         self._conditions = conditions
-
-    def _clean_condition(self, condition, data):
-        """
-        Format the condition string (as eval-compliant code).
-        nb: variable replacement should be `@variable_name` formatted.
-        """
-        # /!\ This regex forbids the use of ' and " in a string
-        # See https://regex101.com/r/hUueag/7
-        match = re.findall(
-            r' *(and|or)? *\( *(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) +([=<>!]=?|not in|in|not) +(@\S*|None|True|False|[\"\'\[][^\'\"]*[\'\"\]]|\d+) *\) *',
-            condition
-        )
-        if not match:
-            return condition
-
-        def replace(match):
-            key = match.group('var_name')
-            value = data.get(key)
-            placeholder = '{!r}' if isinstance(value, str) else '{}'
-            return placeholder.format(value)
-
-        # Reconstruct a cleaned string from the operation parts.
-        cleaned = ''
-        for operation in match:
-            # Get 'and' or 'or' operation
-            andor = operation[0]
-            # Restructure condition string, striping any trailing space
-            ops = []
-            ops.append(re.sub(r'^@(?P<var_name>\w+)$', replace, operation[1]))
-            ops.append(operation[2])
-            ops.append(re.sub(r'^@(?P<var_name>\w+)$', replace, operation[3]))
-            cleaned += '{}({})'.format(andor, ' '.join(ops))
-        return cleaned
+        # Conditions are parsed once, 'else' always validates
+        self._evaluators = [
+            compile_condition(condition['condition'])
+            if condition['type'] != 'else' else None
+            for condition in conditions
+        ]
 
     def condition_validated(self, condition, data):
         """
@@ -119,18 +241,12 @@ class ConditionBlock:
         """
         Iterate through the conditions and stop at first validated condition.
         """
-        for condition in self._conditions:
+        for condition, evaluate in zip(self._conditions, self._evaluators):
             # If type 'else', set given next tasks and leave
-            if condition['type'] == 'else':
+            if evaluate is None:
                 self.condition_validated(condition['rules'], data)
                 return
-            # Else find the condition and evaluate it
-            cleaned = self._clean_condition(condition['condition'], data)
-            log.debug('arithmetics: trying %s', cleaned)
-            if safe_eval(cleaned):
-                log.debug(
-                    'arithmetics: validated condition "%s" as "%s"',
-                    condition, cleaned
-                )
+            if evaluate(data):
+                log.debug('arithmetics: validated condition "%s"', condition)
                 self.condition_validated(condition['rules'], data)
                 return
@@ -0,0 +1,116 @@
+import logging
+from bisect import bisect_right
+from enum import Enum
+
+
+log = logging.getLogger(__name__)
+
+
+class LookupMode(Enum):
+
+    """
+    How a value is matched against the entries of a lookup table:
+        - exact: equal to an entry (as strings)
+        - icase: equal to an entry, case insensitive
+        - prefix: starts with an entry, the longest one wins
+        - range: numeric entries are lower bounds, the greatest one lower
+          or equal to the value wins
+    """
+
+    EXACT = 'exact'
+    ICASE = 'icase'
+    PREFIX = 'prefix'
+    RANGE = 'range'
+
+
+class LookupTable:
+
+    """
+    Read-only index of the (value, replace) pairs of a lookup table, built
+    once and shared by all the rules using it.
+    Exact and prefix matching use a hash index (prefixes are tried from the
+    longest entry length down), ranges use sorted arrays of bounds.
+    When several entries have the same value, the last one wins.
+    """
+
+    __slots__ = ('mode', 'icase', '_index', '_lengths', '_bounds', '_replaces')
+
+    MISSING = object()
+
+    def __init__(self, pairs, mode=LookupMode.EXACT, icase=False):
+        mode = LookupMode(mode)
+        if mode is LookupMode.ICASE:
+            mode, icase = LookupMode.EXACT, True
+        self.mode = mode
+        self.icase = icase and mode is not LookupMode.RANGE
+        self._index = None
+        self._lengths = ()
+        self._bounds = self._replaces = ()
+
+        if mode is LookupMode.RANGE:
+            self._index_ranges(pairs)
+            return
+
+        if self.icase:
+            self._index = {
+                str(value).lower(): replace for value, replace in pairs
+            }
+        else:
+            self._index = {str(value): replace for value, replace in pairs}
+        if mode is LookupMode.PREFIX:
+            self._lengths = sorted(
+                {len(value) for value in self._index}, reverse=True
+            )
+
+    @classmethod
+    def from_rows(cls, rows, mode=LookupMode.EXACT, icase=False):
+        """
+        Index the rows of a stored lookup table: [{"value", "replace"}, ...]
+        """
+        return cls(
+            ((row['value'], row['replace']) for row in rows), mode, icase
+        )
+
+    def _index_ranges(self, pairs):
+        bounds = {}
+        for value, replace in pairs:
+            try:
+                bounds[float(value)] = replace
+            except (TypeError, ValueError):
+                log.warning("Lookup: ignoring non-numeric range '%s'", value)
+        self._bounds = sorted(bounds)
+        self._replaces = [bounds[bound] for bound in self._bounds]
+
+    def __len__(self):
+        if self._index is not None:
+            return len(self._index)
+        return len(self._bounds)
+
+    def get(self, value, default=None):
+        """
+        Return the replacement of `value`, or `default` if nothing matches.
+        """
+        if self.mode is LookupMode.RANGE:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                return default
+            position = bisect_right(self._bounds, value)
+            if position == 0:
+                return default
+            return self._replaces[position - 1]
+
+        value = str(value)
+        if self.icase:
+            value = value.lower()
+        if self.mode is LookupMode.EXACT:
+            return self._index.get(value, default)
+
+        index = self._index
+        size = len(value)
+        for length in self._lengths:
+            if length <= size:
+                replace = index.get(value[:length], self.MISSING)
+                if replace is not self.MISSING:
+                    return replace
+        return default
@@ -1,5 +1,5 @@
 from functools import singledispatch
-from datetime import datetime, timedelta
+from datetime import datetime
 
 
 @singledispatch
@@ -16,3 +16,70 @@ def _serialize_datetime(dt):
     Datetime serializer.
     """
     return dt.isoformat()
+
+
+BSON_SCALARS = frozenset((str, int, float, bool, type(None), datetime))
+BSON_MAX_DEPTH = 100
+BSON_MIN_INT, BSON_MAX_INT = -2 ** 63, 2 ** 63 - 1
+TRUNCATED = '... (truncated)'
+
+
+def bson_safe(obj, max_size=None):
+    """
+    Return a copy of `obj` that can be stored in Mongo, in a single
+    iterative pass:
+        - dicts, lists and tuples are copied (tuples become lists)
+        - keys are converted into strings
+        - strings longer than `max_size` characters are truncated
+        - integers out of the int64 range are converted into strings
+        - any other object is replaced by an 'Internal server data' string
+    """
+    scalars = BSON_SCALARS
+    root = [None]
+    # Stack of (container, key, value, depth), the value is yet to be set.
+    stack = [(root, 0, obj, 0)]
+    pop = stack.pop
+    push = stack.append
+
+    while stack:
+        parent, key, value, depth = pop()
+
+        if isinstance(value, dict):
+            is_dict = True
+            new = {}
+            items = value.items()
+        elif isinstance(value, (list, tuple)):
+            is_dict = False
+            new = [None] * len(value)
+            items = enumerate(value)
+        else:
+            # Unknown object (or scalar root object)
+            if type(value) not in scalars:
+                value = 'Internal server data: {}'.format(type(value))
+            parent[key] = value
+            continue
+
+        if depth >= BSON_MAX_DEPTH:
+            parent[key] = 'Internal server data: max depth reached'
+            continue
+
+        parent[key] = new
+        depth += 1
+        for child_key, child in items:
+            if is_dict and type(child_key) is not str:
+                child_key = str(child_key)
+            ctype = type(child)
+            if ctype is str:
+                if max_size is not None and len(child) > max_size:
+                    child = child[:max_size] + TRUNCATED
+            elif ctype is int:
+                if not BSON_MIN_INT <= child <= BSON_MAX_INT:
+                    child = str(child)
+            elif ctype not in scalars:
+                # Containers and unknown objects are handled once popped,
+                # the key is set now to keep the dict ordering.
+                push((new, child_key, child, depth))
+                child = None
+            new[child_key] = child
+
+    return root[0]
@@ -1,69 +1,141 @@
 import logging
 import operator
 import re
+import sre_parse
+import sre_constants
 from copy import deepcopy
+from enum import Enum
+from functools import wraps
+from itertools import repeat
+from collections.abc import MutableMapping
 
 from .evaluate import ConditionBlock
+from .lookup import LookupMode, LookupTable
 
 
 log = logging.getLogger(__name__)
 
 
-class TraceableDict(dict):
+class DiffMode(Enum):
 
     """
-    Python dict-based class that tracks any changes.
+    Level of detail of the diff returned by `Converter.apply()`:
+        - full: every change, with the old and new values
+        - summary: the action and key of every change, without values
+        - none: only the errors, rules are applied without any tracking
+    """
+
+    FULL = 'full'
+    SUMMARY = 'summary'
+    NONE = 'none'
+
+
+class TraceableDict(MutableMapping):
+
+    """
+    Dict wrapper that writes through to the wrapped dict and tracks any
+    changes. Only the values of the touched keys are copied (into the
+    changes), and the original ones are kept to `rollback()` on error.
     Format:
         {"action": "add", "key": <key>, "value": <new-value>},
         {"action": "remove", "key": <key>, "value": <old-value>},
         {"action": "update", "key": <key>, "old_value": <old-value>,
                                            "new_value": <new-value>},
+    Values are not recorded if `values` is False.
     """
 
-    def __init__(self, dict2):
-        super().__init__(deepcopy(dict2))
+    _MISSING = object()
+
+    def __init__(self, data, values=True):
+        self._data = data
+        self._values = values
         self._changes = []
+        # Original value of each touched key
+        self._journal = {}
+        # Original key order, saved before adding or removing any key
+        self._keys = None
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<TraceableDict {!r}>'.format(self._data)
+
+    def _touch(self, key, exists):
+        if key not in self._journal:
+            self._journal[key] = self._data[key] if exists else self._MISSING
+        if not exists and self._keys is None:
+            self._keys = list(self._data)
 
     def __setitem__(self, key, value):
-        if key not in self:
+        if key not in self._data:
+            self._touch(key, False)
+            if self._values is False:
+                self._changes.append({'action': 'add', 'key': key})
+            else:
+                self._changes.append({
+                    'action': 'add',
+                    'key': key,
+                    'value': deepcopy(value)
+                })
+        else:
+            self._touch(key, True)
+            if self._data[key] != value:
+                if self._values is False:
+                    self._changes.append({'action': 'update', 'key': key})
+                else:
+                    self._changes.append({
+                        'action': 'update',
+                        'key': key,
+                        'old_value': deepcopy(self._data[key]),
+                        'new_value': deepcopy(value)
+                    })
+        self._data[key] = value
+
+    def __delitem__(self, key):
+        value = self._data[key]
+        self._touch(key, True)
+        if self._keys is None:
+            self._keys = list(self._data)
+        if self._values is False:
+            self._changes.append({'action': 'remove', 'key': key})
+        else:
             self._changes.append({
-                'action': 'add',
+                'action': 'remove',
                 'key': key,
                 'value': deepcopy(value)
             })
-        elif self[key] != value:
-            self._changes.append({
-                'action': 'update',
-                'key': key,
-                'old_value': deepcopy(self[key]),
-                'new_value': deepcopy(value)
-            })
-        super().__setitem__(key, value)
+        del self._data[key]
 
-    def __delitem__(self, key):
-        self._changes.append({
-            'action': 'remove',
-            'key': key,
-            'value': deepcopy(self[key])
-        })
-        super().__delitem__(key)
-
-    def update(self, dict2=None, **kwargs):
-        for key in dict2:
-            if key not in self:
-                self._changes.append({
-                    'action': 'add',
-                    'key': key,
-                    'value': deepcopy(dict2[key])
-                })
-            elif self[key] != dict2[key]:
-                self._changes.append({
-                    'action': 'update',
-                    'key': key,
-                    'old_value': deepcopy(self[key]),
-                    'new_value': deepcopy(dict2[key])
-                })
-        super().update(dict2, **kwargs)
+    def rollback(self):
+        """
+        Restore the wrapped dict as it was before any change.
+        """
+        data = self._data
+        if self._keys is None:
+            # Only updates, the key order did not change
+            for key, value in self._journal.items():
+                data[key] = value
+        else:
+            values = {key: data[key] for key in self._keys if key in data}
+            values.update({
+                key: value
+                for key, value in self._journal.items()
+                if value is not self._MISSING
+            })
+            data.clear()
+            data.update((key, values[key]) for key in self._keys)
+        self._journal = {}
+        self._keys = None
 
     @property
     def changes(self):
@@ -126,33 +198,106 @@ class Converter(object):
             rules.append(rule_cls(**params))
         return cls(rules=rules)
 
-    def apply(self, data):
+    def apply(self, data, diff=DiffMode.FULL):
+        """
+        Apply the rules on `data` (in-place) and return a diff detailed
+        according to the `DiffMode` `diff`. With `DiffMode.NONE`, only the
+        rules in error are listed.
+        """
+        mode = DiffMode(diff)
         diff = {'rules': []}
         for rule in self.rules:
-            rule_diff = rule.apply(data)
+            rule_diff = rule.apply(data, mode)
+            if rule_diff is None:
+                continue
             diff['rules'].append(rule_diff)
-            if rule_diff is not None and 'error' in rule_diff:
+            if 'error' in rule_diff:
                 diff['error'] = True
         return diff
 
+    def apply_many(self, records, diff=DiffMode.SUMMARY, aggregate=None):
+        """
+        Apply the rules on each dict of `records` (in-place) and return a
+        diff aggregated per rule (nested rules of condition blocks count for
+        their block):
+        {
+            "records": <count>,
+            "skipped": <count of non-dict records>,
+            "rules": [
+                {"type": <name>, "add": <n>, "update": <n>, "remove": <n>,
+                 "errors": <n>},
+            ],
+            "error": true
+        }
+        With `DiffMode.NONE`, only the errors are counted. A previous
+        `aggregate` can be given to add up the diffs of several batches.
+        """
+        mode = DiffMode.NONE if DiffMode(diff) is DiffMode.NONE \
+            else DiffMode.SUMMARY
+        if aggregate is None:
+            aggregate = {'records': 0, 'skipped': 0, 'rules': [
+                {
+                    'type': rule.TYPENAME,
+                    'add': 0, 'update': 0, 'remove': 0, 'errors': 0,
+                }
+                for rule in self.rules
+            ]}
+        rules = list(zip(self.rules, aggregate['rules']))
+        for data in records:
+            if not isinstance(data, dict):
+                aggregate['skipped'] += 1
+                continue
+            aggregate['records'] += 1
+            for rule, counts in rules:
+                rule_diff = rule.apply(data, mode)
+                if rule_diff is not None:
+                    self._count(rule_diff, counts)
+        if any(counts['errors'] for counts in aggregate['rules']):
+            aggregate['error'] = True
+        return aggregate
+
+    @classmethod
+    def _count(cls, rule_diff, counts):
+        if 'error' in rule_diff:
+            counts['errors'] += 1
+        for change in rule_diff.get('changes', ()):
+            counts[change['action']] += 1
+        for nested in rule_diff.get('conditions', ()):
+            cls._count(nested, counts)
+
 
 class FactoryConditionBlock(ConditionBlock, metaclass=_RegisteredRule):
 
     TYPENAME = 'condition-block'
 
     def __init__(self, conditions):
-        super().__init__(conditions)
+        # The rules of each condition are compiled along with the block
+        super().__init__([
+            {
+                **condition,
+                'rules': Converter.from_dict({
+                    'rules': condition.get('rules', [])
+                }),
+            }
+            for condition in conditions
+        ])
         self._changes = {'type': self.TYPENAME, 'conditions': []}
+        self._mode = DiffMode.FULL
 
-    def condition_validated(self, rules, data):
+    def condition_validated(self, converter, data):
         """
         Apply rules on data upon validating a condition.
         """
-        diff = Converter.from_dict({'rules': rules}).apply(data)
+        diff = converter.apply(data, self._mode)
         self._changes['conditions'] = diff['rules']
 
-    def apply(self, data):
+    def apply(self, data, diff=DiffMode.FULL):
+        # A compiled block is applied many times, each diff is a new dict
+        self._changes = {'type': self.TYPENAME, 'conditions': []}
+        self._mode = DiffMode(diff)
         super().apply(data)
+        if self._mode is DiffMode.NONE and not self._changes['conditions']:
+            return
         return self._changes
 
 
@@ -185,34 +330,46 @@ class _Rule(metaclass=_RegisteredRule):
         Decorator for `Rule.apply(<data>)` methods that return a JSON-formatted
         diff of the changes made by the method itself.
         """
-        def wrapper(self, data):
-            # Handle data through a traceable dict
-            tracker = TraceableDict(data)
+        @wraps(func)
+        def wrapper(self, data, diff=DiffMode.FULL):
+            diff = DiffMode(diff)
+            if diff is DiffMode.NONE:
+                # Errors are raised before any change, no need to track them
+                tracker = data
+            else:
+                # Handle data through a traceable dict, changes are applied in
+                # place and rolled back on error
+                tracker = TraceableDict(data, values=diff is DiffMode.FULL)
             try:
                 func(self, tracker)
             except RegexpRuleError as exc:
-                return {
-                    'type': self.TYPENAME, 'changes': tracker.changes,
-                    'error': 'regexp_rule_error', 'error_details': str(exc)
-                }
+                error, details = 'regexp_rule_error', str(exc)
             except ArithmeticRuleError as exc:
-                return {
-                    'type': self.TYPENAME, 'changes': tracker.changes,
-                    'error': 'arithmetic_rule_error', 'error_details': str(exc)
-                }
+                error, details = 'arithmetic_rule_error', str(exc)
             except UnionRuleError as exc:
+                error, details = 'union_rule_error', str(exc)
+            except Exception:
+                if diff is not DiffMode.NONE:
+                    tracker.rollback()
+                raise
+            else:
+                if diff is DiffMode.NONE:
+                    return
+                return {'type': self.TYPENAME, 'changes': tracker.changes}
+            if diff is DiffMode.NONE:
                 return {
-                    'type': self.TYPENAME, 'changes': tracker.changes,
-                    'error': 'union_rule_error', 'error_details': str(exc)
+                    'type': self.TYPENAME,
+                    'error': error, 'error_details': details
                 }
-            # We want to keep the object reference
-            data.clear()
-            data.update(tracker)
-            return {'type': self.TYPENAME, 'changes': tracker.changes}
+            tracker.rollback()
+            return {
+                'type': self.TYPENAME, 'changes': tracker.changes,
+                'error': error, 'error_details': details
+            }
 
         return wrapper
 
-    def apply(self, data):
+    def apply(self, data, diff=DiffMode.FULL):
         """
         Execute an operation on one field of the dict `data` and returns an
         diff.
@@ -220,6 +377,35 @@ class _Rule(metaclass=_RegisteredRule):
         raise NotImplementedError
 
 
+def required_literal(regexp):
+    """
+    Return the longest literal substring any match of a compiled regexp must
+    contain, or None. A string without it cannot match.
+    """
+    if not isinstance(regexp.pattern, str) or regexp.flags & re.IGNORECASE:
+        return
+    try:
+        parsed = sre_parse.parse(regexp.pattern, regexp.flags)
+    except Exception:
+        return
+
+    runs = ['']
+
+    def walk(items):
+        for opcode, value in items:
+            if opcode is sre_constants.LITERAL:
+                runs[-1] += chr(value)
+            elif opcode is sre_constants.SUBPATTERN \
+                    and not (len(value) == 4 and value[1] & re.IGNORECASE):
+                # Groups are matched in sequence, as if inlined
+                walk(value[-1])
+            else:
+                runs.append('')
+
+    walk(parsed)
+    return max(runs, key=len) or None
+
+
 class _RegexpRule(_Rule):
 
     """
@@ -233,6 +419,14 @@ class _RegexpRule(_Rule):
 
     def _configure(self, pattern, flags=0):
         self.regexp = re.compile(pattern, flags=flags)
+        # Strings without this literal are not searched at all
+        self._literal = required_literal(self.regexp)
+
+    def _impossible(self, string):
+        return (
+            self._literal is not None and isinstance(string, str)
+            and self._literal not in string
+        )
 
     def _run_regexp(self, string):
         raise NotImplementedError
@@ -269,6 +463,8 @@ class Extract(_RegexpRule):
     def _run_regexp(self, string):
         if not self.regexp.groupindex:
             raise RegexpRuleError("regex is invalid, ensure a group is captured")
+        if self._impossible(string):
+            return {}
         args = (string,) + self._pos_args
         match = self.regexp.search(*args)
         if match is not None:
@@ -288,8 +484,15 @@ class Sub(_RegexpRule):
     def _configure(self, pattern, repl, flags=0, count=0):
         super()._configure(pattern, flags=flags)
         self.repl, self.count = repl, count
+        try:
+            self.regexp.sub(repl, '')
+        except Exception:
+            # Let the replacement error be raised at runtime
+            self._literal = None
 
     def _run_regexp(self, string):
+        if self._impossible(string):
+            return {self.fieldname: string}
         res = self.regexp.sub(self.repl, string, count=self.count)
         return {self.fieldname: res}
 
@@ -345,31 +548,35 @@ class Unset(_Rule):
 class Lookup(_Rule):
 
     """
-    Implements a dead-simple lookup table which perform case sensitive
-    (default) or insensitive (icase=True) lookups.
+    Implements a lookup table which performs exact case sensitive (default)
+    or insensitive (icase=True) lookups, longest-prefix or numeric range
+    lookups (see `LookupMode`).
+    The table is either a dict or a shared, prebuilt `LookupTable`.
     """
 
-    def _configure(self, table=None, icase=False):
-        self.table = table or dict()
-        self.icase = icase
-        if icase:
-            self.table = {k.lower(): v for k, v in table.items()}
+    def _configure(self, table=None, icase=False, mode=LookupMode.EXACT):
+        if isinstance(table, LookupTable):
+            self.table = table
+        else:
+            self.table = LookupTable((table or {}).items(), mode, icase)
+        self.icase = self.table.icase
 
     @_Rule.track_changes
     def apply(self, data):
         """
-        The 1st entry in the lookup table that matches the string from `data`
-        replaces it. Note that entries in the lookup table are evaluated in an
-        unpredictable order.
+        The entry in the lookup table that matches the value from `data`
+        replaces it.
         """
         try:
-            fieldval = str(data[self.fieldname])
-            if self.icase:
-                fieldval = fieldval.lower()
-            data[self.fieldname] = self.table[fieldval]
+            fieldval = data[self.fieldname]
         except KeyError as err:
             log.debug("Lookup: fieldname '%s' not in data, ignoring", err)
             return
+        replace = self.table.get(fieldval, LookupTable.MISSING)
+        if replace is LookupTable.MISSING:
+            log.debug("Lookup: no entry for '%s', ignoring", fieldval)
+            return
+        data[self.fieldname] = replace
 
 
 class Lower(_Rule):
@@ -412,6 +619,19 @@ class Upper(_Rule):
             log.debug("Upper: fieldname '%s' invalid, ignoring", err)
 
 
+FIELD_OPERAND = re.compile(r'^@[\w-]+$')
+
+
+def operand_getter(operand):
+    """
+    Return a function reading an operand of a rule from the data: the field
+    value for a '@fieldname' placeholder, else the operand itself.
+    """
+    if isinstance(operand, str) and FIELD_OPERAND.match(operand):
+        return operator.itemgetter(operand[1:])
+    return lambda data: operand
+
+
 class ArithmeticRuleError(Exception):
     pass
 
@@ -420,6 +640,8 @@ class Arithmetic(_Rule):
 
     """
     Arithmetic rule to add, substrack, multiply and divide fields.
+    Operands can be lists, the operation is then made item by item (against
+    the other operand, or the items of the other list).
     """
 
     # List available operators and their associated types.
@@ -450,15 +672,39 @@ class Arithmetic(_Rule):
     def _configure(self, operator, operand1, operand2):
         self.op, self.types = self.OPS[operator]
         self.operands = (operand1, operand2)
+        self._operand1 = operand_getter(operand1)
+        self._operand2 = operand_getter(operand2)
 
     def _compute_operands(self, data):
-        operands = tuple()
         # We replace placeholders with the actual data
-        for op in self.operands:
-            if isinstance(op, str) and re.match(r'^@[\w-]+$', op):
-                op = data[op.split('@')[1]]
-            operands += (op,)
-        return operands
+        return self._operand1(data), self._operand2(data)
+
+    def _compute(self, operand1, operand2):
+        type1 = type(operand1)
+        type2 = type(operand2)
+        if type1 not in self.types or type2 not in self.types[type1]:
+            raise ArithmeticRuleError(
+                'Bad operand types ({} against {})'.format(type1, type2)
+            )
+
+        result = self.op(operand1, operand2)
+        if isinstance(result, float):
+            # Arbitrary 3-round value
+            result = round(result, 3)
+        return result
+
+    def _compute_list(self, operand1, operand2):
+        if isinstance(operand1, list) and isinstance(operand2, list):
+            if len(operand1) != len(operand2):
+                raise ArithmeticRuleError(
+                    'Operand lists of different lengths ({} against {})'
+                    .format(len(operand1), len(operand2))
+                )
+        elif isinstance(operand1, list):
+            operand2 = repeat(operand2, len(operand1))
+        else:
+            operand1 = repeat(operand1, len(operand2))
+        return list(map(self._compute, operand1, operand2))
 
     @_Rule.track_changes
     def apply(self, data):
@@ -471,23 +717,15 @@ class Arithmetic(_Rule):
             log.debug('Unusable operands: %s (%s)', exc, exc.__class__)
             raise ArithmeticRuleError(exc)
 
-        type1 = type(operand1)
-        type2 = type(operand2)
-        if type1 not in self.types or type2 not in self.types[type1]:
-            raise ArithmeticRuleError(
-                'Bad operand types ({} against {})'.format(type1, type2)
-            )
-
         try:
-            result = self.op(operand1, operand2)
+            if isinstance(operand1, list) or isinstance(operand2, list):
+                result = self._compute_list(operand1, operand2)
+            else:
+                result = self._compute(operand1, operand2)
         except TypeError as exc:
             log.debug(exc)
             return
 
-        if isinstance(result, float):
-            # Arbitrary 3-round value
-            result = round(result, 3)
-
         data[self.fieldname] = result
 
 
@@ -503,21 +741,44 @@ class Union(_Rule):
 
     def _configure(self, operand1, operand2):
         self.operands = (operand1, operand2)
+        self._operand1 = operand_getter(operand1)
+        self._operand2 = operand_getter(operand2)
 
     def _compute_operands(self, data):
-        computed = tuple()
-        for op in self.operands:
-            if isinstance(op, str) and re.match(r'^@[\w-]+$', op):
-                computed += (data[op.split('@')[1]],)
+        return self._operand1(data), self._operand2(data)
+
+    @staticmethod
+    def _list_union(a, b):
+        """
+        Append the items of `b` not in `a` to `a`, in order.
+        Hashable items are looked up in a set, unhashable ones in the list.
+        """
+        hashable = set()
+        unhashable = []
+        for item in a:
+            try:
+                hashable.add(item)
+            except TypeError:
+                unhashable.append(item)
+
+        union = list(a)
+        for item in b:
+            try:
+                found = item in hashable
+            except TypeError:
+                found = item in a
             else:
-                computed += (op,)
-        return computed
+                if not found and unhashable:
+                    found = item in unhashable
+            if not found:
+                union.append(item)
+        return union
 
     def _union(self, a, b):
         if isinstance(a, dict) and isinstance(b, dict):
             return {**a, **b}
         elif isinstance(a, list) and isinstance(b, list):
-            return a + [item for item in b if item not in a]
+            return self._list_union(a, b)
         raise UnionRuleError('union available for two dicts or lists')
 
     @_Rule.track_changes
@@ -0,0 +1,244 @@
+import heapq
+import asyncio
+import logging
+from enum import Enum
+from itertools import count
+from collections import Counter
+
+
+log = logging.getLogger(__name__)
+
+
+class OverflowPolicy(Enum):
+
+    """
+    What to do with a new trigger when the admission queue is full:
+        - reject: refuse the new trigger (HTTP 429 on instance requests)
+        - drop: discard the lowest priority, most recent queued trigger
+        - spill: store the new trigger in the storage until there is room
+    """
+
+    REJECT = 'reject'
+    DROP = 'drop'
+    SPILL = 'spill'
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class QueuedTrigger:
+
+    """
+    A workflow trigger waiting for a free slot.
+    `waited` is True when the caller itself awaits `future` to get the
+    workflow instance (e.g. an HTTP request).
+    """
+
+    __slots__ = ('template', 'event', 'raw', 'priority', 'future', 'waited')
+
+    def __init__(self, template, event, raw=None, priority=0, waited=False,
+                 loop=None):
+        self.template = template
+        self.event = event
+        self.raw = raw
+        self.priority = priority
+        self.waited = waited
+        self.future = asyncio.Future(loop=loop)
+
+    @property
+    def uid(self):
+        return self.template.uid
+
+
+class AdmissionQueue:
+
+    """
+    Bound the number of running workflow instances, globally (`limit`) and per
+    template (`templates` from the configuration, or the template's own
+    'concurrency' value). Triggers over the limits wait in a bounded priority
+    queue (FIFO within the same priority) of `queue_size` entries.
+    """
+
+    def __init__(self, limit=None, templates=None, queue_size=1000,
+                 overflow=OverflowPolicy.REJECT.value, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.limit = limit
+        self.queue_size = queue_size
+        self.overflow = OverflowPolicy(overflow)
+        # Limits from the configuration override the templates' ones
+        self._config_limits = dict(templates or {})
+        self._template_limits = {}
+        self._running = Counter()
+        self._queued = Counter()
+        self._queue = []
+        self._seq = count()
+        # Callbacks set by the engine/nyuki
+        self.start = None
+        self.spill = None
+        self.refill = None
+        self.spilled = 0
+        self._refilling = False
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def running(self):
+        return sum(self._running.values())
+
+    def set_template_limit(self, tid, limit=None):
+        if limit is None:
+            self._template_limits.pop(tid, None)
+        else:
+            self._template_limits[tid] = limit
+
+    def limit_for(self, tid):
+        return self._config_limits.get(tid, self._template_limits.get(tid))
+
+    def _has_slot(self, tid):
+        if self.limit is not None and self.running >= self.limit:
+            return False
+        limit = self.limit_for(tid)
+        return limit is None or self._running[tid] < limit
+
+    def acquire(self, tid):
+        """
+        Take a slot for a new instance of template `tid` if one is available
+        and no trigger of the same template is already waiting.
+        """
+        if self._queued[tid] > 0 or not self._has_slot(tid):
+            return False
+        self._running[tid] += 1
+        self.stats['admitted'] += 1
+        return True
+
+    def release(self, tid):
+        """
+        Free a slot and start the queued triggers that can now run.
+        """
+        self._running[tid] -= 1
+        if self._running[tid] <= 0:
+            del self._running[tid]
+        self._drain()
+        # Reload spilled triggers once there is room in the queue
+        room = self.queue_size - len(self._queue)
+        if self.spilled > 0 and room > 0 and self.refill is not None \
+                and not self._refilling:
+            self._refilling = True
+            future = asyncio.ensure_future(self.refill(room), loop=self._loop)
+            future.add_done_callback(self._refilled)
+
+    def _refilled(self, future):
+        self._refilling = False
+        try:
+            count = future.result()
+        except Exception as exc:
+            log.error('Could not reload spilled workflow triggers: %s', exc)
+        else:
+            self.spilled = max(self.spilled - count, 0)
+
+    def put(self, entry):
+        """
+        Queue a trigger, applying the overflow policy if the queue is full.
+        """
+        if len(self._queue) >= self.queue_size:
+            if self.overflow is OverflowPolicy.DROP:
+                # The queued entry with the lowest priority (newest first)
+                # is discarded, possibly the new one.
+                last = max(self._queue)
+                if (-entry.priority, next(self._seq)) > last[:2]:
+                    return self._discard(entry, 'dropped')
+                self._queue.remove(last)
+                heapq.heapify(self._queue)
+                self._queued[last[2].uid] -= 1
+                self._discard(last[2], 'dropped')
+            elif self.overflow is OverflowPolicy.SPILL \
+                    and self.spill is not None and not entry.waited:
+                self.spilled += 1
+                self.stats['spilled'] += 1
+                asyncio.ensure_future(self.spill(entry), loop=self._loop)
+                return entry
+            else:
+                self.stats['rejected'] += 1
+                raise AdmissionRejected(
+                    'admission queue is full ({} triggers)'.format(
+                        self.queue_size
+                    )
+                )
+
+        heapq.heappush(self._queue, (-entry.priority, next(self._seq), entry))
+        self._queued[entry.uid] += 1
+        self.stats['queued'] += 1
+        log.debug(
+            'Workflow trigger for template %s queued (%d waiting)',
+            entry.uid[:8], len(self._queue),
+        )
+        return entry
+
+    def _discard(self, entry, reason):
+        log.warning(
+            'Workflow trigger for template %s %s', entry.uid[:8], reason
+        )
+        self.stats[reason] += 1
+        if not entry.future.done():
+            entry.future.set_exception(AdmissionRejected(reason))
+            # Avoid 'exception never retrieved' for non-awaited triggers
+            if not entry.waited:
+                entry.future.exception()
+        return entry
+
+    def _drain(self):
+        """
+        Start queued triggers by priority, skipping the ones whose template
+        is still at its limit.
+        """
+        skipped = []
+        while self._queue:
+            if self.limit is not None and self.running >= self.limit:
+                break
+            item = heapq.heappop(self._queue)
+            entry = item[2]
+            if not self._has_slot(entry.uid):
+                skipped.append(item)
+                continue
+            self._queued[entry.uid] -= 1
+            if self._queued[entry.uid] <= 0:
+                del self._queued[entry.uid]
+            self._running[entry.uid] += 1
+            self.stats['admitted'] += 1
+            self.start(entry)
+        for item in skipped:
+            heapq.heappush(self._queue, item)
+
+    def clear(self):
+        """
+        Reject all the queued triggers.
+        """
+        while self._queue:
+            _, _, entry = heapq.heappop(self._queue)
+            self._discard(entry, 'cancelled')
+        self._queued.clear()
+
+    def report(self):
+        """
+        Return the admission metrics.
+        """
+        return {
+            'limit': self.limit,
+            'running': self.running,
+            'queued': len(self._queue),
+            'queue_size': self.queue_size,
+            'overflow': self.overflow.value,
+            'spilled': self.spilled,
+            'stats': dict(self.stats),
+            'templates': {
+                tid: {
+                    'limit': self.limit_for(tid),
+                    'running': self._running[tid],
+                    'queued': self._queued[tid],
+                }
+                for tid in set(self._running) | set(self._queued)
+            },
+        }
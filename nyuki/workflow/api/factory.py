@@ -1,14 +1,15 @@
 import csv
 import re
+import codecs
 import logging
 from uuid import uuid4
 from io import StringIO
 from re import error as re_error
-from aiohttp.web import FileField
+from aiohttp.web import StreamResponse
 from pymongo.errors import AutoReconnect
 
 from nyuki.workflow.tasks import FACTORY_SCHEMAS
-from nyuki.api import Response, resource, content_type
+from nyuki.api import Response, resource, content_type, streamed
 
 
 log = logging.getLogger(__name__)
@@ -76,6 +77,7 @@ class ApiFactoryRegexes:
         except AutoReconnect:
             return Response(status=503)
         await self.nyuki.storage.regexes.delete()
+        await self.nyuki.invalidate_rules('regexes')
         return Response(rules)
 
 
@@ -118,6 +120,7 @@ class ApiFactoryRegex:
                 'error_code': 'invalid_regex'
             })
         await self.nyuki.storage.regexes.insert(regex)
+        await self.nyuki.invalidate_rules('regexes', regex_id)
         return Response(regex)
 
     async def delete(self, request, regex_id):
@@ -132,6 +135,7 @@ class ApiFactoryRegex:
             return Response(status=404)
 
         await self.nyuki.storage.regexes.delete(regex_id)
+        await self.nyuki.invalidate_rules('regexes', regex_id)
         return Response(regex)
 
 
@@ -163,9 +167,128 @@ def new_lookup(title, table, lookup_id=None):
 CSV_FIELDNAMES = ['value', 'replace']
 
 
+class CSVStream:
+
+    """
+    Incremental parser of an uploaded CSV file, fed by chunks of bytes and
+    returning the [value, replace] rows completed by each chunk.
+    The file is decoded as utf-8, or latin-1 if it is not utf-8 (as long as
+    only ascii characters have been decoded yet), and its dialect and header
+    are sniffed from its first `SAMPLE_SIZE` characters.
+    """
+
+    SAMPLE_SIZE = 1024
+
+    def __init__(self):
+        self.encoding = 'utf-8'
+        self.dialect = None
+        self.header = None
+        self.rows = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._ascii = True
+        self._sample = ''
+        self._skip_header = False
+        # Lines of a record with a quoted field not closed yet
+        self._record = []
+        self._quotes = 0
+        self._line = ''
+
+    def _decode(self, data, final):
+        try:
+            text = self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            if not self._ascii:
+                raise
+            log.info('CSV file is not utf-8, decoding it as latin-1')
+            pending = self._decoder.getstate()[0]
+            self.encoding = 'latin-1'
+            self._decoder = codecs.getincrementaldecoder('latin-1')()
+            return self._decoder.decode(pending + data, final)
+        # Any non-ascii character is encoded in several utf-8 bytes
+        if len(text) != len(data):
+            self._ascii = False
+        return text
+
+    def _sniff(self, sample):
+        sniffer = csv.Sniffer()
+        self.dialect = sniffer.sniff(sample)
+        self._skip_header = sniffer.has_header(sample)
+        log.info(
+            "CSV file validated with delimiter: '%s'", self.dialect.delimiter
+        )
+
+    def _records(self, text):
+        """
+        Split a text into complete CSV records (a quoted field can contain
+        line breaks), keeping the incomplete ones for the next chunk.
+        """
+        lines = (self._line + text).split('\n')
+        self._line = lines.pop()
+        quotechar = self.dialect.quotechar
+        if self.dialect.quoting == csv.QUOTE_NONE:
+            quotechar = None
+
+        records = []
+        for line in lines:
+            self._record.append(line + '\n')
+            if quotechar:
+                self._quotes += line.count(quotechar)
+            if self._quotes % 2 == 0:
+                records.append(''.join(self._record))
+                self._record = []
+                self._quotes = 0
+        return records
+
+    def _parse(self, records):
+        rows = []
+        for row in csv.reader(records, self.dialect):
+            # Ignore blank lines
+            if not row:
+                continue
+            # Ignore header if there is one
+            if self._skip_header:
+                self._skip_header = False
+                self.header = row
+                log.info('CSV header found: %s', row)
+                continue
+            rows.append([row[0], row[1] if len(row) > 1 else None])
+        self.rows += len(rows)
+        return rows
+
+    def feed(self, data, final=False):
+        """
+        Parse a chunk of the file, return the new rows.
+        Raise `csv.Error` if the CSV dialect can't be determined.
+        """
+        text = self._decode(data, final)
+        if self.dialect is None:
+            self._sample += text
+            if len(self._sample) < self.SAMPLE_SIZE and not final:
+                return []
+            text, self._sample = self._sample, None
+            self._sniff(text[:self.SAMPLE_SIZE])
+
+        records = self._records(text)
+        if final:
+            tail = ''.join(self._record) + self._line
+            if tail:
+                records.append(tail)
+            self._record, self._line = [], ''
+        return self._parse(records)
+
+    def close(self):
+        """
+        Parse the end of the file, return the last rows.
+        """
+        return self.feed(b'', final=True)
+
+
 @resource('/workflow/lookups', versions=['v1'])
 class ApiFactoryLookups:
 
+    # Size of the uploaded CSV chunks read at once
+    READ_SIZE = 2 ** 16
+
     async def get(self, request):
         """
         Return the list of all lookups
@@ -176,56 +299,124 @@ class ApiFactoryLookups:
             return Response(status=503)
         return Response(lookups)
 
+    async def _import(self, part, lookup_id, title):
+        """
+        Stream a CSV file part into a lookup table.
+        Small tables are stored in their lookup document, larger ones are
+        stored chunk by chunk while the file is read.
+        """
+        storage = self.nyuki.storage.lookups
+        chunk_size = storage.CHUNK_SIZE
+        stream = CSVStream()
+        pending = []
+        index = 0
+        generation = None
+
+        while True:
+            data = await part.read_chunk(self.READ_SIZE)
+            if not data:
+                pending.extend(stream.close())
+                break
+            pending.extend(stream.feed(data))
+            if len(pending) <= chunk_size:
+                continue
+
+            if index == 0:
+                generation = await storage.start_import(lookup_id, title)
+            while len(pending) >= chunk_size:
+                await storage.insert_rows(
+                    lookup_id, generation, index, pending[:chunk_size]
+                )
+                del pending[:chunk_size]
+                index += 1
+            log.info(
+                "Lookup '%s': %d rows imported",
+                lookup_id, stream.rows - len(pending)
+            )
+
+        if index == 0:
+            return new_lookup(title, [
+                {'value': value, 'replace': replace}
+                for value, replace in pending
+            ], lookup_id=lookup_id)
+        if pending:
+            await storage.insert_rows(lookup_id, generation, index, pending)
+        return {
+            'id': lookup_id,
+            'title': title,
+            'rows': stream.rows,
+            'chunked': True,
+            'generation': generation,
+        }
+
+    @streamed
     @content_type('multipart/form-data')
     async def post(self, request):
         """
         Get a CSV file and parse it into a new lookup table.
+        The file is read and stored by chunks, the lookup is returned with
+        its row count instead of its table if it has been chunked.
         """
-        data = await request.post()
-        if 'csv' not in data or not isinstance(data['csv'], FileField):
-            return Response(status=400, body={
-                'error': "'csv' field must be a CSV file"
-            })
+        storage = self.nyuki.storage.lookups
+        lookup_id = str(uuid4())
+        lookup = None
+        title = None
 
-        # From bytes to string (aiohttp handles everything in bytes)
-        csv_field = data['csv']
-        lookup_name = data.get('title') or csv_field.filename.replace('.csv', '')
-        csv_string = csv_field.file.read()
-
-        # Try utf-8 or latin-1 encoding
         try:
-            iocsv = StringIO(csv_string.decode())
-        except UnicodeDecodeError:
-            iocsv = StringIO(csv_string.decode('latin-1'))
-
-        # Find headers and dialect using a Sniffer
-        sniffer = csv.Sniffer()
-        sample = iocsv.read(1024)
-        iocsv.seek(0)
-
-        try:
-            dialect = sniffer.sniff(sample)
-        except csv.Error as exc:
-            # Could not determine delimiter
+            reader = await request.multipart()
+            while True:
+                part = await reader.next()
+                if part is None:
+                    break
+                if part.name == 'title':
+                    title = await part.text()
+                elif part.name == 'csv' and part.filename and lookup is None:
+                    lookup = await self._import(
+                        part, lookup_id,
+                        title or part.filename.replace('.csv', '')
+                    )
+                else:
+                    await part.release()
+        except (csv.Error, UnicodeDecodeError) as exc:
+            # Could not determine delimiter or decode the file
             log.error(exc)
+            await storage.delete(lookup_id)
             return Response(status=400, body={
                 'error': str(exc),
                 'code': 'CSV_PARSE_ERROR'
             })
+        except AutoReconnect:
+            await storage.abort_import(lookup_id)
+            return Response(status=503)
+        except (ValueError, AssertionError) as exc:
+            log.debug(exc)
+            await storage.delete(lookup_id)
+            return Response(status=400, body={
+                'error': 'multipart/form-data must be a form'
+            })
 
-        log.info("CSV file validated with delimiter: '%s'", dialect.delimiter)
-        reader = csv.DictReader(iocsv, fieldnames=CSV_FIELDNAMES, dialect=dialect)
-        # Ignore header if there is one
-        if sniffer.has_header(sample):
-            header = reader.__next__()
-            log.info('CSV header found: %s', header)
-        table = list(reader)
+        if lookup is None:
+            return Response(status=400, body={
+                'error': "'csv' field must be a CSV file"
+            })
 
-        lookup = new_lookup(lookup_name, table)
+        # The title field can be sent after the file
+        lookup['title'] = title or lookup['title']
         try:
-            await self.nyuki.storage.lookups.insert(lookup)
+            if lookup.get('chunked'):
+                await storage.end_import(
+                    lookup_id, lookup['generation'], lookup['rows'],
+                    lookup['title']
+                )
+            else:
+                await storage.insert(lookup)
         except AutoReconnect:
+            await storage.abort_import(lookup_id)
             return Response(status=503)
+        log.info(
+            "Lookup '%s' imported with %d rows", lookup_id,
+            lookup['rows'] if lookup.get('chunked') else len(lookup['table'])
+        )
         return Response(lookup)
 
     async def put(self, request):
@@ -260,6 +451,7 @@ class ApiFactoryLookups:
         except AutoReconnect:
             return Response(status=503)
         await self.nyuki.storage.lookups.delete()
+        await self.nyuki.invalidate_rules('lookups')
         return Response(lookups)
 
 
@@ -283,19 +475,30 @@ class ApiFactoryLookup:
         Modify an existing lookup table
         """
         try:
-            lookup = await self.nyuki.storage.lookups.get_one(lookup_id)
+            lookup = await self.nyuki.storage.lookups.get_one(
+                lookup_id, table=False
+            )
         except AutoReconnect:
             return Response(status=503)
         if not lookup:
             return Response(status=404)
 
         request = await request.json()
+        # Rename a chunked table without reading its rows
+        if 'table' not in request and lookup.get('chunked'):
+            lookup['title'] = request.get('title', lookup['title'])
+            await self.nyuki.storage.lookups.update_title(
+                lookup_id, lookup['title']
+            )
+            return Response(lookup)
+
         lookup = new_lookup(
             request.get('title', lookup['title']),
             request.get('table', lookup['table']),
             lookup_id=lookup_id
         )
         await self.nyuki.storage.lookups.insert(lookup)
+        await self.nyuki.invalidate_rules('lookups', lookup_id)
         return Response(lookup)
 
     async def delete(self, request, lookup_id):
@@ -303,13 +506,16 @@ class ApiFactoryLookup:
         Delete the lookup table with id `lookup_id`
         """
         try:
-            lookup = await self.nyuki.storage.lookups.get_one(lookup_id)
+            lookup = await self.nyuki.storage.lookups.get_one(
+                lookup_id, table=False, importing=True
+            )
         except AutoReconnect:
             return Response(status=503)
         if not lookup:
             return Response(status=404)
 
         await self.nyuki.storage.lookups.delete(lookup_id)
+        await self.nyuki.invalidate_rules('lookups', lookup_id)
         return Response(lookup)
 
 
@@ -318,10 +524,11 @@ class ApiFactoryLookupCSV:
 
     async def get(self, request, lookup_id):
         """
-        Return the lookup table for id `lookup_id`
+        Return the lookup table for id `lookup_id`, streamed as a CSV file
         """
+        storage = self.nyuki.storage.lookups
         try:
-            lookup = await self.nyuki.storage.lookups.get_one(lookup_id)
+            lookup = await storage.get_one(lookup_id, table=False)
         except AutoReconnect:
             return Response(status=503)
         if not lookup:
@@ -333,28 +540,54 @@ class ApiFactoryLookupCSV:
 
         encoding = request.GET.get('encoding', 'UTF-8')
 
-        # Write CSV
-        with StringIO() as iocsv:
-            writer = csv.DictWriter(
-                iocsv, fieldnames=CSV_FIELDNAMES, delimiter=','
-            )
-            writer.writeheader()
-            for pair in lookup['table']:
-                writer.writerow(pair)
-            iocsv.seek(0)
+        iocsv = StringIO()
+        writer = csv.writer(iocsv, delimiter=',')
 
-            headers = {
-                'Content-Disposition': 'attachment; filename={}'.format(filename),
-                'Content-Type': 'text/csv; charset={}'.format(encoding)
-            }
+        def encode(rows):
+            iocsv.seek(0)
+            iocsv.truncate()
+            writer.writerows(rows)
+            return iocsv.getvalue().encode(encoding)
+
+        # Encode the first rows (the whole table if not chunked) before
+        # sending the headers, to report an encoding error
+        if lookup.get('chunked'):
+            cursor = storage.chunks(lookup)
+            first = (await cursor.to_list(1) or [{'rows': []}])[0]['rows']
+        else:
+            cursor = None
+            first = [
+                [pair['value'], pair['replace']] for pair in lookup['table']
+            ]
+        try:
+            body = encode([CSV_FIELDNAMES] + first)
+        except UnicodeEncodeError as exc:
+            return Response(status=406, body={
+                'error': str(exc),
+                'code': 'UNICODE_ENCODING_ERROR'
+            })
 
-            try:
-                return Response(
-                    text=iocsv.read(),
-                    headers=headers
-                )
-            except UnicodeEncodeError as exc:
-                return Response(status=406, body={
-                    'error': str(exc),
-                    'code': 'UNICODE_ENCODING_ERROR'
-                })
+        response = StreamResponse(headers={
+            'Content-Disposition': 'attachment; filename={}'.format(filename),
+            'Content-Type': 'text/csv; charset={}'.format(encoding)
+        })
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        response.write(body)
+        await response.drain()
+
+        if cursor is not None:
+            async for chunk in cursor:
+                try:
+                    response.write(encode(chunk['rows']))
+                except UnicodeEncodeError as exc:
+                    # Too late for an error status, cut the file short
+                    log.error(
+                        "Lookup '%s' can't be encoded in %s: %s",
+                        lookup_id, encoding, exc
+                    )
+                    break
+                await response.drain()
+
+        await response.write_eof()
+        return response
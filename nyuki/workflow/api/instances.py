@@ -10,7 +10,8 @@ from pymongo.errors import AutoReconnect
 
 from nyuki.api import Response, resource, content_type, HTTPBreak
 from nyuki.utils import from_isoformat
-from nyuki.workflow.tasks.utils.uri import URI, InvalidWorkflowUri
+from nyuki.workflow.admission import AdmissionRejected
+from nyuki.workflow.tasks.utils.uri import URI
 from nyuki.workflow.db.workflow_instances import Ordering
 
 
@@ -43,26 +44,95 @@ class _WorkflowResource:
 
         broker.register(exec_handler, topic=topic)
 
+    async def rescue_report(self, report):
+        """
+        Attach a dangling workflow instance from its last known report.
+        Return the resulting HTTP status.
+        """
+        exec = report['exec']
+        if exec['id'] in self.nyuki.running_workflows:
+            return 409
+
+        wf_tmpl = WorkflowTemplate.from_dict(report)
+        try:
+            wf_tmpl.root()
+        except WorkflowRootTaskError:
+            return 400
+
+        wflow = await self.nyuki.engine.rescue(wf_tmpl, report)
+        if wflow is None:
+            return 400
+
+        self.nyuki.new_workflow(
+            report, wflow,
+            track=exec.get('track', []),
+            requester=exec.get('requester'),
+        )
+        return 200
+
 
 @resource('/workflow/instances', ['v1'], 'application/json')
 class ApiWorkflows(_WorkflowResource):
 
     async def get(self, request):
         """
-        Return workflow instances
+        Return the running workflow reports, or their summaries.
+        Filters:
+            * `children` also return the workflows started by other workflows
+            * `tasks` include the tasks in the reports
+            * `template` return the workflows of this template id
+            * `state` return the workflows on this FutureState
+            * `offset` return the worflows from this offset
+            * `limit` return this amount of workflows
+            * `summary` return the workflow summaries instead of the reports
+        The total count is sent in the 'X-Total-Count' header.
         """
-        workflows = []
-        children = request.GET.get('children', '0') == '1'
-        tasks = request.GET.get('tasks', '0') == '1'
+        index = self.nyuki.running_index
+        summary = request.GET.get('summary', '0') == '1'
+        # The summaries only change with the set of workflows or their state
+        if summary and request.headers.get('If-None-Match') == index.etag:
+            return Response(status=304, headers={'ETag': index.etag})
 
-        for wflow in self.nyuki.running_workflows.values():
-            if children is False:
-                requester = wflow.exec.get('requester')
-                if requester and requester.startswith('nyuki://'):
-                    continue
-            workflows.append(wflow.report(tasks=tasks))
+        state = request.GET.get('state')
+        if state:
+            try:
+                state = FutureState(state).value
+            except ValueError:
+                return Response(status=400, body={
+                    'error': "Unknown state '{}'".format(state)
+                })
+        try:
+            offset = int(request.GET.get('offset', 0))
+        except ValueError:
+            return Response(status=400, body={
+                'error': 'Offset must be an int'
+            })
+        limit = request.GET.get('limit')
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return Response(status=400, body={
+                    'error': 'Limit must be an int'
+                })
 
-        return Response(workflows)
+        count, workflows = index.select(
+            template=request.GET.get('template'),
+            state=state,
+            children=request.GET.get('children', '0') == '1',
+            offset=offset, limit=limit or None,
+        )
+        headers = {'X-Total-Count': str(count)}
+        if summary:
+            headers['ETag'] = index.etag
+        else:
+            tasks = request.GET.get('tasks', '0') == '1'
+            workflows = [
+                self.nyuki.running_workflows[wflow['id']].report(tasks=tasks)
+                for wflow in workflows
+            ]
+
+        return Response(workflows, headers=headers)
 
     async def put(self, request):
         """
@@ -90,7 +160,7 @@ class ApiWorkflows(_WorkflowResource):
         if exec:
             # Suspended/crashed instance
             # The request's payload is the last known execution report
-            templates = [request]
+            template = request
             if exec['id'] in self.nyuki.running_workflows:
                 return Response(status=400, body={
                     'error': 'This workflow is already being rescued'
@@ -117,31 +187,30 @@ class ApiWorkflows(_WorkflowResource):
                 'error': 'More than one root task'
             })
 
+        # Prevent workflow loop, before starting anything
+        exec_track = exec_track.split(',') if exec_track else []
+        if URI.in_track(exec_track, wf_tmpl.uid):
+            return Response(status=400, body={
+                'error': 'Loop detected between workflows'
+            })
+
         if exec:
             wflow = await self.nyuki.engine.rescue(wf_tmpl, request)
         elif draft:
             wflow = await self.nyuki.engine.run_once(wf_tmpl, data)
         else:
-            wflow = await self.nyuki.engine.trigger(wf_tmpl.uid, data)
+            try:
+                wflow = await self.nyuki.engine.trigger(wf_tmpl.uid, data)
+            except AdmissionRejected as exc:
+                return Response(status=429, body={
+                    'error': 'Too many workflows running ({})'.format(exc)
+                })
 
         if wflow is None:
             return Response(status=400, body={
                 'error': 'Could not start any workflow from this template'
             })
 
-        # Prevent workflow loop
-        exec_track = exec_track.split(',') if exec_track else []
-        holder = self.nyuki.bus.name
-        for ancestor in exec_track:
-            try:
-                info = URI.parse(ancestor)
-            except InvalidWorkflowUri:
-                continue
-            if info.template_id == wf_tmpl.uid and info.holder == holder:
-                return Response(status=400, body={
-                    'error': 'Loop detected between workflows'
-                })
-
         # Keep full instance+template in nyuki's memory
         wfinst = self.nyuki.new_workflow(
             template, wflow,
@@ -163,6 +232,51 @@ class ApiWorkflows(_WorkflowResource):
         return Response(wfinst.report(), status=status)
 
 
+@resource('/workflow/rescue', versions=['v1'])
+class ApiWorkflowRescue(_WorkflowResource):
+
+    async def post(self, request):
+        """
+        Rescue many suspended/crashed instances from their last known
+        reports, returning the status of each: {"<exec id>": <status>}
+        """
+        reports = await request.json()
+        if not isinstance(reports, list):
+            return Response(status=400, body={
+                'error': 'A list of workflow reports is expected'
+            })
+
+        statuses = {}
+        for report in reports:
+            try:
+                uid = report['exec']['id']
+            except (KeyError, TypeError):
+                log.warning('Invalid workflow report to rescue')
+                continue
+            try:
+                statuses[uid] = await self.rescue_report(report)
+            except Exception as exc:
+                log.exception(exc)
+                statuses[uid] = 500
+        return Response(statuses)
+
+
+@resource('/workflow/queue', versions=['v1'])
+class ApiWorkflowQueue:
+
+    async def get(self, request):
+        """
+        Return the admission queue metrics, and the history queue ones
+        """
+        report = self.nyuki.engine.admission.report()
+        try:
+            report['stored'] = await self.nyuki.storage.workflow_queue.count()
+        except AutoReconnect:
+            report['stored'] = None
+        report['history'] = self.nyuki.history.report()
+        return Response(report)
+
+
 @resource('/workflow/instances/{iid}', versions=['v1'])
 class ApiWorkflow:
 
@@ -36,6 +36,18 @@ class _TemplateResource:
             'tags': request.get('tags', []),
         }
 
+        # Admission settings, stored with each template version
+        concurrency = request.get('concurrency')
+        if concurrency is not None:
+            if not isinstance(concurrency, int) or concurrency < 1:
+                raise ValueError("'concurrency' must be a positive integer")
+            template['concurrency'] = concurrency
+        priority = request.get('priority')
+        if priority is not None:
+            if not isinstance(priority, int):
+                raise ValueError("'priority' must be an integer")
+            template['priority'] = priority
+
         # Store task extra info (ie. title)
         rqst_tasks = request.get('tasks', [])
         tmpl_tasks = template['tasks']
@@ -105,6 +117,10 @@ class ApiTemplates(_TemplateResource):
             return Response(status=409, body={
                 'error': exc
             })
+        except ValueError as exc:
+            return Response(status=400, body={
+                'error': str(exc)
+            })
 
         tmpl_dict['errors'] = self.errors_from_validation(template)
         return Response(tmpl_dict)
@@ -158,6 +174,10 @@ class ApiTemplate(_TemplateResource):
             return Response(status=409, body={
                 'error': exc
             })
+        except ValueError as exc:
+            return Response(status=400, body={
+                'error': str(exc)
+            })
 
         tmpl_dict['errors'] = self.errors_from_validation(template)
         return Response(tmpl_dict)
@@ -197,6 +217,7 @@ class ApiTemplate(_TemplateResource):
             return Response(status=404)
 
         await self.nyuki.storage.delete_template(tid)
+        await self.nyuki.invalidate_template(tid, deleted=True)
         return Response(templates)
 
 
@@ -258,6 +279,7 @@ class ApiTemplateDraft(_TemplateResource):
 
         # Update draft into a new template
         await self.nyuki.storage.publish_draft(tid)
+        await self.nyuki.invalidate_template(tid)
         tmpl_dict['state'] = TemplateState.ACTIVE.value
         return Response(tmpl_dict)
 
@@ -288,6 +310,10 @@ class ApiTemplateDraft(_TemplateResource):
             return Response(status=409, body={
                 'error': str(exc)
             })
+        except ValueError as exc:
+            return Response(status=400, body={
+                'error': str(exc)
+            })
 
         tmpl_dict['errors'] = self.errors_from_validation(template)
         return Response(tmpl_dict)
@@ -1,4 +1,4 @@
-import re
+import zlib
 import logging
 from pymongo.errors import AutoReconnect
 
@@ -10,64 +10,59 @@ log = logging.getLogger(__name__)
 
 class DataInspector(object):
 
-    REGEX = [
-        re.compile('{([a-zA-Z_\-]+)}', re.IGNORECASE),
-        re.compile('@([a-zA-Z_\-]+)', re.IGNORECASE)
-    ]
-
-    @classmethod
-    def iter(cls, node):
-        if isinstance(node, dict):
-            for value in node.values():
-                yield from cls.iter(value)
-        elif isinstance(node, list):
-            for value in node:
-                yield from cls.iter(value)
-        else:
-            yield node
+    """
+    Serve the data keys read by the tasks of a template, computed when its
+    draft was saved and stored with it.
+    """
 
-    async def required_keys(self, tid, version=None, draft=False):
+    async def get_keys(self, tid, version=None, draft=False):
         try:
-            template = await self.nyuki.storage.get_template(
+            keys = await self.nyuki.storage.get_required_keys(
                 tid, draft=draft, version=version
             )
         except AutoReconnect:
             raise HTTPBreak(503)
-        if not template:
+        if not keys:
             raise HTTPBreak(404, {'error': 'template not found'})
+        return keys
 
-        keys = set()
-        for task in template.get('tasks', []):
-            for key, data in task.get('config', {}).items():
-                # Get all evaluable inner-data
-                for value in self.iter(data):
-                    if not isinstance(value, str):
-                        continue
-                    for regex in self.REGEX:
-                        for data_key in regex.findall(value):
-                            keys.add(data_key)
-        return list(keys)
+    async def required_keys(self, tid, version=None, draft=False):
+        keys = await self.get_keys(tid, version, draft)
+        return keys['keys']
+
+    async def keys_response(self, request, tid, version=None, draft=False):
+        """
+        Respond with the required keys, tagged with the template version
+        (and the keys themselves for a draft, which can change anytime).
+        """
+        keys = await self.get_keys(tid, version, draft)
+        etag = '{}-{}'.format(tid, keys['version'])
+        if keys['draft']:
+            etag = '{}-{:08x}'.format(
+                etag, zlib.crc32(','.join(keys['keys']).encode())
+            )
+        etag = '"{}"'.format(etag)
+        if request.headers.get('If-None-Match') == etag:
+            return Response(status=304, headers={'ETag': etag})
+        return Response(body=keys['keys'], headers={'ETag': etag})
 
 
 @resource('/workflow/vars/{tid}', versions=['v1'])
 class ApiVars(DataInspector):
 
     async def get(self, request, tid):
-        keys = await self.required_keys(tid)
-        return Response(body=keys)
+        return await self.keys_response(request, tid)
 
 
 @resource('/workflow/vars/{tid}/{version:\d+}', versions=['v1'])
 class ApiVarsVersion(DataInspector):
 
     async def get(self, request, tid, version):
-        keys = await self.required_keys(tid, version=version)
-        return Response(body=keys)
+        return await self.keys_response(request, tid, version=version)
 
 
 @resource('/workflow/vars/{tid}/draft', versions=['v1'])
 class ApiVarsDraft(DataInspector):
 
     async def get(self, request, tid):
-        keys = await self.required_keys(tid, draft=True)
-        return Response(body=keys)
+        return await self.keys_response(request, tid, draft=True)
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+from collections import OrderedDict, Counter
+
+
+log = logging.getLogger(__name__)
+
+
+class ProgressCoalescer:
+
+    """
+    Coalesce the progress payloads published for a (workflow, task) key:
+    within `window` seconds only the latest payload of each topic is sent.
+    Pending payloads of a key must be flushed before publishing one of its
+    state transitions to keep the events in order.
+    """
+
+    WINDOW = 0.5
+
+    def __init__(self, publish, window=WINDOW, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._publish = publish
+        self.window = window
+        self._pending = {}
+        self._timers = {}
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _send(self, topic, payload):
+        self.stats['sent'] += 1
+        asyncio.ensure_future(self._publish(payload, topic), loop=self._loop)
+
+    def push(self, key, topic, payload):
+        """
+        Delay a progress payload, replacing the pending one of this topic.
+        """
+        if self.window <= 0:
+            self._send(topic, payload)
+            return
+
+        try:
+            pending = self._pending[key]
+        except KeyError:
+            pending = self._pending[key] = OrderedDict()
+            self._timers[key] = self._loop.call_later(
+                self.window, self.flush, key
+            )
+        if topic in pending:
+            self.stats['coalesced'] += 1
+        pending[topic] = payload
+
+    def flush(self, key):
+        """
+        Send the pending payloads of a key right away.
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        for topic, payload in self._pending.pop(key, {}).items():
+            self._send(topic, payload)
+
+    def flush_workflow(self, uid):
+        """
+        Send the pending payloads of all the tasks of a workflow.
+        """
+        for key in [key for key in self._pending if key[0] == uid]:
+            self.flush(key)
+
+    def flush_all(self):
+        for key in list(self._pending):
+            self.flush(key)
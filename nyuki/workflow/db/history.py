@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from pymongo.errors import AutoReconnect
+
+
+log = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+
+    """
+    Buffer finished workflow and task instances and bulk-insert them into the
+    history. A flush is triggered every `batch_size` documents or
+    `flush_interval` seconds after the first buffered one, whichever comes
+    first. The buffer is bounded by `max_queue`: `put()` waits up to
+    `put_timeout` seconds when it is full, then drops the document (counted
+    in `dropped`). A batch that cannot be written is logged and dropped, the consumer keeps
+    running.
+    """
+
+    RETRY_DELAY = 1.0
+
+    def __init__(self, storage, batch_size=100, flush_interval=1.0,
+                 max_queue=10000, retries=5, put_timeout=30.0, loop=None):
+        self._storage = storage
+        self._loop = loop or asyncio.get_event_loop()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.put_timeout = put_timeout
+        self._queue = asyncio.Queue(maxsize=max_queue, loop=self._loop)
+        self._batch = []
+        self._consumer = None
+        # Documents dropped because the queue stayed full
+        self.dropped = 0
+
+    def __len__(self):
+        return self._queue.qsize() + len(self._batch)
+
+    async def _put(self, item):
+        if not self._queue.full():
+            self._queue.put_nowait(item)
+            return True
+        log.warning(
+            'History queue is full (%d documents), waiting for a flush',
+            self._queue.maxsize,
+        )
+        try:
+            await asyncio.wait_for(
+                self._queue.put(item), self.put_timeout, loop=self._loop
+            )
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                log.error(
+                    'History queue still full after %ss, %d documents '
+                    'dropped', self.put_timeout, self.dropped,
+                )
+            return False
+        return True
+
+    async def put(self, instance):
+        """
+        Queue a finished (and sanitized) workflow instance report, return
+        False if it was dropped.
+        """
+        return await self._put((None, instance))
+
+    async def put_task(self, instance_id, task):
+        """
+        Queue a finished (and sanitized) task instance report, return False
+        if it was dropped.
+        """
+        return await self._put((instance_id, task))
+
+    def report(self):
+        return {
+            'queued': len(self),
+            'max_queue': self._queue.maxsize,
+            'dropped': self.dropped,
+        }
+
+    def start(self):
+        if self._consumer is None:
+            self._consumer = asyncio.ensure_future(self._run(), loop=self._loop)
+
+    async def stop(self):
+        """
+        Stop the consumer and flush everything left in memory.
+        """
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+
+        while not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+        log.info('Flushing %d documents into history', len(self._batch))
+        while self._batch:
+            await self._write(self._batch[:self.batch_size])
+            self._batch = self._batch[self.batch_size:]
+
+    async def _run(self):
+        while True:
+            self._batch.append(await self._queue.get())
+            deadline = self._loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                if not self._queue.empty():
+                    self._batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                item = await self._get(timeout)
+                if item is None:
+                    break
+                self._batch.append(item)
+
+            await self._write(self._batch)
+            self._batch = []
+
+    async def _get(self, timeout):
+        """
+        Wait for the next document up to `timeout` seconds, or return None.
+        A document already taken from the queue when the consumer is
+        cancelled is kept in the batch.
+        """
+        get = asyncio.ensure_future(self._queue.get(), loop=self._loop)
+        try:
+            await asyncio.wait([get], timeout=timeout, loop=self._loop)
+        except asyncio.CancelledError:
+            if get.done() and not get.cancelled():
+                self._batch.append(get.result())
+            get.cancel()
+            raise
+        if get.done():
+            return get.result()
+        get.cancel()
+
+    async def _write(self, batch):
+        """
+        Insert a batch of workflows and tasks, retrying on connection
+        failures. Already inserted documents are ignored by the storage on
+        retry. Any other error drops the batch.
+        """
+        # Workflows are queued without any instance id
+        workflows = [doc for instance_id, doc in batch if instance_id is None]
+        tasks = [item for item in batch if item[0] is not None]
+        for attempt in range(1, self.retries + 1):
+            try:
+                await self._storage.insert_instances(workflows, tasks)
+            except AutoReconnect as exc:
+                log.warning(
+                    'Could not write history (attempt %d/%d): %s',
+                    attempt, self.retries, exc,
+                )
+                await asyncio.sleep(self.RETRY_DELAY * attempt)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log.exception(exc)
+                break
+            else:
+                log.debug(
+                    '%d workflows and %d tasks written in history',
+                    len(workflows), len(tasks),
+                )
+                return
+        log.error(
+            'Dropping %d workflows and %d tasks from history',
+            len(workflows), len(tasks),
+        )
@@ -0,0 +1,225 @@
+import logging
+from uuid import uuid4
+from pymongo import ASCENDING
+
+from .data_processing import DataProcessingCollection
+
+
+log = logging.getLogger(__name__)
+
+
+class LookupCollection(DataProcessingCollection):
+
+    """
+    Lookup tables. Tables of more than `CHUNK_SIZE` rows are not stored in
+    their lookup document (16MB limit) but in the 'lookup_rows' collection,
+    by chunks of rows:
+
+    {
+        "lookup_id": <uuid4>,
+        "generation": <str>,
+        "index": <int>,
+        "rows": [[<value>, <replace>], ...]
+    }
+
+    Their lookup document holds the row count instead of the table, and the
+    generation of its chunks:
+
+    {
+        "id": <uuid4>,
+        "title": <str>,
+        "rows": <int>,
+        "chunked": true,
+        "generation": <str>,
+        "importing": <bool>
+    }
+
+    The chunks of an import are written under a new generation, the lookup
+    document only switches to it once they all are, and the chunks of the
+    previous generation are deleted afterwards. A table still importing for
+    the first time is not readable.
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, db):
+        super().__init__(db, 'lookups')
+        self._chunks = db['lookup_rows']
+
+    async def index(self):
+        await super().index()
+        await self._chunks.create_index([
+            ('lookup_id', ASCENDING),
+            ('generation', ASCENDING),
+            ('index', ASCENDING),
+        ], unique=True)
+
+    def chunks(self, lookup):
+        """
+        Return a cursor over the row chunks of a chunked lookup table.
+        """
+        query = {
+            'lookup_id': lookup['id'], 'generation': lookup.get('generation'),
+        }
+        return self._chunks.find(
+            query, {'_id': 0, 'rows': 1},
+            sort=[('index', ASCENDING)],
+        )
+
+    async def get_one(self, rule_id, table=True, importing=False):
+        """
+        Return the lookup table for given id or None, its rows are
+        gathered from the chunks if needed (and `table` is True).
+        A table still importing is only returned if `importing` is True,
+        without its rows.
+        """
+        lookup = await super().get_one(rule_id)
+        if not lookup:
+            return
+        if lookup.get('importing'):
+            return lookup if importing is True else None
+        if lookup.get('chunked') and table is True:
+            pairs = await self.pairs(rule_id, lookup)
+            if pairs is None:
+                return
+            lookup['table'] = [
+                {'value': value, 'replace': replace}
+                for value, replace in pairs
+            ]
+        return lookup
+
+    async def pairs(self, lookup_id, lookup=None):
+        """
+        Return the (value, replace) pairs of a lookup table, or None.
+        """
+        # Read again if a new import replaced the chunks meanwhile
+        for _ in range(3):
+            if lookup is None:
+                lookup = await super().get_one(lookup_id)
+            if not lookup or lookup.get('importing'):
+                return
+            if not lookup.get('chunked'):
+                return [
+                    (row['value'], row['replace']) for row in lookup['table']
+                ]
+            pairs = []
+            async for chunk in self.chunks(lookup):
+                pairs.extend(tuple(row) for row in chunk['rows'])
+            if len(pairs) == lookup['rows']:
+                return pairs
+            lookup = None
+        log.warning("Lookup '%s' changed while being read", lookup_id)
+        return pairs
+
+    async def insert(self, data):
+        """
+        Insert or replace a lookup table, by chunks if it is too large.
+        """
+        table = data['table']
+        if len(table) <= self.CHUNK_SIZE:
+            await super().insert(data)
+            await self._chunks.delete_many({'lookup_id': data['id']})
+            return
+
+        generation = await self.start_import(data['id'], data['title'])
+        try:
+            for index, start in enumerate(
+                range(0, len(table), self.CHUNK_SIZE)
+            ):
+                await self.insert_rows(data['id'], generation, index, [
+                    [row['value'], row['replace']]
+                    for row in table[start:start + self.CHUNK_SIZE]
+                ])
+            await self.end_import(
+                data['id'], generation, len(table), data['title']
+            )
+        except Exception:
+            await self.abort_import(data['id'], generation)
+            raise
+
+    async def start_import(self, lookup_id, title):
+        """
+        Return a new generation to store the chunks of a lookup table.
+        An empty chunked lookup table is created if it does not exist yet,
+        an existing one is left as is until `end_import`.
+        """
+        generation = uuid4().hex
+        await self._rules.update_one({'id': lookup_id}, {
+            '$setOnInsert': {
+                'id': lookup_id,
+                'title': title,
+                'rows': 0,
+                'chunked': True,
+                'generation': generation,
+                'importing': True,
+            },
+        }, upsert=True)
+        return generation
+
+    async def insert_rows(self, lookup_id, generation, index, rows):
+        """
+        Store the chunk `index` of a lookup table generation.
+        """
+        await self._chunks.insert_one({
+            'lookup_id': lookup_id,
+            'generation': generation,
+            'index': index,
+            'rows': rows,
+        })
+        # Import progress of a new table
+        await self._rules.update_one(
+            {'id': lookup_id, 'generation': generation},
+            {'$inc': {'rows': len(rows)}},
+        )
+
+    async def end_import(self, lookup_id, generation, rows, title):
+        """
+        Switch a lookup table to the chunks of `generation`, then delete
+        the previous ones.
+        """
+        await self._rules.replace_one({'id': lookup_id}, {
+            'id': lookup_id,
+            'title': title,
+            'rows': rows,
+            'chunked': True,
+            'generation': generation,
+            'importing': False,
+        }, upsert=True)
+        await self._chunks.delete_many({
+            'lookup_id': lookup_id, 'generation': {'$ne': generation},
+        })
+
+    async def abort_import(self, lookup_id, generation=None):
+        """
+        Delete the chunks of a failed import, and its lookup table if it
+        was a new one. Without `generation`, the whole new lookup table is
+        deleted.
+        """
+        chunks = {'lookup_id': lookup_id}
+        rule = {'id': lookup_id}
+        if generation is not None:
+            chunks['generation'] = generation
+            rule.update({'generation': generation, 'importing': True})
+        try:
+            await self._chunks.delete_many(chunks)
+            await self._rules.delete_one(rule)
+        except Exception as exc:
+            log.error(
+                "Could not clean up lookup '%s' import: %s", lookup_id, exc
+            )
+
+    async def update_title(self, lookup_id, title):
+        await self._rules.update_one(
+            {'id': lookup_id}, {'$set': {'title': title}}
+        )
+
+    async def delete(self, rule_id=None):
+        """
+        Delete a lookup table from its id or all of them, with their rows
+        """
+        if rule_id is None:
+            await self._rules.delete_many({})
+            await self._chunks.delete_many({})
+            return
+        await super().delete(rule_id)
+        await self._chunks.delete_many({'lookup_id': rule_id})
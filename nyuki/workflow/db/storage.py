@@ -1,15 +1,20 @@
 import logging
 from copy import deepcopy
+from collections import OrderedDict
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import ServerSelectionTimeoutError
 
 from .triggers import TriggerCollection
 from .data_processing import DataProcessingCollection
+from .lookups import LookupCollection
 from .metadata import MetadataCollection
-from .workflow_templates import WorkflowTemplatesCollection, TemplateState
+from .workflow_templates import (
+    WorkflowTemplatesCollection, TemplateState, required_keys
+)
 from .task_templates import TaskTemplatesCollection
 from .workflow_instances import WorkflowInstancesCollection
+from .workflow_queue import WorkflowQueueCollection
 from .task_instances import TaskInstancesCollection
 
 
@@ -18,10 +23,16 @@ log = logging.getLogger(__name__)
 
 class MongoStorage:
 
+    # Required keys of the template versions last read
+    REQUIRED_KEYS = 1024
+
     def __init__(self):
         self._client = None
         self._db = None
         self._validate_on_start = False
+        # (template id, version) -> required keys, least recently used first
+        # (version None for the active version, until the next publication)
+        self._required_keys = OrderedDict()
 
         # Collections
         self._workflow_templates = None
@@ -32,6 +43,7 @@ class MongoStorage:
         self.regexes = None
         self.lookups = None
         self.triggers = None
+        self.workflow_queue = None
 
     def configure(self, host, database, validate_on_start=True, **kwargs):
         log.info(
@@ -49,8 +61,9 @@ class MongoStorage:
         self._workflow_instances = WorkflowInstancesCollection(self._db)
         self._task_instances = TaskInstancesCollection(self._db)
         self.regexes = DataProcessingCollection(self._db, 'regexes')
-        self.lookups = DataProcessingCollection(self._db, 'lookups')
+        self.lookups = LookupCollection(self._db)
         self.triggers = TriggerCollection(self._db)
+        self.workflow_queue = WorkflowQueueCollection(self._db)
 
     async def index(self):
         """
@@ -67,6 +80,7 @@ class MongoStorage:
                 await self.regexes.index()
                 await self.lookups.index()
                 await self.triggers.index()
+                await self.workflow_queue.index()
             except ServerSelectionTimeoutError as exc:
                 log.error('Could not connect to Mongo - %s', exc)
             else:
@@ -110,6 +124,7 @@ class MongoStorage:
         # Split and insert tasks.
         tasks = template.pop('tasks')
         await self._task_templates.insert_many(deepcopy(tasks), template)
+        template['required_keys'] = required_keys(tasks)
 
         # Insert template without tasks.
         await self._workflow_templates.insert_draft(template)
@@ -122,12 +137,12 @@ class MongoStorage:
         Publish a draft into an 'active' state, and archive the old active.
         """
         await self._workflow_templates.publish_draft(template_id)
+        self.invalidate_required_keys(template_id)
         log.info('Draft for template %s published', template_id[:8])
 
     async def get_for_topic(self, topic):
         """
         Return all the templates listening on a particular topic.
-        This does not append the metadata.
         """
         templates = await self._workflow_templates.get_for_topic(topic)
         if templates:
@@ -136,6 +151,8 @@ class MongoStorage:
                 len(templates), topic,
             )
         for template in templates:
+            metadata = await self._workflow_metadata.get_one(template['id'])
+            template.update(metadata or {})
             template['tasks'] = await self._task_templates.get(
                 template['id'], template['version']
             )
@@ -176,12 +193,71 @@ class MongoStorage:
         )
         return template
 
+    async def get_required_keys(self, tid, draft=False, version=None):
+        """
+        Return the data keys read by the tasks of a template and its
+        version: {"version": <int>, "draft": <bool>, "keys": [<str>]}
+        The keys of a published version never change and are cached, as
+        well as the active version of each template until the next
+        publication (see `invalidate_required_keys()`).
+        """
+        if version is not None:
+            version = int(version)
+        if version is not None or draft is False:
+            cached = self._required_keys.get((tid, version))
+            if cached is not None:
+                self._required_keys.move_to_end((tid, version))
+                return cached
+
+        template = await self._workflow_templates.get_required_keys(
+            tid, version=version, draft=draft
+        )
+        if not template:
+            return
+        keys = template.get('required_keys')
+        if keys is None:
+            # Saved before the keys were stored with the template
+            tasks = await self._task_templates.get(tid, template['version'])
+            keys = required_keys(tasks)
+            await self._workflow_templates.set_required_keys(
+                tid, template['version'], keys
+            )
+
+        result = {
+            'version': template['version'],
+            'draft': template['state'] == TemplateState.DRAFT.value,
+            'keys': keys,
+        }
+        if not result['draft']:
+            self._cache_required_keys((tid, result['version']), result)
+            if version is None:
+                self._cache_required_keys((tid, None), result)
+        return result
+
+    def _cache_required_keys(self, key, result):
+        self._required_keys[key] = result
+        self._required_keys.move_to_end(key)
+        if len(self._required_keys) > self.REQUIRED_KEYS:
+            self._required_keys.popitem(last=False)
+
+    def invalidate_required_keys(self, tid, versions=False):
+        """
+        Forget the active version of a template (published or deleted),
+        and all its versions if `versions` is True.
+        """
+        if versions is False:
+            self._required_keys.pop((tid, None), None)
+            return
+        for key in [key for key in self._required_keys if key[0] == tid]:
+            del self._required_keys[key]
+
     async def delete_template(self, tid, draft=False):
         """
         Delete a whole template or only its draft.
         """
         await self._workflow_templates.delete(tid, draft)
         if draft is False:
+            self.invalidate_required_keys(tid, versions=True)
             await self._task_templates.delete_many(tid)
             await self._workflow_metadata.delete(tid)
             await self.triggers.delete(tid)
@@ -199,6 +275,28 @@ class MongoStorage:
         await self._task_instances.insert_many(task_instances)
         await self._workflow_instances.insert(instance)
 
+    async def insert_instances(self, instances, tasks=()):
+        """
+        Insert many static workflow instances and all their tasks at once,
+        along with the task instances `tasks` given as
+        (workflow instance id, task) pairs.
+        The given reports are left untouched so that a write can be retried.
+        """
+        workflows = []
+        task_instances = [
+            {**task, 'workflow_instance_id': instance_id}
+            for instance_id, task in tasks
+        ]
+        for instance in instances:
+            template = instance['template'].copy()
+            for task in template.pop('tasks'):
+                task_instances.append({
+                    **task, 'workflow_instance_id': instance['id']
+                })
+            workflows.append({**instance, 'template': template})
+        await self._task_instances.insert_many(task_instances, ordered=False)
+        await self._workflow_instances.insert_many(workflows)
+
     # History
 
     async def get_history(self, **kwargs):
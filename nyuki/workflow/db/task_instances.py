@@ -1,10 +1,22 @@
 import logging
 from datetime import timezone
 from bson.codec_options import CodecOptions
+from pymongo.errors import BulkWriteError
 
 
 log = logging.getLogger(__name__)
 WS_FILTERS = ('quorum', 'status', 'twilio_error', 'diff')
+DUPLICATE_KEY_ERROR = 11000
+
+
+def only_duplicates(exc):
+    """
+    Return True if a bulk write only failed on already existing documents.
+    """
+    return all(
+        error['code'] == DUPLICATE_KEY_ERROR
+        for error in exc.details.get('writeErrors', [])
+    )
 
 
 class TaskInstancesCollection:
@@ -67,8 +79,15 @@ class TaskInstancesCollection:
             {'_id': 0, 'inputs': 1, 'outputs': 1},
         )
 
-    async def insert_many(self, tasks):
+    async def insert_many(self, tasks, ordered=True):
         """
-        Insert all the tasks of a finished workflow.
+        Insert all the tasks of one or several finished workflows.
+        Unordered inserts ignore the tasks already stored.
         """
-        await self._instances.insert_many(tasks)
+        if not tasks:
+            return
+        try:
+            await self._instances.insert_many(tasks, ordered=ordered)
+        except BulkWriteError as exc:
+            if ordered is True or not only_duplicates(exc):
+                raise
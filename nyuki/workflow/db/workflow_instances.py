@@ -5,6 +5,9 @@ from enum import Enum
 from datetime import datetime, timezone
 from bson.codec_options import CodecOptions
 from pymongo import DESCENDING, ASCENDING
+from pymongo.errors import BulkWriteError
+
+from .task_instances import only_duplicates
 
 
 log = logging.getLogger(__name__)
@@ -92,3 +95,15 @@ class WorkflowInstancesCollection:
         Insert a finished workflow report into the workflow history.
         """
         await self._instances.insert_one(workflow)
+
+    async def insert_many(self, workflows):
+        """
+        Insert many finished workflow reports, ignoring the ones already stored.
+        """
+        if not workflows:
+            return
+        try:
+            await self._instances.insert_many(workflows, ordered=False)
+        except BulkWriteError as exc:
+            if not only_duplicates(exc):
+                raise
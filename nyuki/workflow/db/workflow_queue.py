@@ -0,0 +1,58 @@
+import logging
+from pymongo import ASCENDING, DESCENDING
+
+from nyuki.utils import bson_safe, utcnow
+
+
+log = logging.getLogger(__name__)
+
+
+class WorkflowQueueCollection:
+
+    """
+    Workflow triggers spilled out of a full admission queue, waiting for
+    room to be made.
+
+    {
+        "template_id": <uuid4>,
+        "priority": <int>,
+        "data": {},
+        "created_at": <datetime>
+    }
+    """
+
+    SORT = [('priority', DESCENDING), ('created_at', ASCENDING)]
+
+    def __init__(self, db):
+        self._queue = db['workflow_queue']
+
+    async def index(self):
+        await self._queue.create_index(self.SORT)
+
+    async def count(self):
+        return await self._queue.count()
+
+    async def push(self, template_id, data, priority=0):
+        """
+        Store a workflow trigger.
+        """
+        await self._queue.insert_one({
+            'template_id': template_id,
+            'priority': priority,
+            'data': bson_safe(data),
+            'created_at': utcnow(),
+        })
+
+    async def pop(self, count):
+        """
+        Atomically remove and return up to `count` triggers, by priority.
+        """
+        triggers = []
+        for _ in range(count):
+            trigger = await self._queue.find_one_and_delete(
+                {}, projection={'_id': 0}, sort=self.SORT,
+            )
+            if not trigger:
+                break
+            triggers.append(trigger)
+        return triggers
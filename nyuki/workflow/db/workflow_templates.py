@@ -1,3 +1,4 @@
+import re
 import asyncio
 import logging
 from enum import Enum
@@ -22,6 +23,38 @@ class TemplateState(Enum):
         return cls.DRAFT.value if draft is True else cls.ACTIVE.value
 
 
+# Data keys read by the task configs ('{key}' and '@key')
+KEY_REGEXES = [
+    re.compile('{([a-zA-Z_\-]+)}', re.IGNORECASE),
+    re.compile('@([a-zA-Z_\-]+)', re.IGNORECASE)
+]
+
+
+def _iter_values(node):
+    if isinstance(node, dict):
+        for value in node.values():
+            yield from _iter_values(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _iter_values(value)
+    else:
+        yield node
+
+
+def required_keys(tasks):
+    """
+    Return the sorted data keys read by the configs of a template's tasks.
+    """
+    keys = set()
+    for task in tasks:
+        for value in _iter_values(task.get('config', {})):
+            if not isinstance(value, str):
+                continue
+            for regex in KEY_REGEXES:
+                keys.update(regex.findall(value))
+    return sorted(keys)
+
+
 class WorkflowTemplatesCollection:
 
     """
@@ -36,8 +69,12 @@ class WorkflowTemplatesCollection:
         "topics": [<str>],
         "graph": {},
         "version": <int>,
-        "state": <draft | active | archived>
+        "state": <draft | active | archived>,
+        "required_keys": [<str>]
     }
+
+    The 'required_keys' are the data keys read by the tasks of the version,
+    computed when the draft is saved.
     """
 
     def __init__(self, db):
@@ -85,6 +122,25 @@ class WorkflowTemplatesCollection:
 
         return await self._templates.find_one(query, {'_id': 0})
 
+    async def get_required_keys(self, tid, version=None, draft=False):
+        """
+        Return the version, state and required keys of a template (the keys
+        may be missing on the templates saved before they were computed).
+        """
+        if version is not None:
+            query = {'id': tid, 'version': int(version)}
+        else:
+            query = {'id': tid, 'state': TemplateState.draft_state(draft)}
+        return await self._templates.find_one(
+            query, {'_id': 0, 'version': 1, 'state': 1, 'required_keys': 1}
+        )
+
+    async def set_required_keys(self, tid, version, keys):
+        await self._templates.update_one(
+            {'id': tid, 'version': version},
+            {'$set': {'required_keys': keys}},
+        )
+
     async def get_for_topic(self, topic):
         """
         Return the latest templates (non-draft) that wait
@@ -0,0 +1,108 @@
+import logging
+from uuid import uuid4
+from collections import OrderedDict
+from tukio.utils import FutureState
+
+
+log = logging.getLogger(__name__)
+
+
+class RunningIndex:
+
+    """
+    Summaries of the running workflows, in start order, kept up to date on
+    workflow exec events so that listing them does not require any report.
+    The `etag` only changes when a workflow is added, removed or changes
+    state.
+
+    {
+        "id": <uuid4>,
+        "template": {"id": <uuid4>, "title": <str>, "version": <int>},
+        "state": <FutureState value>,
+        "start": <datetime>,
+        "requester": <str>
+    }
+    """
+
+    def __init__(self):
+        self._summaries = OrderedDict()
+        # Template summaries are shared between the instances of a version
+        self._templates = {}
+        # Avoid matching an ETag from a previous run
+        self._generation = uuid4().hex[:8]
+        self._version = 0
+
+    def __len__(self):
+        return len(self._summaries)
+
+    def __contains__(self, uid):
+        return uid in self._summaries
+
+    @property
+    def etag(self):
+        return '"{}-{}"'.format(self._generation, self._version)
+
+    def add(self, wflow):
+        """
+        Index a new `WorkflowInstance`.
+        """
+        template = wflow.template
+        uid = wflow.instance.uid
+        key = (
+            template.get('id'), template.get('title'), template.get('version')
+        )
+        try:
+            summary = self._templates[key]
+        except KeyError:
+            summary = self._templates[key] = {
+                'id': key[0], 'title': key[1], 'version': key[2],
+            }
+        self._summaries[uid] = {
+            'id': uid,
+            'template': summary,
+            'state': FutureState.get(wflow.instance).value,
+            'start': None,
+            'requester': wflow.exec.get('requester'),
+        }
+        self._version += 1
+
+    def update(self, uid, **fields):
+        try:
+            summary = self._summaries[uid]
+        except KeyError:
+            return
+        for key, value in fields.items():
+            if summary[key] != value:
+                summary[key] = value
+                self._version += 1
+
+    def remove(self, uid):
+        if self._summaries.pop(uid, None) is not None:
+            self._version += 1
+        if not self._summaries:
+            self._templates.clear()
+
+    def select(self, template=None, state=None, children=True, offset=0,
+               limit=None):
+        """
+        Return the total count of matching workflows and a page of their
+        summaries.
+        """
+        summaries = self._summaries.values()
+        if template or state or children is False:
+            summaries = [
+                summary for summary in summaries
+                if (not template or summary['template']['id'] == template)
+                and (not state or summary['state'] == state)
+                and (children or not (summary['requester'] or '').startswith(
+                    'nyuki://'
+                ))
+            ]
+        else:
+            summaries = list(summaries)
+        end = offset + limit if limit is not None else None
+        page = [
+            {**summary, 'template': dict(summary['template'])}
+            for summary in summaries[offset:end]
+        ]
+        return len(summaries), page
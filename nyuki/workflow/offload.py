@@ -0,0 +1,173 @@
+import signal
+import pickle
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from nyuki.utils import Converter
+
+
+log = logging.getLogger(__name__)
+
+
+# Converters compiled in a worker process, least recently used first
+_converters = OrderedDict()
+_initialized = False
+PIPELINES = 64
+
+
+def _init_worker():
+    """
+    Workers are forked from the nyuki: leave the signals to the parent and
+    its event loop (the wakeup fd is shared with it).
+    """
+    global _initialized
+    if _initialized:
+        return
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _initialized = True
+
+
+def _warm():
+    _init_worker()
+
+
+def _apply(key, rules, payload):
+    """
+    Apply a pipeline in a worker process on the pickled (data, diff, many)
+    and return the pickled (data, diff).
+    Return None if the converter of this pipeline is not compiled in this
+    worker yet and `rules` are not given.
+    """
+    _init_worker()
+    try:
+        converter = _converters[key]
+    except KeyError:
+        if rules is None:
+            return
+        converter = _converters[key] = Converter.from_dict({'rules': rules})
+        if len(_converters) > PIPELINES:
+            _converters.popitem(last=False)
+    else:
+        _converters.move_to_end(key)
+
+    data, diff, many = pickle.loads(payload)
+    if many:
+        diff = converter.apply_many(data, diff)
+    else:
+        diff = converter.apply(data, diff)
+    return pickle.dumps((data, diff), pickle.HIGHEST_PROTOCOL)
+
+
+class OffloadError(Exception):
+    pass
+
+
+class FactoryOffload:
+
+    """
+    Pool of worker processes applying the factory pipelines too costly to be
+    applied in the event loop (regexes over large strings, large lists...),
+    which would stall the bus and raft heartbeats.
+    Each worker keeps the last converters it compiled, the resolved rules are
+    only sent to a worker missing them.
+    """
+
+    OFFLOAD_SIZE = 1000000
+    # Fields read by the rules, besides their 'fieldname'
+    OPERANDS = ('operand1', 'operand2')
+
+    def __init__(self, workers=2, offload_size=OFFLOAD_SIZE, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.workers = workers
+        self.offload_size = offload_size
+        self._executor = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            # Fork the workers now, not while a factory task is waiting
+            for _ in range(self.workers):
+                self._executor.submit(_warm)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    @classmethod
+    def cost(cls, rules, data):
+        """
+        Estimate the cost of applying `rules` on a dict: the size (characters
+        or items) of the fields they read, once per rule.
+        """
+        total = 0
+        for rule in rules:
+            if rule['type'] == 'condition-block':
+                # A single condition is applied
+                total += max(
+                    cls.cost(condition.get('rules', []), data)
+                    for condition in rule['conditions']
+                )
+                continue
+            fields = [rule.get('fieldname')] + [
+                rule[operand][1:] for operand in cls.OPERANDS
+                if isinstance(rule.get(operand), str)
+                and rule[operand].startswith('@')
+            ]
+            for field in fields:
+                value = data.get(field)
+                if isinstance(value, (str, bytes, list, dict)):
+                    total += len(value)
+        return total
+
+    def offloads(self, rules, data, many=False):
+        """
+        Return True if the rules must be applied in a worker, `data` being a
+        list of records if `many` is True.
+        """
+        if self._executor is None:
+            return False
+        if many:
+            first = next((item for item in data if isinstance(item, dict)), {})
+            cost = len(data) * self.cost(rules, first)
+        else:
+            cost = self.cost(rules, data)
+        return cost >= self.offload_size
+
+    async def _run(self, key, rules, payload):
+        try:
+            return await self._loop.run_in_executor(
+                self._executor, _apply, key, rules, payload
+            )
+        except BrokenProcessPool as exc:
+            log.error('Factory worker pool is broken, restarting it')
+            self.stop()
+            self.start()
+            raise OffloadError(exc)
+
+    async def apply(self, pipeline, data, diff, many=False):
+        """
+        Apply a `Pipeline` in a worker on a dict (or a list of records if
+        `many` is True), update it in-place and return the same diff as
+        `Converter.apply()` (or `Converter.apply_many()`).
+        """
+        try:
+            payload = pickle.dumps((data, diff, many), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as exc:
+            raise OffloadError(exc)
+
+        result = await self._run(pipeline.key, None, payload)
+        if result is None:
+            result = await self._run(pipeline.key, pipeline.rules, payload)
+        converted, diff = pickle.loads(result)
+        if many:
+            data[:] = converted
+        else:
+            data.clear()
+            data.update(converted)
+        return diff
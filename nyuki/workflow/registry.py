@@ -0,0 +1,61 @@
+from .db.workflow_templates import TemplateState
+
+
+class TemplateRegistry:
+
+    """
+    Share a single template dict between all the running instances of a
+    published template version, instead of one copy per instance.
+    Drafts (and rescued reports) are never shared since their content may
+    change under the same version.
+    """
+
+    SHARED_STATES = (TemplateState.ACTIVE.value, TemplateState.ARCHIVED.value)
+
+    def __init__(self):
+        # key -> [template, number of instances using it]
+        self._templates = {}
+
+    def __len__(self):
+        return len(self._templates)
+
+    @classmethod
+    def key(cls, template):
+        """
+        Return the key identifying a published template version, or None.
+        """
+        if template.get('state') not in cls.SHARED_STATES:
+            return
+        return (
+            template['id'],
+            template.get('version'),
+            # Metadata can be updated without a new version
+            template.get('title'),
+            tuple(template.get('tags') or ()),
+        )
+
+    def intern(self, template):
+        """
+        Return the shared template dict equal to `template`.
+        """
+        key = self.key(template)
+        if key is None:
+            return template
+        try:
+            entry = self._templates[key]
+        except KeyError:
+            entry = self._templates[key] = [template, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, template):
+        """
+        Forget a template once no running instance uses it anymore.
+        """
+        key = self.key(template)
+        entry = self._templates.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._templates[key]
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from aiohttp import ClientSession, TCPConnector
+
+
+log = logging.getLogger(__name__)
+
+
+class RemoteEngines:
+
+    """
+    Keep-alive HTTP connections to the workflow engines of other services,
+    shared by the trigger_workflow tasks.
+    The variables required by their templates are cached with their ETag
+    (the template version) and only fetched again when their engine answers
+    that they changed.
+    """
+
+    CONNECTIONS = 50
+    KEEPALIVE = 30
+    VARS = 256
+
+    def __init__(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._session = None
+        # Vars URL -> (ETag, keys), least recently used first
+        self._vars = OrderedDict()
+
+    def __len__(self):
+        return len(self._vars)
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.CONNECTIONS,
+                    keepalive_timeout=self.KEEPALIVE,
+                    loop=self._loop,
+                ),
+                loop=self._loop,
+            )
+        return self._session
+
+    async def vars(self, url):
+        """
+        Return the variables required by a template from its vars URL.
+        """
+        cached = self._vars.get(url)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 304 and cached:
+                self._vars.move_to_end(url)
+                return cached[1]
+            if response.status != 200:
+                raise RuntimeError("Can't load template info")
+            keys = await response.json()
+            etag = response.headers.get('ETag')
+
+        if etag:
+            self._vars[url] = (etag, keys)
+            self._vars.move_to_end(url)
+            if len(self._vars) > self.VARS:
+                self._vars.popitem(last=False)
+        else:
+            self._vars.pop(url, None)
+        return keys
+
+    async def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        self._vars.clear()
@@ -0,0 +1,142 @@
+import json
+import asyncio
+import logging
+import aiohttp
+
+from nyuki.utils import serialize_object
+
+
+log = logging.getLogger(__name__)
+
+
+def assign(items, weights):
+    """
+    Distribute `items` over the keys of `weights` using a smooth weighted
+    round-robin, returning a dict {key: [items]}.
+    """
+    total = sum(weights.values())
+    current = {key: 0 for key in weights}
+    assigned = {key: [] for key in weights}
+    if not weights:
+        return assigned
+    for item in items:
+        for key, weight in weights.items():
+            current[key] += weight
+        chosen = max(current, key=current.get)
+        current[chosen] -= total
+        assigned[chosen].append(item)
+    return assigned
+
+
+class RescueClient:
+
+    """
+    Send workflow reports to rescuers over a pool of HTTP connections, with
+    at most `parallelism` requests at once and up to `batch_size` reports
+    per request (POST /v1/workflow/rescue).
+    """
+
+    TIMEOUT = 30.0
+
+    def __init__(self, port, parallelism=10, batch_size=50, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._port = port
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(parallelism, loop=self._loop)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=parallelism, loop=self._loop),
+            loop=self._loop,
+        )
+
+    async def close(self):
+        await self._session.close()
+
+    def _url(self, ipv4, path):
+        return 'http://{}:{}/v1/workflow/{}'.format(ipv4, self._port, path)
+
+    async def _weight(self, ipv4):
+        """
+        The less workflows a rescuer runs or queues, the more it gets.
+        Return None if its load could not be fetched.
+        """
+        try:
+            async with self._semaphore:
+                async with self._session.get(
+                    self._url(ipv4, 'queue'), timeout=self.TIMEOUT
+                ) as resp:
+                    if resp.status != 200:
+                        return
+                    load = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            log.warning('Could not fetch the load of %s: %s', ipv4, exc)
+            return
+        return 1 / (1 + load.get('running', 0) + load.get('queued', 0))
+
+    async def weights(self, rescuers):
+        """
+        Rescuers whose load is unknown (unreachable or failing) get half the
+        smallest known weight, to be sent less than any healthy one.
+        """
+        weights = dict(zip(rescuers, await asyncio.gather(
+            *[self._weight(ipv4) for ipv4 in rescuers], loop=self._loop
+        )))
+        known = [weight for weight in weights.values() if weight is not None]
+        unknown = min(known) / 2 if known else 1
+        return {
+            ipv4: unknown if weight is None else weight
+            for ipv4, weight in weights.items()
+        }
+
+    async def _send(self, ipv4, reports):
+        """
+        Send a batch of reports, return the ids of the rescued workflows.
+        """
+        data = json.dumps(reports, default=serialize_object)
+        try:
+            async with self._semaphore:
+                async with self._session.post(
+                    self._url(ipv4, 'rescue'),
+                    headers={'Content-Type': 'application/json'},
+                    data=data, timeout=self.TIMEOUT,
+                ) as resp:
+                    if resp.status != 200:
+                        log.warning(
+                            'Rescuer %s answered %s', ipv4, resp.status
+                        )
+                        return set()
+                    statuses = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            log.warning('Could not send workflows to %s: %s', ipv4, exc)
+            return set()
+        # 409: the workflow is already running on this rescuer
+        return {
+            uid for uid, status in statuses.items() if status in (200, 409)
+        }
+
+    async def rescue(self, reports, rescuers):
+        """
+        Dispatch the reports {uid: report} over the rescuers, trying the
+        other rescuers for the failing ones.
+        Return the set of rescued workflow ids.
+        """
+        weights = await self.weights(rescuers)
+        rescued = set()
+        pending = list(reports)
+        while pending and weights:
+            jobs = []
+            batches = []
+            for ipv4, uids in assign(pending, weights).items():
+                for i in range(0, len(uids), self.batch_size):
+                    batch = uids[i:i + self.batch_size]
+                    batches.append((ipv4, batch))
+                    jobs.append(
+                        self._send(ipv4, [reports[uid] for uid in batch])
+                    )
+            results = await asyncio.gather(*jobs, loop=self._loop)
+            for (ipv4, batch), done in zip(batches, results):
+                rescued |= done
+                # Rescuers failing once are not tried again
+                if len(done) < len(batch):
+                    weights.pop(ipv4, None)
+            pending = [uid for uid in pending if uid not in rescued]
+        return rescued
@@ -0,0 +1,165 @@
+import re
+import json
+import logging
+from collections import OrderedDict, namedtuple
+
+from nyuki.utils import Converter
+from nyuki.utils.lookup import LookupMode, LookupTable
+
+
+log = logging.getLogger(__name__)
+
+
+# A compiled factory config, along with its resolved rules (regexes and
+# lookup tables included) and a key identifying them until invalidated
+Pipeline = namedtuple('Pipeline', ['key', 'converter', 'rules'])
+
+
+class FactoryRuleCache:
+
+    """
+    Regexes (compiled) and lookup tables used by the factory tasks, read from
+    the storage on first use and kept in memory until invalidated by the
+    factory API (locally or from a replica over the bus).
+    The compiled `Converter` of the last `PIPELINES` factory configs are kept
+    as well.
+    """
+
+    KINDS = ('regexes', 'lookups')
+    PIPELINES = 256
+
+    def __init__(self, storage):
+        self._storage = storage
+        # (regex id, flags) -> compiled regex
+        self._regexes = {}
+        # (lookup id, mode, icase) -> LookupTable
+        self._lookups = {}
+        # factory rules (as JSON) -> Pipeline, least recently used first
+        self._converters = OrderedDict()
+        # Bumped on invalidation, so that a rule read from the storage before
+        # an update is not cached after it
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._regexes) + len(self._lookups)
+
+    async def regex(self, regex_id, flags=0):
+        """
+        Return the compiled regex for id `regex_id`.
+        """
+        try:
+            return self._regexes[(regex_id, flags)]
+        except KeyError:
+            pass
+
+        generation = self._generation
+        regex = await self._storage.regexes.get_one(regex_id)
+        if not regex:
+            raise RuntimeError(
+                'Could not find regex with id {}'.format(regex_id)
+            )
+        compiled = re.compile(regex['pattern'], flags=flags)
+        if generation == self._generation:
+            self._regexes[(regex_id, flags)] = compiled
+        return compiled
+
+    async def lookup(self, lookup_id, mode=LookupMode.EXACT, icase=False):
+        """
+        Return the lookup table for id `lookup_id`, indexed for `mode`.
+        """
+        mode = LookupMode(mode)
+        if mode is LookupMode.ICASE:
+            mode, icase = LookupMode.EXACT, True
+        key = (lookup_id, mode, bool(icase))
+        try:
+            return self._lookups[key]
+        except KeyError:
+            pass
+
+        generation = self._generation
+        pairs = await self._storage.lookups.pairs(lookup_id)
+        if pairs is None:
+            raise RuntimeError(
+                'Could not find lookup table with id {}'.format(lookup_id)
+            )
+        table = LookupTable(pairs, mode, icase)
+        if generation == self._generation:
+            self._lookups[key] = table
+        return table
+
+    async def resolve(self, rules):
+        """
+        Return a copy of factory rules with the regex and lookup IDs swapped
+        for their compiled equivalent.
+        """
+        resolved = []
+        for rule in rules:
+            if rule['type'] in ['extract', 'sub']:
+                rule = rule.copy()
+                rule['pattern'] = await self.regex(
+                    rule.pop('regex_id'), rule.pop('flags', 0)
+                )
+            elif rule['type'] == 'lookup':
+                rule = rule.copy()
+                rule['table'] = await self.lookup(
+                    rule.pop('lookup_id'),
+                    rule.get('mode', LookupMode.EXACT),
+                    rule.get('icase', False),
+                )
+            elif rule['type'] == 'condition-block':
+                conditions = []
+                for condition in rule['conditions']:
+                    conditions.append({
+                        **condition,
+                        'rules': await self.resolve(condition['rules']),
+                    })
+                rule = {**rule, 'conditions': conditions}
+            resolved.append(rule)
+        return resolved
+
+    async def pipeline(self, config):
+        """
+        Return the `Pipeline` compiled from a factory task config.
+        """
+        key = json.dumps(config['rules'], sort_keys=True)
+        try:
+            pipeline = self._converters[key]
+        except KeyError:
+            pass
+        else:
+            self._converters.move_to_end(key)
+            return pipeline
+
+        generation = self._generation
+        rules = await self.resolve(config['rules'])
+        pipeline = Pipeline(
+            (generation, key), Converter.from_dict({'rules': rules}), rules
+        )
+        if generation == self._generation:
+            self._converters[key] = pipeline
+            if len(self._converters) > self.PIPELINES:
+                self._converters.popitem(last=False)
+        return pipeline
+
+    async def converter(self, config):
+        """
+        Return the `Converter` compiled from a factory task config.
+        Converters are shared and must only be applied.
+        """
+        return (await self.pipeline(config)).converter
+
+    def invalidate(self, kind, rule_id=None):
+        """
+        Forget a regex or lookup table, or all of them if `rule_id` is None.
+        """
+        if kind not in self.KINDS:
+            raise ValueError('unknown rule kind {}'.format(kind))
+        self._generation += 1
+        # Any converter could use this rule
+        self._converters.clear()
+        cache = self._lookups if kind == 'lookups' else self._regexes
+        if rule_id is None:
+            cache.clear()
+        else:
+            for key in [key for key in cache if key[0] == rule_id]:
+                del cache[key]
@@ -1,12 +1,11 @@
 import asyncio
 import logging
-from aiohttp import ClientSession
-from copy import deepcopy
 from tukio.task import register
 from tukio.task.holder import TaskHolder
 
-from nyuki.utils import Converter
-from nyuki.utils.transform import Arithmetic
+from nyuki.utils.lookup import LookupMode
+from nyuki.utils.transform import Arithmetic, DiffMode
+from nyuki.workflow.offload import OffloadError
 from nyuki.workflow.tasks.utils import runtime, generate_factory_schema
 
 
@@ -33,7 +32,11 @@ FACTORY_SCHEMAS = {
             'type': {'type': 'string', 'enum': ['lookup']},
             'fieldname': {'type': 'string', 'minLength': 1},
             'lookup_id': {'type': 'string', 'minLength': 1},
-            'icase': {'type': 'boolean'}
+            'icase': {'type': 'boolean'},
+            'mode': {
+                'type': 'string',
+                'enum': [mode.value for mode in LookupMode]
+            }
         }
     },
     'set': {
@@ -119,74 +122,83 @@ FACTORY_SCHEMAS = {
 @register('factory', 'execute')
 class FactoryTask(TaskHolder):
 
-    __slots__ = ('api_url', 'session')
+    __slots__ = ()
 
-    SCHEMA = generate_factory_schema(**FACTORY_SCHEMAS)
-
-    def __init__(self, config):
-        super().__init__(config)
-        self.api_url = 'http://localhost:{}/v1/workflow'.format(
-            runtime.config['api']['port']
-        )
-        self.session = None
+    SCHEMA = generate_factory_schema(schema={
+        'type': 'object',
+        'properties': {
+            'diff': {
+                'type': 'string',
+                'enum': [mode.value for mode in DiffMode],
+                'description': (
+                    "Detail of the diff reported in the task's data, "
+                    "'full' by default, 'summary' by default with 'records'"
+                )
+            },
+            # Apply the rules on each record of this list field instead
+            'records': {'type': 'string', 'minLength': 1},
+            # Records processed between two yields to the event loop
+            'chunk_size': {'type': 'integer', 'minimum': 1}
+        }
+    }, **FACTORY_SCHEMAS)
 
-    async def get_regex(self, rule):
+    @property
+    def diff_mode(self):
         """
-        Query the nyuki to get the actual regexes from their IDs
+        Diff mode from the config, defaulting to a summary over records
         """
-        url = '{}/regexes/{}'.format(self.api_url, rule['regex_id'])
-        async with self.session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(
-                    'Could not find regex with id {}'.format(
-                        rule['regex_id']
-                    )
-                )
-            data = await resp.json()
-            rule['pattern'] = data['pattern']
-            del rule['regex_id']
+        default = DiffMode.SUMMARY if 'records' in self.config \
+            else DiffMode.FULL
+        return self.config.get('diff', default)
 
-    async def get_lookup(self, rule):
+    async def apply_many(self, converter, records, diff):
         """
-        Query the nyuki to get the actual lookup tables from their IDs
+        Apply the rules on a list of records, chunk by chunk, and return
+        the aggregated diff
         """
-        url = '{}/lookups/{}'.format(self.api_url, rule['lookup_id'])
-        async with self.session.get(url) as resp:
-            if resp.status != 200:
-                raise RuntimeError(
-                    'Could not find lookup table with id {}'.format(
-                        rule['lookup_id']
-                    )
-                )
-            data = await resp.json()
-            rule['table'] = {
-                field['value']: field['replace']
-                for field in data['table']
-            }
-            del rule['lookup_id']
+        chunk_size = self.config.get('chunk_size') or len(records) or 1
+        aggregate = converter.apply_many(records[:chunk_size], diff)
+        for start in range(chunk_size, len(records), chunk_size):
+            await asyncio.sleep(0)
+            aggregate = converter.apply_many(
+                records[start:start + chunk_size], diff, aggregate
+            )
+        return aggregate
 
-    async def get_factory_rules(self, config):
+    async def offload(self, pipeline, data, mode, many=False):
         """
-        Iterate through the task's configuration to swap from their IDs to
-        their database equivalent within the nyuki
+        Apply the rules in a worker process if they are too costly to be
+        applied in the event loop, return the diff or None if they are not
         """
-        for rule in config['rules']:
-            if rule['type'] in ['extract', 'sub']:
-                await self.get_regex(rule)
-            elif rule['type'] == 'lookup':
-                await self.get_lookup(rule)
-            elif rule['type'] == 'condition-block':
-                for condition in rule['conditions']:
-                    await self.get_factory_rules(condition)
+        offload = getattr(runtime, 'offload', None)
+        if offload is None or not offload.offloads(pipeline.rules, data, many):
+            return
+        try:
+            return await offload.apply(pipeline, data, mode, many)
+        except OffloadError as exc:
+            log.warning('Factory: could not offload the conversion: %s', exc)
 
     async def execute(self, event):
         data = event.data
-        runtime_config = deepcopy(self.config)
-        async with ClientSession() as self.session:
-            await self.get_factory_rules(runtime_config)
-        log.debug('Full factory config: %s', runtime_config)
-
-        converter = Converter.from_dict(runtime_config)
-        data['diff'] = converter.apply(data)
+        pipeline = await runtime.rules.pipeline(self.config)
+        mode = self.diff_mode
+        if 'records' not in self.config:
+            diff = await self.offload(pipeline, data, mode)
+            if diff is None:
+                diff = pipeline.converter.apply(data, mode)
+        else:
+            records = data.get(self.config['records'])
+            if not isinstance(records, list):
+                log.debug(
+                    "Factory: records field '%s' is not a list, ignoring",
+                    self.config['records'],
+                )
+                records = []
+            diff = await self.offload(pipeline, records, mode, many=True)
+            if diff is None:
+                diff = await self.apply_many(
+                    pipeline.converter, records, mode
+                )
+        data['diff'] = diff
         log.debug('Conversion diff: %s', data['diff'])
         return data
@@ -1,5 +1,6 @@
 import logging
 import asyncio
+from collections import OrderedDict
 from tukio import Workflow
 from tukio.task import register
 from tukio.task.holder import TaskHolder
@@ -11,29 +12,97 @@ from nyuki.workflow.tasks.utils import generate_factory_schema
 log = logging.getLogger(__name__)
 
 
-class TaskConditionBlock(ConditionBlock):
+class DecisionTable:
 
     """
-    Overrides work on ConditionBlock from the factory task to
-    set next workflow tasks.
+    Task selector rules compiled into the branches that can decide the next
+    tasks. As the last selection wins, blocks are tried from the last one
+    and the first selection found is kept; the conditions of a block are
+    tried in order until one validates. Blocks hidden by a block always
+    selecting tasks and conditions selecting nothing at the end of a block
+    are dropped.
+    Each table counts how often its branches are selected.
     """
 
-    def __init__(self, conditions, workflow):
-        super().__init__(conditions)
-        self._workflow = workflow
-        self._selected = None
+    __slots__ = ('_blocks', 'counts')
+
+    NONE = 'none'
+    TABLES = 1024
+    # id(config) -> (config, table), least recently used first
+    _tables = OrderedDict()
 
-    def condition_validated(self, rules, data):
+    def __init__(self, rules):
+        # Blocks of (evaluate or None, tasks or None, branch name)
+        self._blocks = []
+        for index in reversed(range(len(rules))):
+            block = rules[index]
+            if block['type'] == 'task-selector':
+                name = 'rules[{}]'.format(index)
+                self._blocks.append(((None, block['tasks'], name),))
+                break
+            if block['type'] != 'condition-block':
+                continue
+
+            conditions = block['conditions']
+            evaluators = ConditionBlock(conditions)._evaluators
+            branches = []
+            for position, condition in enumerate(conditions):
+                # Only the first rule of a condition selects tasks
+                selectors = condition.get('rules')
+                branches.append((
+                    evaluators[position],
+                    selectors[0]['tasks'] if selectors else None,
+                    'rules[{}].conditions[{}]'.format(index, position),
+                ))
+            while branches and branches[-1][1] is None:
+                branches.pop()
+            if not branches:
+                continue
+            self._blocks.append(tuple(branches))
+            # This block always selects tasks
+            if branches[-1][0] is None and all(
+                tasks is not None for _, tasks, _ in branches
+            ):
+                break
+
+        self.counts = OrderedDict(
+            (name, 0) for block in self._blocks for _, _, name in block
+        )
+        self.counts[self.NONE] = 0
+
+    @classmethod
+    def get(cls, config):
         """
-        Set next workflow tasks upon validating a condition.
+        Return the table compiled from a task selector config, shared by all
+        the tasks holding this config.
         """
-        if rules:
-            self._workflow.set_next_tasks(rules[0]['tasks'])
-            self._selected = rules[0]['tasks']
-
-    def apply(self, data):
-        super().apply(data)
-        return self._selected
+        key = id(config)
+        entry = cls._tables.get(key)
+        # The config is kept along, its id can't be reused
+        if entry is not None and entry[0] is config:
+            cls._tables.move_to_end(key)
+            return entry[1]
+
+        table = cls(config['rules'])
+        cls._tables[key] = (config, table)
+        if len(cls._tables) > cls.TABLES:
+            cls._tables.popitem(last=False)
+        return table
+
+    def select(self, data):
+        """
+        Return the name of the branch selected by `data` and its tasks, or
+        (None, None).
+        """
+        for block in self._blocks:
+            for evaluate, tasks, name in block:
+                if evaluate is None or evaluate(data):
+                    if tasks is None:
+                        break
+                    self.counts[name] += 1
+                    return name, tasks
+        self.counts[self.NONE] += 1
+        return None, None
 
 
 @register('task_selector', 'execute')
@@ -57,20 +126,16 @@ class TaskSelector(TaskHolder):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._table = None
+        self._branch = None
         self._selected = None
 
     async def execute(self, event):
         data = event.data
-        workflow = Workflow.current_workflow()
-        self._selected = None
-        for block in self.config['rules']:
-            if block['type'] == 'task-selector':
-                workflow.set_next_tasks(block['tasks'])
-                self._selected = block['tasks']
-            elif block['type'] == 'condition-block':
-                selected = TaskConditionBlock(block['conditions'], workflow).apply(data)
-                if selected is not None:
-                    self._selected = selected
+        self._table = DecisionTable.get(self.config)
+        self._branch, self._selected = self._table.select(data)
+        if self._selected is not None:
+            Workflow.current_workflow().set_next_tasks(self._selected)
 
         task = asyncio.Task.current_task()
         task.dispatch_progress({'tasks': self._selected})
@@ -78,4 +143,9 @@ class TaskSelector(TaskHolder):
         return data
 
     def report(self):
-        return {'tasks': self._selected}
+        return {
+            'tasks': self._selected,
+            'branch': self._branch,
+            # Selections of each branch by all the tasks with this config
+            'selections': dict(self._table.counts) if self._table else {},
+        }
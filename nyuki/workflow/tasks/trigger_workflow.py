@@ -1,12 +1,16 @@
 import json
 import asyncio
 import logging
+from copy import deepcopy
 from enum import Enum
-from aiohttp import ClientSession
 from tukio.task import register
 from tukio.task.holder import TaskHolder
-from tukio.workflow import WorkflowExecState, Workflow
+from tukio.workflow import (
+    WorkflowExecState, Workflow, WorkflowTemplate, WorkflowRootTaskError
+)
 
+from nyuki.workflow.admission import AdmissionRejected
+from nyuki.workflow.db.workflow_templates import required_keys
 from .utils import runtime
 from .utils.uri import URI
 
@@ -80,6 +84,14 @@ class TriggerWorkflowTask(TaskHolder):
             self.async_future.set_result(data)
         await runtime.bus.unsubscribe(topic)
 
+    @property
+    def local(self):
+        """
+        Workflows of this service are started without any HTTP request.
+        """
+        service = runtime.config.get('service') or runtime.bus.name
+        return self.template['service'] == service
+
     async def execute(self, event):
         """
         Entrypoint execution method.
@@ -88,20 +100,98 @@ class TriggerWorkflowTask(TaskHolder):
         self.task = asyncio.Task.current_task()
         is_draft = self.template.get('draft', False)
 
-        # Send the HTTP request
         log.info('Triggering template %s%s on service %s', self.template['id'],
                  ' (draft)' if is_draft else '', self.template['service'])
 
-        # Setup headers (set requester and exec-track to avoid workflow loops)
+        # Set requester and exec-track to avoid workflow loops
         workflow = runtime.workflows[Workflow.current_workflow().uid]
         parent = workflow.exec.get('requester')
         track = list(workflow.exec.get('track', []))
         if parent:
             track.append(parent)
+        requester = URI.instance(workflow.instance)
+
+        if self.local:
+            await self._trigger_local(is_draft, track, requester)
+        else:
+            await self._trigger_remote(is_draft, track, requester)
+
+        wf_id = '@'.join([self.triggered_id[:8], self.template['service']])
+        self.status = WorkflowStatus.RUNNING.value
+        log.info('Successfully started %s', wf_id)
+        self.task.dispatch_progress(self.report())
+
+        # Block until task completed
+        if self.blocking:
+            log.info('Waiting for workflow %s to complete', wf_id)
+            await asyncio.wait([self.async_future])
+            self.status = WorkflowStatus.DONE.value
+            log.info('Workflow %s is done', wf_id)
+            self.task.dispatch_progress({'status': self.status})
+
+        return self.data
+
+    def _error(self, reason):
+        return RuntimeError(
+            "Can't process workflow template {} on {}, reason: {}".format(
+                self.template, self.template['service'], reason
+            )
+        )
+
+    async def _trigger_local(self, is_draft, track, requester):
+        """
+        Start the workflow in this nyuki, as its instances API would.
+        """
+        nyuki = runtime.nyuki
+        template = await nyuki.storage.get_template(
+            self.template['id'], draft=is_draft
+        )
+        if not template:
+            raise self._error('Could not find a suitable template to run')
+
+        wf_tmpl = WorkflowTemplate.from_dict(template)
+        try:
+            wf_tmpl.root()
+        except WorkflowRootTaskError:
+            raise self._error('More than one root task')
+        if URI.in_track(track, wf_tmpl.uid):
+            raise self._error('Loop detected between workflows')
 
+        # Only send the data the sub-workflow needs
+        keys = template.get('required_keys')
+        if keys is None:
+            keys = required_keys(template.get('tasks', []))
+        # (a copy, as the HTTP API would get: tukio only copies the top
+        # level of the data given to each task)
+        lightened_data = deepcopy({
+            key: self.data[key] for key in keys if key in self.data
+        })
+        if is_draft:
+            wflow = await nyuki.engine.run_once(wf_tmpl, lightened_data)
+        else:
+            try:
+                wflow = await nyuki.engine.trigger(wf_tmpl.uid, lightened_data)
+            except AdmissionRejected as exc:
+                raise self._error(
+                    'Too many workflows running ({})'.format(exc)
+                )
+        if wflow is None:
+            raise self._error(
+                'Could not start any workflow from this template'
+            )
+
+        nyuki.new_workflow(template, wflow, track=track, requester=requester)
+        self.triggered_id = wflow.uid
+        # Workflows are futures, resolved once ended or failed
+        self.async_future = wflow
+
+    async def _trigger_remote(self, is_draft, track, requester):
+        """
+        Start the workflow through the instances API of its service.
+        """
         headers = {
             'Content-Type': 'application/json',
-            'Referer': URI.instance(workflow.instance),
+            'Referer': requester,
             'X-Surycat-Exec-Track': ','.join(track)
         }
 
@@ -120,72 +210,60 @@ class TriggerWorkflowTask(TaskHolder):
                 asyncio.ensure_future(runtime.bus.unsubscribe(topic))
             self.task.add_done_callback(_unsub)
 
-        async with ClientSession() as session:
-            # Compute data to send to sub-workflows
-            url = '{}/vars/{}{}'.format(
-                self._engine,
-                self.template['id'],
-                '/draft' if is_draft else '',
-            )
-            async with session.get(url) as response:
-                if response.status != 200:
-                    raise RuntimeError("Can't load template info")
-                wf_vars = await response.json()
-            lightened_data = {
-                key: self.data[key]
-                for key in wf_vars
-                if key in self.data
-            }
-
-            params = {
-                'url': '{}/instances'.format(self._engine),
-                'headers': headers,
-                'data': json.dumps({
-                    'id': self.template['id'],
-                    'draft': is_draft,
-                    'inputs': lightened_data,
-                })
-            }
-            async with session.put(**params) as response:
-                if response.status != 200:
-                    log.critical(await response.text())
-                    msg = "Can't process workflow template {} on {}".format(
-                        self.template, self.nyuki_api
-                    )
-                    if response.status % 400 < 100:
-                        reason = await response.json()
-                        msg = "{}, reason: {}".format(msg, reason['error'])
-                    raise RuntimeError(msg)
-                resp_body = await response.json()
-                self.triggered_id = resp_body['id']
-
-        wf_id = '@'.join([self.triggered_id[:8], self.template['service']])
-        self.status = WorkflowStatus.RUNNING.value
-        log.info('Successfully started %s', wf_id)
-        self.task.dispatch_progress(self.report())
-
-        # Block until task completed
-        if self.blocking:
-            log.info('Waiting for workflow %s to complete', wf_id)
-            await self.async_future
-            self.status = WorkflowStatus.DONE.value
-            log.info('Workflow %s is done', wf_id)
-            self.task.dispatch_progress({'status': self.status})
+        # Compute data to send to sub-workflows
+        wf_vars = await runtime.remote.vars('{}/vars/{}{}'.format(
+            self._engine,
+            self.template['id'],
+            '/draft' if is_draft else '',
+        ))
+        lightened_data = {
+            key: self.data[key]
+            for key in wf_vars
+            if key in self.data
+        }
 
-        return self.data
+        params = {
+            'url': '{}/instances'.format(self._engine),
+            'headers': headers,
+            'data': json.dumps({
+                'id': self.template['id'],
+                'draft': is_draft,
+                'inputs': lightened_data,
+            })
+        }
+        async with runtime.remote.session.put(**params) as response:
+            if response.status != 200:
+                log.critical(await response.text())
+                msg = "Can't process workflow template {} on {}".format(
+                    self.template, self._engine
+                )
+                if response.status % 400 < 100:
+                    reason = await response.json()
+                    msg = "{}, reason: {}".format(msg, reason['error'])
+                raise RuntimeError(msg)
+            resp_body = await response.json()
+            self.triggered_id = resp_body['id']
 
     async def _end_triggered_workflow(self):
         """
         Asynchronously cancel the triggered workflow.
         """
         wf_id = '@'.join([self.triggered_id[:8], self.template['service']])
-        async with ClientSession() as session:
-            url = '{}/instances/{}'.format(self._engine, self.triggered_id)
-            async with session.delete(url) as response:
-                if response.status != 200:
-                    log.warning('Failed to cancel workflow %s', wf_id)
-                else:
-                    log.info('Workflow %s has been cancelled', wf_id)
+        if self.local:
+            try:
+                runtime.workflows[self.triggered_id].instance.cancel()
+            except KeyError:
+                log.warning('Failed to cancel workflow %s', wf_id)
+            else:
+                log.info('Workflow %s has been cancelled', wf_id)
+            return
+
+        url = '{}/instances/{}'.format(self._engine, self.triggered_id)
+        async with runtime.remote.session.delete(url) as response:
+            if response.status != 200:
+                log.warning('Failed to cancel workflow %s', wf_id)
+            else:
+                log.info('Workflow %s has been cancelled', wf_id)
 
     def teardown(self):
         """
@@ -39,6 +39,22 @@ class URI:
             template_id=template_id, holder=runtime.bus.name
         )
 
+    @classmethod
+    def in_track(cls, track, template_id):
+        """
+        Return True if a workflow of this template on this nyuki is one of
+        the requesters in `track` (a workflow loop).
+        """
+        for ancestor in track or []:
+            try:
+                info = cls.parse(ancestor)
+            except InvalidWorkflowUri:
+                continue
+            if (info.template_id == template_id and
+                    info.holder == runtime.bus.name):
+                return True
+        return False
+
     @classmethod
     def parse(cls, uri):
         result = re.match(cls.REGEX, uri)
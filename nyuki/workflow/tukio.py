@@ -1,21 +1,323 @@
-from tukio.task import TaskTemplate
+import asyncio
+import inspect
+import logging
+from uuid import uuid4
+from tukio import Engine
+from tukio.broker import get_broker
+from tukio.event import Event
+from tukio.task import TaskRegistry, TukioTask
 from tukio.workflow import WorkflowTemplate
 
+from .admission import AdmissionRejected, QueuedTrigger
+from .registry import TemplateRegistry
+
+
+log = logging.getLogger(__name__)
+
+
+class _LazyQueue:
+
+    """
+    The receiving queue of a task, only created when it is first used.
+    Most tasks never receive any event during their execution.
+    """
+
+    __slots__ = ('_loop', '_queue')
+
+    def __init__(self, loop):
+        self._loop = loop
+        self._queue = None
+
+    def __getattr__(self, name):
+        if self._queue is None:
+            self._queue = asyncio.Queue(loop=self._loop)
+        return getattr(self._queue, name)
+
+
+class _Committed:
+
+    """
+    Stand-in for the 'committed' event of a task, shared by all the tasks
+    until they are suspended (it is only ever read).
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def is_set():
+        return True
+
+
+COMMITTED = _Committed()
+
+
+class _Unlocked:
+
+    """
+    Stand-in for the lock of a workflow never locked by its overrun policy
+    (only 'skip-until-unlock' locks its instances).
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def locked():
+        return False
+
+
+UNLOCKED = _Unlocked()
+
+
+class _LazyEvent:
+
+    """
+    The 'committed' event of a workflow, only creating an `asyncio.Event`
+    when it is waited for while cleared (i.e the workflow is suspended).
+    """
+
+    __slots__ = ('_loop', '_value', '_event')
+
+    def __init__(self, value, loop):
+        self._loop = loop
+        self._value = value
+        self._event = None
+
+    def is_set(self):
+        if self._event is not None:
+            return self._event.is_set()
+        return self._value
+
+    def set(self):
+        if self._event is not None:
+            self._event.set()
+        self._value = True
+
+    def clear(self):
+        if self._event is not None:
+            self._event.clear()
+        self._value = False
+
+    async def wait(self):
+        if self.is_set():
+            return True
+        if self._event is None:
+            self._event = asyncio.Event(loop=self._loop)
+        return await self._event.wait()
+
+
+class NyukiTask(TukioTask):
+
+    """
+    A `TukioTask` creating its receiving queue on first use and its
+    'committed' event only when it is suspended, instead of both at init.
+    Running and finished tasks are kept by their workflow until it ends.
+    """
+
+    # `TukioTask` misspells this slot
+    __slots__ = ('_committed',)
+
+    def __init__(self, coro, *, loop=None):
+        # Same as `TukioTask.__init__()` (tukio 0.15), without the queue and
+        # the event
+        asyncio.Task.__init__(self, coro, loop=loop)
+        self.holder = inspect.getcoroutinelocals(coro).get('self')
+        try:
+            self.uid = self.holder.uid
+        except AttributeError:
+            self.uid = str(uuid4())
+        self._broker = get_broker(self._loop)
+        self._in_progress = False
+        self._template = None
+        self._workflow = None
+        self._source = None
+        self._start = None
+        self._end = None
+        self._inputs = None
+        self._outputs = None
+        self._queue = _LazyQueue(self._loop)
+        if self.holder:
+            self.holder.queue = self._queue
+        self._committed = COMMITTED
+        self._timed_out = False
+
+    def suspend(self):
+        self.cancel()
+        self._committed = asyncio.Event(loop=self._loop)
+
+
+def task_factory(loop, coro):
+    """
+    `tukio_factory()` creating `NyukiTask` instances.
+    """
+    try:
+        TaskRegistry.codes()[coro.cr_code]
+    except (KeyError, AttributeError):
+        return asyncio.Task(coro, loop=loop)
+    return NyukiTask(coro, loop=loop)
+
 
 class WorkflowSelector:
 
-    def __init__(self, storage):
+    """
+    Fetch the templates from the storage, keeping the last template dicts
+    (with their metadata) selected for each template id.
+    """
+
+    def __init__(self, storage, admission=None):
         self.storage = storage
+        self.admission = admission
+        self._templates = {}
+
+    def _from_dict(self, template):
+        cached = self._templates.get(template['id'])
+        key = TemplateRegistry.key(template)
+        # Published versions do not change, reuse the template already built
+        if (
+            key is not None and cached is not None
+            and TemplateRegistry.key(cached[1]) == key
+        ):
+            wf_template, template = cached
+        else:
+            wf_template = WorkflowTemplate.from_dict(template)
+            self._templates[wf_template.uid] = (wf_template, template)
+        if self.admission is not None:
+            self.admission.set_template_limit(
+                wf_template.uid, template.get('concurrency')
+            )
+        return wf_template
+
+    def template(self, wf_template):
+        """
+        Return the template dict a `WorkflowTemplate` was built from, if it is
+        still the last one selected for this template id.
+        """
+        try:
+            cached, template = self._templates[wf_template.uid]
+        except KeyError:
+            return
+        if cached is wf_template:
+            return template
 
     async def get(self, tmpl_id):
         template = await self.storage.get_template(
             tmpl_id, draft=False
         )
-        return WorkflowTemplate.from_dict(template)
+        if not template:
+            return
+        return self._from_dict(template)
 
     async def select(self, topic):
         templates = await self.storage.get_for_topic(topic)
-        return [
-            WorkflowTemplate.from_dict(template)
-            for template in templates
-        ]
+        return [self._from_dict(template) for template in templates]
+
+
+class WorkflowEngine(Engine):
+
+    """
+    Start new workflow instances through an admission queue, bounding the
+    number of workflows running at once.
+    Rescued and draft workflows (`rescue()` and `run_once()`) are not bound.
+    """
+
+    def __init__(self, *, admission, on_start=None, **kwargs):
+        super().__init__(**kwargs)
+        self._loop.set_task_factory(task_factory)
+        self.admission = admission
+        self.admission.start = self._start_queued
+        # Called with (template dict, workflow) for the instances started
+        # from the queue when nobody awaits them.
+        self.on_start = on_start
+
+    def _admit(self, template, event, waited=False):
+        """
+        Start a workflow if a slot is available, else return the queued
+        trigger.
+        """
+        if self._must_stop:
+            log.debug("The engine is stopping, cannot trigger new workflows")
+            return
+        if self.admission.acquire(template.uid):
+            return self._run_admitted(template, event)
+        raw = self._selector.template(template)
+        return self.admission.put(QueuedTrigger(
+            template, event, raw,
+            priority=raw.get('priority', 0) if raw else 0,
+            waited=waited, loop=self._loop,
+        ))
+
+    def _do_run(self, wflow, event):
+        super()._do_run(wflow, event)
+        self._slim(wflow)
+
+    def _slim(self, wflow):
+        """
+        Replace the lock and the 'committed' event created by each workflow
+        with lighter stand-ins, they are held until the workflow ends.
+        """
+        if not wflow.lock.locked():
+            wflow.lock = UNLOCKED
+        wflow._committed = _LazyEvent(wflow._committed.is_set(), self._loop)
+
+    def _run_admitted(self, template, event):
+        uid = template.uid
+        wflow = super()._try_run(template, event)
+        if wflow is None:
+            self.admission.release(uid)
+        else:
+            wflow.add_done_callback(lambda _: self.admission.release(uid))
+        return wflow
+
+    def _start_queued(self, entry):
+        wflow = self._run_admitted(entry.template, entry.event)
+        if entry.waited and not entry.future.done():
+            entry.future.set_result(wflow)
+        # Nobody is waiting for this instance (anymore)
+        elif wflow is not None and self.on_start:
+            self.on_start(entry.raw, wflow)
+
+    def _try_run(self, template, event):
+        try:
+            wflow = self._admit(template, event)
+        except AdmissionRejected as exc:
+            log.warning(
+                'Workflow trigger for template %s rejected: %s',
+                template.uid[:8], exc,
+            )
+            return
+        return wflow if not isinstance(wflow, QueuedTrigger) else None
+
+    async def rescue(self, template, report):
+        wflow = await super().rescue(template, report)
+        if wflow is not None:
+            self._slim(wflow)
+        return wflow
+
+    async def trigger(self, template_id, data):
+        """
+        Trigger a new workflow, waiting for a free slot if necessary.
+        Raise `AdmissionRejected` if the admission queue is full.
+        """
+        with await self._lock:
+            template = await self._selector.get(template_id)
+            if not template:
+                return None
+            wflow = self._admit(template, Event(data), waited=True)
+        if isinstance(wflow, QueuedTrigger):
+            return await wflow.future
+        return wflow
+
+    async def requeue(self, template_id, data):
+        """
+        Trigger a workflow spilled out of the admission queue.
+        """
+        with await self._lock:
+            template = await self._selector.get(template_id)
+            if not template:
+                return
+            wflow = self._try_run(template, Event(data))
+        if wflow is not None and self.on_start:
+            self.on_start(self._selector.template(template), wflow)
+
+    def stop(self, force=False):
+        self.admission.clear()
+        return super().stop(force=force)
@@ -1,20 +1,19 @@
-import json
 import asyncio
 import logging
-import pickle
-import aiohttp
+from pymongo.errors import AutoReconnect
 from uuid import uuid4
 from copy import deepcopy
-from random import shuffle
-from datetime import datetime
-from tukio import Engine, TaskRegistry, get_broker, EXEC_TOPIC
+from functools import partial
+from tukio import TaskRegistry, get_broker, EXEC_TOPIC
 from tukio.workflow import Workflow, WorkflowExecState
 from tukio.task.factory import TaskExecState
+from tukio.utils import FutureState
 
 from nyuki import Nyuki
-from nyuki.memory import memsafe
-from nyuki.utils import serialize_object, utcnow
+from nyuki.memory import CodecError, memsafe
+from nyuki.utils import bson_safe, serialize_object, utcnow
 from nyuki.workflow.db.storage import MongoStorage
+from nyuki.workflow.db.history import HistoryWriter
 from nyuki.workflow.db.migrations import run_migrations
 from nyuki.workflow.db.task_instances import WS_FILTERS
 
@@ -29,7 +28,7 @@ from .api.instances import (
     ApiWorkflow, ApiWorkflows, ApiWorkflowsHistory, ApiWorkflowHistory,
     ApiWorkflowTriggers, ApiWorkflowTrigger, ApiWorkflowHistoryTask,
     ApiWorkflowHistoryTaskData, ApiTaskReporting, ApiTaskReportingContact,
-    ApiTaskReportingContacts,
+    ApiTaskReportingContacts, ApiWorkflowQueue, ApiWorkflowRescue,
 )
 from .api.vars import (
     ApiVars, ApiVarsVersion, ApiVarsDraft
@@ -37,7 +36,15 @@ from .api.vars import (
 
 from .tasks import *
 from .tasks.utils import runtime, CONTACT_PROGRESS
-from .tukio import WorkflowSelector
+from .admission import AdmissionQueue, OverflowPolicy
+from .coalesce import ProgressCoalescer
+from .index import RunningIndex
+from .registry import TemplateRegistry
+from .rules import FactoryRuleCache
+from .offload import FactoryOffload
+from .remote import RemoteEngines
+from .rescue import RescueClient
+from .tukio import WorkflowEngine, WorkflowSelector
 
 
 log = logging.getLogger(__name__)
@@ -55,20 +62,35 @@ def _serialize_workflow(wf):
     return wf.report()
 
 
-def sanitize_workflow_exec(obj):
+def sanitize_workflow_exec(obj, max_size=None):
     """
     Replace any object value by 'internal data' string to store in Mongo.
     """
-    types = [dict, list, tuple, str, int, float, bool, type(None), datetime]
-    if type(obj) not in types:
-        obj = 'Internal server data: {}'.format(type(obj))
-    elif isinstance(obj, dict):
-        for key, value in obj.items():
-            obj[key] = sanitize_workflow_exec(value)
-    elif isinstance(obj, list):
-        for item in obj:
-            item = sanitize_workflow_exec(item)
-    return obj
+    return bson_safe(obj, max_size=max_size)
+
+
+class ExecRecord:
+
+    """
+    Extra execution metadata of a workflow instance.
+    """
+
+    __slots__ = ('requester', 'track')
+
+    def __init__(self, requester=None, track=None):
+        self.requester = requester
+        self.track = track
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def as_dict(self):
+        return {
+            key: getattr(self, key)
+            for key in self.__slots__
+            if getattr(self, key) is not None
+        }
 
 
 class WorkflowInstance:
@@ -76,20 +98,25 @@ class WorkflowInstance:
     """
     Holds a workflow pair of template/instance.
     Allows retrieving a workflow exec state at any moment.
+    The template dict may be shared with other instances and must not be
+    modified.
     """
 
-    __slots__ = ('_template', '_instance', '_exec')
+    __slots__ = ('_template', '_instance', '_exec', '_written')
 
-    ALLOWED_EXEC_KEYS = ['requester', 'track']
+    ALLOWED_EXEC_KEYS = ExecRecord.__slots__
 
     def __init__(self, template, instance, **kwargs):
         self._template = template
         self._instance = instance
-        self._exec = {
+        self._exec = ExecRecord(**{
             key: kwargs[key]
             for key in kwargs
             if key in self.ALLOWED_EXEC_KEYS
-        }
+        })
+        # Task template id -> task exec id of the tasks already in history
+        # (only created once a task is written)
+        self._written = None
 
     @property
     def template(self):
@@ -103,13 +130,44 @@ class WorkflowInstance:
     def exec(self):
         return self._exec
 
-    def report(self, tasks=True, data=True):
+    @property
+    def written(self):
+        return self._written or {}
+
+    def task_report(self, task):
+        """
+        Return the report of a finished task merged with its template, and
+        remember it has been written into the history.
+        """
+        template = next(
+            tmpl for tmpl in self._template['tasks']
+            if tmpl['id'] == task.template.uid
+        )
+        report = {'template': deepcopy(template), **task.as_dict()}
+        if hasattr(task.holder, 'report'):
+            try:
+                report['reporting'] = task.holder.report()
+            except Exception as exc:
+                log.error('Exception on task reporting: %s', exc)
+        if self._written is None:
+            self._written = {}
+        self._written[template['id']] = report['id']
+        return report
+
+    def report(self, tasks=True, data=True, skip_written=False):
         """
         Merge a workflow exec instance report and its template.
+        The tasks already written into the history are left out if
+        `skip_written` is True.
         """
-        template = deepcopy(self._template)
+        # Only copy the parts of the shared template kept in the report
+        template = {
+            key: deepcopy(value)
+            for key, value in self._template.items()
+            if key != 'tasks' and (tasks is not False or key != 'graph')
+        }
         inst = self._instance.report()
-        inst['exec'].update(self._exec)
+        inst['exec'].update(self._exec.as_dict())
 
         result = {
             **inst['exec'],
@@ -117,11 +175,14 @@ class WorkflowInstance:
         }
 
         if tasks is False:
-            del result['template']['graph']
-            del result['template']['tasks']
             return result
 
-        tasks = {task['id']: {'template': task} for task in template['tasks']}
+        written = self.written if skip_written is True else {}
+        tasks = {
+            task['id']: {'template': deepcopy(task)}
+            for task in self._template['tasks']
+            if task['id'] not in written
+        }
         for task_dict in inst['tasks']:
             if not task_dict.get('exec'):
                 # Task was never started, create dummy exec dict.
@@ -148,7 +209,8 @@ class WorkflowInstance:
                     }
 
             # Add execution informations to each task.
-            tasks[task_dict['id']].update(task_dict['exec'])
+            if task_dict['id'] in tasks:
+                tasks[task_dict['id']].update(task_dict['exec'])
 
         result['template']['tasks'] = list(tasks.values())
         return result
@@ -178,6 +240,65 @@ class WorkflowNyuki(Nyuki):
             'topics': {
                 'type': 'array',
                 'items': {'type': 'string', 'minLength': 1}
+            },
+            'history': {
+                'type': 'object',
+                'properties': {
+                    'batch_size': {'type': 'integer', 'minimum': 1},
+                    'flush_interval': {'type': 'number', 'minimum': 0},
+                    'max_queue': {'type': 'integer', 'minimum': 1},
+                    'put_timeout': {
+                        'type': 'number',
+                        'minimum': 0,
+                        'description': (
+                            'Seconds a finished workflow or task waits for '
+                            'room in a full history queue (30 by default). '
+                            'It is dropped from the history after that, '
+                            'see the "history" counters of GET '
+                            '/v1/workflow/queue'
+                        )
+                    },
+                    'retries': {'type': 'integer', 'minimum': 1},
+                    'max_field_size': {'type': 'integer', 'minimum': 1},
+                }
+            },
+            'concurrency': {
+                'type': 'object',
+                'properties': {
+                    'limit': {'type': 'integer', 'minimum': 1},
+                    'templates': {
+                        'type': 'object',
+                        'additionalProperties': {
+                            'type': 'integer', 'minimum': 1,
+                        },
+                    },
+                    'queue_size': {'type': 'integer', 'minimum': 0},
+                    'overflow': {
+                        'type': 'string',
+                        'enum': [policy.value for policy in OverflowPolicy],
+                    },
+                }
+            },
+            'rescue': {
+                'type': 'object',
+                'properties': {
+                    'parallelism': {'type': 'integer', 'minimum': 1},
+                    'batch_size': {'type': 'integer', 'minimum': 1},
+                }
+            },
+            'websocket': {
+                'type': 'object',
+                'properties': {
+                    'progress_window': {'type': 'number', 'minimum': 0},
+                }
+            },
+            'factory': {
+                'type': 'object',
+                'properties': {
+                    # Worker processes for the costly factory conversions
+                    'workers': {'type': 'integer', 'minimum': 0},
+                    'offload_size': {'type': 'integer', 'minimum': 1},
+                }
             }
         }
     }
@@ -189,6 +310,8 @@ class WorkflowNyuki(Nyuki):
         ApiTemplateVersion,  # /v1/workflows/templates/{uid}/{version}
         ApiWorkflows,  # /v1/workflow/instances
         ApiWorkflow,  # /v1/workflow/instances/{uid}
+        ApiWorkflowQueue,  # /v1/workflow/queue
+        ApiWorkflowRescue,  # /v1/workflow/rescue
         ApiTaskReporting,  # /v1/workflow/instances/{uid}/tasks/{task_id}/reporting
         ApiTaskReportingContacts,  # /v1/workflow/instances/{uid}/tasks/{task_id}/reporting/contacts
         ApiTaskReportingContact,  # /v1/workflow/instances/{uid}/tasks/{task_id}/reporting/contacts/{contact_id}
@@ -216,6 +339,13 @@ class WorkflowNyuki(Nyuki):
         self.register_schema(self.CONF_SCHEMA)
         self.engine = None
         self.storage = MongoStorage()
+        self.history = None
+        # Compiled factory rules, read by the factory tasks
+        self.rules = FactoryRuleCache(self.storage)
+        # Process pool for the factory tasks, if configured
+        self.offload = None
+        # Connections to the other services, for the trigger_workflow tasks
+        self.remote = RemoteEngines(loop=self.loop)
 
         self.AVAILABLE_TASKS = {}
         for name, value in TaskRegistry.all().items():
@@ -223,10 +353,19 @@ class WorkflowNyuki(Nyuki):
 
         # Stores workflow instances with their template data
         self.running_workflows = {}
+        self.running_index = RunningIndex()
+        # Template dicts shared by the running instances
+        self.templates = TemplateRegistry()
+        self.progress = ProgressCoalescer(self.bus.publish, loop=self.loop)
 
         runtime.bus = self.bus
         runtime.config = self.config
         runtime.workflows = self.running_workflows
+        runtime.rules = self.rules
+        runtime.offload = None
+        runtime.remote = self.remote
+        # Workflows triggered on this service are started in-process
+        runtime.nyuki = self
 
     @property
     def mongo_config(self):
@@ -236,17 +375,70 @@ class WorkflowNyuki(Nyuki):
     def topics(self):
         return self.config.get('topics', [])
 
+    @property
+    def history_config(self):
+        return self.config.get('history', {})
+
+    @property
+    def rules_topic(self):
+        # Shared by all the replicas of this service
+        return '{}/factory/rules'.format(
+            self.config.get('service') or self.bus.name
+        )
+
+    @property
+    def concurrency_config(self):
+        return self.config.get('concurrency', {})
+
+    @property
+    def rescue_config(self):
+        return self.config.get('rescue', {})
+
+    @property
+    def websocket_config(self):
+        return self.config.get('websocket', {})
+
+    @property
+    def factory_config(self):
+        return self.config.get('factory', {})
+
     async def setup(self):
+        self.progress.window = self.websocket_config.get(
+            'progress_window', ProgressCoalescer.WINDOW
+        )
+        if self.factory_config.get('workers'):
+            # Forked before the Mongo client starts its threads
+            self.offload = FactoryOffload(
+                loop=self.loop, **self.factory_config
+            )
+            self.offload.start()
+            runtime.offload = self.offload
         self.storage.configure(**self.mongo_config)
         # Blocks until connection to Mongo is done.
         await self.storage.index()
         await run_migrations(**self.mongo_config)
-        selector = WorkflowSelector(self.storage)
-        self.engine = Engine(selector=selector, loop=self.loop)
+        self.history = HistoryWriter(self.storage, loop=self.loop, **{
+            key: value
+            for key, value in self.history_config.items()
+            if key != 'max_field_size'
+        })
+        self.history.start()
+        admission = AdmissionQueue(loop=self.loop, **self.concurrency_config)
+        admission.spill = self.spill_trigger
+        admission.refill = self.refill_triggers
+        admission.spilled = await self.storage.workflow_queue.count()
+        selector = WorkflowSelector(self.storage, admission)
+        self.engine = WorkflowEngine(
+            selector=selector, admission=admission,
+            on_start=self.new_workflow, loop=self.loop,
+        )
         for topic in self.topics:
             asyncio.ensure_future(self.bus.subscribe(
                 topic, self.workflow_event
             ))
+        asyncio.ensure_future(self.bus.subscribe(
+            self.rules_topic, self.rules_event
+        ))
         # Enable workflow exec follow-up
         get_broker().register(self.report_workflow, topic=EXEC_TOPIC)
         # Handle distributed workflow's failures
@@ -259,19 +451,62 @@ class WorkflowNyuki(Nyuki):
     async def teardown(self):
         if self.engine:
             await self.engine.stop()
+        if self.history:
+            await self.history.stop()
+        self.progress.flush_all()
+        if self.offload:
+            self.offload.stop()
+        await self.remote.close()
 
     def new_workflow(self, template, instance, **kwargs):
         """
         Keep in memory a workflow template/instance pair.
         """
+        if template is None:
+            template = instance.template.as_dict()
+        template = self.templates.intern(template)
         wflow = WorkflowInstance(template, instance, **kwargs)
         self.running_workflows[instance.uid] = wflow
+        self.running_index.add(wflow)
         if 'memory' in self._services and self.memory.available:
             asyncio.ensure_future(
                 self.write_report(wflow.report(), False)
             )
         return wflow
 
+    async def invalidate_rules(self, kind, rule_id=None):
+        """
+        Drop an updated regex or lookup table from the factory rule cache of
+        this instance and its replicas.
+        """
+        self.rules.invalidate(kind, rule_id)
+        await self.bus.publish({'kind': kind, 'id': rule_id}, self.rules_topic)
+
+    async def invalidate_template(self, tid, deleted=False):
+        """
+        Drop the cached required keys of a template published or deleted
+        on this instance from its replicas (through the rules topic).
+        """
+        self.storage.invalidate_required_keys(tid, versions=deleted)
+        await self.bus.publish(
+            {'kind': 'templates', 'id': tid, 'deleted': deleted},
+            self.rules_topic,
+        )
+
+    async def rules_event(self, efrom, data):
+        """
+        A factory rule or a template has been updated on a replica.
+        """
+        try:
+            if data['kind'] == 'templates':
+                self.storage.invalidate_required_keys(
+                    data['id'], versions=data.get('deleted', False)
+                )
+                return
+            self.rules.invalidate(data['kind'], data.get('id'))
+        except (KeyError, ValueError) as exc:
+            log.warning('Invalid rule invalidation event: %s', exc)
+
     async def report_workflow(self, event):
         """
         Send all worklfow updates to the clients.
@@ -298,6 +533,9 @@ class WorkflowNyuki(Nyuki):
             if requester:
                 payload['requester'] = requester
 
+        # History write, awaited last as it waits while the queue is full
+        history = None
+
         # A task information requires the corresponding template id
         # and a more precise topic.
         task_exec_id = source.get('task_exec_id')
@@ -324,6 +562,11 @@ class WorkflowNyuki(Nyuki):
                 TaskExecState.END.value,
                 TaskExecState.ERROR.value,
             ):
+                report = self.task_history(wflow, task_exec_id)
+                if report is not None:
+                    history = partial(
+                        self.history.put_task, instance_id, report
+                    )
                 if isinstance(event.data['content'], dict):
                     # Only send the task's important fields, if any
                     payload['data'] = {
@@ -339,6 +582,18 @@ class WorkflowNyuki(Nyuki):
         # Workflow begins, also send the full template.
         if event.data['type'] == WorkflowExecState.BEGIN.value:
             payload['template'] = dict(wflow.template)
+            self.running_index.update(
+                instance_id,
+                state=FutureState.get(wflow.instance).value,
+                start=payload['ts'],
+            )
+        elif event.data['type'] in [
+            WorkflowExecState.SUSPEND.value,
+            WorkflowExecState.RESUME.value
+        ]:
+            self.running_index.update(
+                instance_id, state=FutureState.get(wflow.instance).value
+            )
         # Workflow ended, clear it from memory
         elif event.data['type'] in [
             WorkflowExecState.END.value,
@@ -346,10 +601,14 @@ class WorkflowNyuki(Nyuki):
         ]:
             payload['data'] = event.data.get('content') or {}
             # Sanitize objects to store the finished workflow instance
-            asyncio.ensure_future(self.storage.insert_instance(
-                sanitize_workflow_exec(wflow.report())
+            # (finished tasks have already been written)
+            history = partial(self.history.put, sanitize_workflow_exec(
+                wflow.report(skip_written=True),
+                max_size=self.history_config.get('max_field_size'),
             ))
             del self.running_workflows[instance_id]
+            self.running_index.remove(instance_id)
+            self.templates.release(wflow.template)
             memwrite = False
 
         # Shared memory set/del
@@ -360,27 +619,77 @@ class WorkflowNyuki(Nyuki):
                 memjob = self.clear_report(instance_id)
             asyncio.ensure_future(memjob)
 
-        asyncio.ensure_future(self.bus.publish(
-            payload, 'websocket/{}'.format(topic)
-        ))
+        ws_topic = 'websocket/{}'.format(topic)
+        if event.data['type'] in (
+            TaskExecState.PROGRESS.value, CONTACT_PROGRESS
+        ):
+            self.progress.push((instance_id, task_exec_id), ws_topic, payload)
+            return
+
+        # Send the pending progress events first to keep them in order
+        if task_exec_id:
+            self.progress.flush((instance_id, task_exec_id))
+        else:
+            self.progress.flush_workflow(instance_id)
+        asyncio.ensure_future(self.bus.publish(payload, ws_topic))
+
+        if history is not None:
+            await history()
+
+    def task_history(self, wflow, task_exec_id):
+        """
+        Return the sanitized report of a finished task instance to write
+        into the history right away, or None.
+        """
+        for task in wflow.instance.tasks:
+            # Rescued tasks are shadows without any uid
+            if getattr(task, 'uid', None) == task_exec_id:
+                break
+        else:
+            return
+        if not task.done() or task.template.uid in wflow.written:
+            return
+        return sanitize_workflow_exec(
+            wflow.task_report(task),
+            max_size=self.history_config.get('max_field_size'),
+        )
 
     async def workflow_event(self, efrom, data):
         """
         New bus event received, trigger workflows if needed.
         """
-        templates = {}
-        # Retrieve full workflow templates
-        # TODO: Better way to fetch the full template details
-        # (this does may more requests than it should)
-        wf_templates = await self.engine.selector.select(efrom)
-        for wftmpl in wf_templates:
-            templates[wftmpl.uid] = await self.storage.get_template(
-                wftmpl.uid, draft=False
-            )
-        # Trigger workflows
+        # Trigger workflows, the selector keeps the full templates fetched
         instances = await self.engine.data_received(data, efrom)
-        for instance in instances:
-            self.new_workflow(templates[instance.template.uid], instance)
+        for instance in instances or []:
+            template = self.engine.selector.template(instance.template)
+            if template is None:
+                template = await self.storage.get_template(
+                    instance.template.uid, draft=False
+                )
+            self.new_workflow(template, instance)
+
+    async def spill_trigger(self, entry):
+        """
+        Store a trigger overflowing the admission queue.
+        """
+        try:
+            await self.storage.workflow_queue.push(
+                entry.uid, entry.event.data, entry.priority
+            )
+        except AutoReconnect as exc:
+            log.error(
+                'Could not spill trigger for template %s: %s',
+                entry.uid[:8], exc,
+            )
+
+    async def refill_triggers(self, count):
+        """
+        Reload up to `count` spilled triggers into the admission queue.
+        """
+        triggers = await self.storage.workflow_queue.pop(count)
+        for trigger in triggers:
+            await self.engine.requeue(trigger['template_id'], trigger['data'])
+        return len(triggers)
 
     @memsafe
     async def failure_handler(self, instances):
@@ -399,43 +708,47 @@ class WorkflowNyuki(Nyuki):
         # Select eligible rescuers
         ntw = self.raft.network
         rescuers = [ipv4 for ipv4, uid in ntw.items() if uid not in instances]
+        if not rescuers:
+            log.error('No instance left to rescue workflows')
+            return
 
-        # Iterate over all failing instances
-        for ifrom in instances:
-
-            # Fetch the list of workflows for a given failing instance.
-            index = self.memory.key(ifrom, 'workflows', 'instances')
-            for wflow in await self.memory.store.smembers(index):
-                wflow = wflow.decode('utf-8')
-
-                # Get the report shared by the failing instance
-                try:
-                    report = await self.read_report(wflow, ifrom)
-                except KeyError:
-                    log.error("Workflow %s memory has been wiped out", wflow)
-                    break
-
-                shuffle(rescuers)
-                report = json.dumps(report, default=serialize_object)
-
-                # Send a failover request to a valid, not failing, instance.
-                for ito in rescuers:
-                    request = {
-                        'url': 'http://{}:{}/v1/workflow/instances'.format(
-                            ito, self.api._port
-                        ),
-                        'headers': {'Content-Type': 'application/json'},
-                        'data': report
-                    }
-                    async with aiohttp.ClientSession() as session:
-                        async with session.put(**request) as resp:
-                            if resp.status == 200:
-                                # `ito` rescuer has taken over the workflow
-                                break
-                else:
-                    log.error("Workflow %s hasn't be rescued properly", wflow)
+        client = RescueClient(
+            self.api._port, loop=self.loop, **self.rescue_config
+        )
+        try:
+            for ifrom in instances:
+                # Fetch all the reports shared by a failing instance at once.
+                index = self.memory.key(ifrom, 'workflows', 'instances')
+                wflows = [
+                    wflow.decode('utf-8')
+                    for wflow in await self.memory.store.smembers(index)
+                ]
+                if not wflows:
                     continue
-                asyncio.ensure_future(self.clear_report(wflow, ifrom=ifrom))
+                reports = await self.read_reports(wflows, ifrom)
+                for wflow in wflows:
+                    if wflow not in reports:
+                        log.error(
+                            "Workflow %s memory has been wiped out", wflow
+                        )
+
+                # Send failover requests to valid, not failing, instances.
+                rescued = await client.rescue(reports, rescuers)
+                for wflow in reports:
+                    if wflow not in rescued:
+                        log.error(
+                            "Workflow %s hasn't be rescued properly", wflow
+                        )
+                log.info(
+                    '%d/%d workflows of %s rescued',
+                    len(rescued), len(wflows), ifrom,
+                )
+                if rescued:
+                    asyncio.ensure_future(
+                        self.clear_reports(list(rescued), ifrom=ifrom)
+                    )
+        finally:
+            await client.close()
 
     @memsafe
     async def clear_report(self, uid, ifrom=None):
@@ -451,6 +764,20 @@ class WorkflowNyuki(Nyuki):
             member=uid
         )
 
+    @memsafe
+    async def clear_reports(self, uids, ifrom=None):
+        """
+        Remove many reports from the shared memory.
+        """
+        _iform = ifrom or self.id
+        await self.memory.store.delete(*[
+            self.memory.key(_iform, 'workflows', 'instances', uid)
+            for uid in uids
+        ])
+        await self.memory.store.srem(
+            self.memory.key(_iform, 'workflows', 'instances'), *uids
+        )
+
     @memsafe
     async def write_report(self, report, replace=True, ito=None):
         """
@@ -462,7 +789,7 @@ class WorkflowNyuki(Nyuki):
         uid = report['exec']['id']
         response = await self.memory.store.set(
             key=self.memory.key(_ito, 'workflows', 'instances', uid),
-            value=pickle.dumps(report),
+            value=self.memory.codec.encode(report),
             expire=86400,
             exist=None if replace else False
         )
@@ -486,4 +813,24 @@ class WorkflowNyuki(Nyuki):
         )
         if not report:
             raise KeyError("Can't find workflow id context %s in memory", uid)
-        return pickle.loads(report)
+        return self.memory.codec.decode(report)
+
+    async def read_reports(self, uids, ifrom=None):
+        """
+        Read and parse many reports from the shared memory in one request.
+        Return a dict {uid: report} of the reports found.
+        """
+        _iform = ifrom or self.id
+        reports = await self.memory.store.mget(*[
+            self.memory.key(_iform, 'workflows', 'instances', uid)
+            for uid in uids
+        ])
+        decoded = {}
+        for uid, report in zip(uids, reports):
+            if not report:
+                continue
+            try:
+                decoded[uid] = self.memory.codec.decode(report)
+            except CodecError as exc:
+                log.error("Can't decode workflow id %s context: %s", uid, exc)
+        return decoded
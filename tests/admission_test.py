@@ -0,0 +1,66 @@
+from asynctest import TestCase, Mock, ignore_loop
+
+from nyuki.workflow.admission import (
+    AdmissionQueue, AdmissionRejected, QueuedTrigger
+)
+
+
+@ignore_loop
+class TestAdmissionQueue(TestCase):
+
+    def setUp(self):
+        self.queue = AdmissionQueue(
+            limit=3, templates={'a': 1}, queue_size=2, loop=self.loop
+        )
+        self.started = []
+        self.queue.start = self.started.append
+
+    def trigger(self, uid, priority=0, waited=False):
+        return QueuedTrigger(
+            Mock(uid=uid), None, priority=priority, waited=waited,
+            loop=self.loop,
+        )
+
+    def test_001_limits(self):
+        self.assertTrue(self.queue.acquire('a'))
+        self.assertFalse(self.queue.acquire('a'))
+        self.queue.set_template_limit('b', 5)
+        self.assertTrue(self.queue.acquire('b'))
+        self.assertTrue(self.queue.acquire('b'))
+        # Global limit reached
+        self.assertFalse(self.queue.acquire('c'))
+        self.assertEqual(self.queue.report()['running'], 3)
+
+    def test_002_priority(self):
+        self.assertTrue(self.queue.acquire('a'))
+        low = self.queue.put(self.trigger('a'))
+        high = self.queue.put(self.trigger('a', priority=10))
+        # A trigger of the same template can't skip the queue
+        self.queue.release('a')
+        self.assertEqual(self.started, [high])
+        self.assertFalse(self.queue.acquire('a'))
+        self.queue.release('a')
+        self.assertEqual(self.started, [high, low])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_003_reject(self):
+        self.queue.put(self.trigger('a'))
+        self.queue.put(self.trigger('a'))
+        with self.assertRaises(AdmissionRejected):
+            self.queue.put(self.trigger('a'))
+        self.assertEqual(self.queue.stats['rejected'], 1)
+
+    def test_004_drop(self):
+        self.queue = AdmissionQueue(
+            queue_size=1, overflow='drop', loop=self.loop
+        )
+        first = self.queue.put(self.trigger('a', waited=True))
+        second = self.queue.put(self.trigger('a', priority=1))
+        self.assertEqual(len(self.queue), 1)
+        with self.assertRaises(AdmissionRejected):
+            first.future.result()
+        # Lower priority than the queued trigger, dropped
+        third = self.queue.put(self.trigger('a'))
+        self.assertTrue(third.future.done())
+        self.assertFalse(second.future.done())
+        self.assertEqual(self.queue.stats['dropped'], 2)
@@ -5,7 +5,7 @@ from nose.tools import (
     assert_is, assert_is_not_none, assert_raises, assert_true, eq_
 )
 
-from nyuki.api.api import Api, mw_capability, Response
+from nyuki.api.api import Api, mw_capability, Response, streamed
 
 from tests import make_future
 
@@ -142,3 +142,20 @@ class TestCapabilityMiddleware(TestCase):
             await mdw(self._request)
 
         exc_mock.asser_called_once_with(exc)
+
+    async def test_005_streamed(self):
+        self._request.method = 'POST'
+        self._request.match_info = {}
+        self._request.headers = {'Content-Type': 'multipart/form-data'}
+        self._request.post = Mock(side_effect=ValueError)
+
+        @streamed
+        async def _capa_handler(d):
+            return web.StreamResponse(status=201)
+        _capa_handler.CONTENT_TYPE = 'multipart/form-data'
+
+        mdw = await mw_capability(self._app, _capa_handler)
+        response = await mdw(self._request)
+        eq_(type(response), web.StreamResponse)
+        eq_(response.status, 201)
+        eq_(self._request.post.call_count, 0)
@@ -0,0 +1,34 @@
+import asyncio
+from asynctest import TestCase, CoroutineMock
+
+from nyuki.workflow.coalesce import ProgressCoalescer
+
+
+class TestProgressCoalescer(TestCase):
+
+    async def setUp(self):
+        self.publish = CoroutineMock()
+        self.coalescer = ProgressCoalescer(
+            self.publish, window=0.05, loop=self.loop
+        )
+
+    async def test_001_window(self):
+        for i in range(10):
+            self.coalescer.push(('wf', 't1'), 'topic/t1', {'i': i})
+        self.coalescer.push(('wf', 't2'), 'topic/t2', {'i': 0})
+        self.publish.assert_not_called()
+        await asyncio.sleep(0.1)
+        self.publish.assert_any_call({'i': 9}, 'topic/t1')
+        self.publish.assert_any_call({'i': 0}, 'topic/t2')
+        self.assertEqual(self.publish.call_count, 2)
+        self.assertEqual(self.coalescer.stats['coalesced'], 9)
+
+    async def test_002_flush(self):
+        self.coalescer.push(('wf', 't1'), 'topic/t1', {'i': 0})
+        self.coalescer.push(('wf', 't2'), 'topic/t2', {'i': 0})
+        self.coalescer.flush_workflow('wf')
+        self.assertEqual(len(self.coalescer), 0)
+        await asyncio.sleep(0)
+        self.assertEqual(self.publish.call_count, 2)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.publish.call_count, 2)
@@ -0,0 +1,65 @@
+import asyncio
+from asynctest import TestCase
+from tukio.task import TaskHolder, register
+
+from nyuki.workflow.tukio import (
+    COMMITTED, NyukiTask, _LazyEvent, _LazyQueue, task_factory
+)
+
+
+@register('engine_test_receiver', 'execute')
+class Receiver(TaskHolder):
+
+    async def execute(self, event):
+        received = await self.queue.get()
+        return received
+
+
+class TestNyukiTask(TestCase):
+
+    def setUp(self):
+        self.loop.set_task_factory(task_factory)
+
+    def tearDown(self):
+        self.loop.set_task_factory(None)
+
+    async def test_001_lazy_queue(self):
+        task = asyncio.ensure_future(Receiver().execute(None))
+        self.assertIsInstance(task, NyukiTask)
+        self.assertIsInstance(task._queue, _LazyQueue)
+        self.assertIs(task.holder.queue, task._queue)
+        self.assertTrue(task.committed)
+        self.assertFalse(hasattr(task, '__dict__') and task.__dict__)
+        await task.data_received({'value': 1})
+        self.assertEqual(await task, {'value': 1})
+
+    async def test_002_suspend(self):
+        task = asyncio.ensure_future(Receiver().execute(None))
+        await asyncio.sleep(0)
+        task.suspend()
+        self.assertFalse(task.committed)
+        self.assertTrue(COMMITTED.is_set())
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    async def test_003_other_coroutines(self):
+        task = asyncio.ensure_future(asyncio.sleep(0))
+        self.assertNotIsInstance(task, NyukiTask)
+        await task
+
+
+class TestLazyEvent(TestCase):
+
+    async def test_001_wait(self):
+        event = _LazyEvent(True, self.loop)
+        self.assertTrue(await event.wait())
+        self.assertIsNone(event._event)
+
+        event.clear()
+        self.assertFalse(event.is_set())
+        waiter = asyncio.ensure_future(event.wait())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        event.set()
+        self.assertTrue(await waiter)
+        self.assertTrue(event.is_set())
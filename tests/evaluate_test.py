@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+from nyuki.utils.evaluate import compile_condition, safe_eval
+
+
+class TestCompileCondition(TestCase):
+
+    def test_001_variables(self):
+        evaluate = compile_condition("(@name == 'test') and (@count > 2)")
+        self.assertTrue(evaluate({'name': 'test', 'count': 3}))
+        self.assertFalse(evaluate({'name': 'test', 'count': 1}))
+        # Missing variables are None
+        self.assertTrue(compile_condition('(@missing == None)')({}))
+        # Parsed once
+        condition = compile_condition('(@a == 1)')
+        self.assertIs(compile_condition('(@a == 1)'), condition)
+
+    def test_002_quotes(self):
+        evaluate = compile_condition(
+            '(@text == "it\'s @here") or (@l == [\'a\'])'
+        )
+        self.assertTrue(evaluate({'text': "it's @here"}))
+        self.assertTrue(evaluate({'l': ['a']}))
+        self.assertFalse(evaluate({'text': 'other'}))
+
+    def test_003_nested(self):
+        evaluate = compile_condition(
+            "not ((@a in [1, 2]) or (1 < @b <= 3)) and ({'k': @a} != {})"
+        )
+        self.assertFalse(evaluate({'a': 1, 'b': 0}))
+        self.assertFalse(evaluate({'a': 0, 'b': 2}))
+        self.assertTrue(evaluate({'a': 0, 'b': 4}))
+        self.assertTrue(safe_eval('-1 < 0'))
+
+    def test_004_forbidden(self):
+        for expr in [
+            "__import__('os')", '(@a.b == 1)', '@a + 1', 'name == 1'
+        ]:
+            with self.assertRaises(TypeError):
+                compile_condition(expr)
+        with self.assertRaises(SyntaxError):
+            compile_condition('(@1 == 1)')
+
+    def test_005_unbalanced(self):
+        for expr in ['(@a == 1', "(@a in [1, 2)", "{'k': @a"]:
+            with self.assertRaises(SyntaxError):
+                compile_condition(expr)
+            with self.assertRaises(SyntaxError):
+                safe_eval(expr, {'a': 1})
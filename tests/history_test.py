@@ -0,0 +1,98 @@
+import asyncio
+from asynctest import TestCase, Mock, CoroutineMock, exhaust_callbacks
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from nyuki.workflow.db.history import HistoryWriter
+
+
+class TestHistoryWriter(TestCase):
+
+    async def setUp(self):
+        self.storage = Mock()
+        self.storage.insert_instances = CoroutineMock()
+        self.history = HistoryWriter(
+            self.storage, batch_size=3, flush_interval=0.05, max_queue=5,
+            retries=2, loop=self.loop,
+        )
+        self.history.RETRY_DELAY = 0
+        self.history.start()
+
+    async def tearDown(self):
+        await self.history.stop()
+
+    async def test_001_batch_size(self):
+        await self.history.put({'id': 'wf1'})
+        await self.history.put_task('wf1', {'id': 'task1'})
+        await self.history.put({'id': 'wf2'})
+        await exhaust_callbacks(self.loop)
+        self.storage.insert_instances.assert_called_once_with(
+            [{'id': 'wf1'}, {'id': 'wf2'}], [('wf1', {'id': 'task1'})]
+        )
+        self.assertEqual(len(self.history), 0)
+
+    async def test_002_flush_interval(self):
+        await self.history.put({'id': 'wf1'})
+        await exhaust_callbacks(self.loop)
+        self.storage.insert_instances.assert_not_called()
+        await asyncio.sleep(0.1)
+        self.storage.insert_instances.assert_called_once_with(
+            [{'id': 'wf1'}], []
+        )
+
+    async def test_003_retry(self):
+        self.storage.insert_instances.side_effect = [AutoReconnect(), None]
+        for i in range(3):
+            await self.history.put({'id': i})
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.storage.insert_instances.call_count, 2)
+
+        # Dropped after the last retry
+        self.storage.insert_instances.side_effect = AutoReconnect()
+        for i in range(3):
+            await self.history.put({'id': i})
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.storage.insert_instances.call_count, 4)
+        self.assertEqual(len(self.history), 0)
+
+    async def test_004_stop(self):
+        await self.history.put({'id': 'wf1'})
+        await self.history.put({'id': 'wf2'})
+        await self.history.stop()
+        self.storage.insert_instances.assert_called_once_with(
+            [{'id': 'wf1'}, {'id': 'wf2'}], []
+        )
+        self.assertEqual(len(self.history), 0)
+
+    async def test_005_errors(self):
+        # A batch failing for any other reason is dropped at once
+        self.storage.insert_instances.side_effect = OperationFailure('nope')
+        for i in range(3):
+            await self.history.put({'id': i})
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.storage.insert_instances.call_count, 1)
+
+        # The consumer is still running
+        self.storage.insert_instances.side_effect = None
+        for i in range(3):
+            await self.history.put({'id': i})
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.storage.insert_instances.call_count, 2)
+        self.assertFalse(self.history._consumer.done())
+
+    async def test_006_backpressure(self):
+        await self.history.stop()
+        self.history.put_timeout = 0.05
+        for i in range(5):
+            self.assertTrue(await self.history.put({'id': i}))
+        # Waits for room in the queue
+        put = asyncio.ensure_future(self.history.put_task('wf', {'id': 't'}))
+        await asyncio.sleep(0.01)
+        self.assertFalse(put.done())
+        self.history._queue.get_nowait()
+        self.assertTrue(await put)
+
+        # Then drops the document
+        self.assertFalse(await self.history.put({'id': 'late'}))
+        self.assertEqual(self.history.report(), {
+            'queued': 5, 'max_queue': 5, 'dropped': 1,
+        })
@@ -0,0 +1,101 @@
+import json
+import asynctest
+from unittest import TestCase
+from unittest.mock import Mock
+
+from nyuki.workflow.api.instances import ApiWorkflows
+from nyuki.workflow.index import RunningIndex
+
+
+class TestRunningIndex(TestCase):
+
+    def setUp(self):
+        self.index = RunningIndex()
+        for i in range(5):
+            self.index.add(Mock(
+                template={'id': 'tmpl{}'.format(i % 2), 'title': 'test'},
+                instance=Mock(**{
+                    'uid': 'wf{}'.format(i),
+                    'committed': True,
+                    'done.return_value': False,
+                }),
+                exec={'requester': 'nyuki://parent' if i == 4 else None},
+            ))
+
+    def test_001_select(self):
+        count, page = self.index.select(offset=1, limit=2)
+        self.assertEqual(count, 5)
+        self.assertEqual([s['id'] for s in page], ['wf1', 'wf2'])
+        count, page = self.index.select(template='tmpl0', children=False)
+        self.assertEqual(count, 2)
+        self.assertEqual([s['id'] for s in page], ['wf0', 'wf2'])
+        count, _ = self.index.select(state='suspended')
+        self.assertEqual(count, 0)
+
+    def test_002_etag(self):
+        etag = self.index.etag
+        self.index.update('wf0', state='pending')
+        self.assertEqual(self.index.etag, etag)
+        self.index.update('wf0', state='suspended')
+        self.assertNotEqual(self.index.etag, etag)
+        etag = self.index.etag
+        self.index.remove('wf0')
+        self.index.remove('wf0')
+        self.assertNotEqual(self.index.etag, etag)
+        self.assertEqual(len(self.index), 4)
+
+
+class TestApiWorkflows(asynctest.TestCase):
+
+    def setUp(self):
+        self.index = RunningIndex()
+        self.workflows = {}
+        for i in range(3):
+            uid = 'wf{}'.format(i)
+            wflow = Mock(
+                template={'id': 'tmpl', 'title': 'test'},
+                instance=Mock(**{
+                    'uid': uid, 'committed': True, 'done.return_value': False,
+                }),
+                exec={},
+            )
+            wflow.report.return_value = {'id': uid, 'template': {}}
+            self.index.add(wflow)
+            self.workflows[uid] = wflow
+        self.api = ApiWorkflows()
+        self.api.nyuki = Mock(
+            running_index=self.index, running_workflows=self.workflows
+        )
+
+    async def test_001_reports(self):
+        # Full reports by default
+        response = await self.api.get(Mock(GET={}, headers={}))
+        self.assertEqual(
+            json.loads(response.body.decode()),
+            [{'id': 'wf0', 'template': {}}, {'id': 'wf1', 'template': {}},
+             {'id': 'wf2', 'template': {}}],
+        )
+        self.assertNotIn('ETag', response.headers)
+        self.workflows['wf0'].report.assert_called_once_with(tasks=False)
+
+        response = await self.api.get(Mock(
+            GET={'offset': '1', 'limit': '1', 'tasks': '1'}, headers={}
+        ))
+        self.assertEqual(json.loads(response.body.decode()), [
+            {'id': 'wf1', 'template': {}},
+        ])
+        self.assertEqual(response.headers['X-Total-Count'], '3')
+        self.workflows['wf1'].report.assert_called_with(tasks=True)
+
+    async def test_002_summaries(self):
+        response = await self.api.get(Mock(GET={'summary': '1'}, headers={}))
+        body = json.loads(response.body.decode())
+        self.assertEqual([summary['id'] for summary in body], [
+            'wf0', 'wf1', 'wf2',
+        ])
+        self.assertEqual(body[0]['template']['id'], 'tmpl')
+        etag = response.headers['ETag']
+        response = await self.api.get(Mock(
+            GET={'summary': '1'}, headers={'If-None-Match': etag}
+        ))
+        self.assertEqual(response.status, 304)
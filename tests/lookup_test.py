@@ -0,0 +1,277 @@
+import csv
+import asynctest
+from unittest import TestCase
+from pymongo.errors import AutoReconnect
+
+from nyuki.utils.lookup import LookupTable, LookupMode
+from nyuki.utils.transform import Lookup
+from nyuki.workflow.api.factory import CSVStream
+from nyuki.workflow.db.lookups import LookupCollection
+
+
+class TestLookupTable(TestCase):
+
+    def test_001_exact(self):
+        table = LookupTable.from_rows([
+            {'value': 'a', 'replace': 'first'},
+            {'value': 'A', 'replace': 'upper'},
+            {'value': 1, 'replace': 'one'},
+            {'value': 'a', 'replace': 'last'},
+        ])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.get('a'), 'last')
+        self.assertEqual(table.get('A'), 'upper')
+        self.assertEqual(table.get(1), 'one')
+        self.assertIsNone(table.get('b'))
+
+    def test_002_icase(self):
+        table = LookupTable([('Minor', 'MINOR')], 'icase')
+        self.assertIs(table.mode, LookupMode.EXACT)
+        self.assertTrue(table.icase)
+        self.assertEqual(table.get('mINOR'), 'MINOR')
+
+    def test_003_prefix(self):
+        table = LookupTable(
+            [('+33', 'France'), ('+336', 'France mobile'), ('+1', 'USA')],
+            LookupMode.PREFIX,
+        )
+        self.assertEqual(table.get('+33612345678'), 'France mobile')
+        self.assertEqual(table.get('+33123456789'), 'France')
+        self.assertEqual(table.get('+1555'), 'USA')
+        self.assertIsNone(table.get('+44'))
+        self.assertIsNone(table.get('+3'))
+
+    def test_004_range(self):
+        table = LookupTable(
+            [('50', 'medium'), (0, 'low'), ('80.5', 'high'), ('x', 'bad')],
+            LookupMode.RANGE,
+        )
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.get(0), 'low')
+        self.assertEqual(table.get('49.9'), 'low')
+        self.assertEqual(table.get(50), 'medium')
+        self.assertEqual(table.get(100), 'high')
+        self.assertIsNone(table.get(-1))
+        self.assertIsNone(table.get('nan?'))
+
+    def test_005_rule(self):
+        table = LookupTable([('+33', 'FR')], LookupMode.PREFIX)
+        data = {'phone': '+33600000000', 'level': 12}
+        Lookup('phone', table=table).apply(data)
+        Lookup('level', table={'0': 'low', '10': 'mid'}, mode='range').apply(
+            data
+        )
+        self.assertEqual(data, {'phone': 'FR', 'level': 'mid'})
+
+
+class TestCSVStream(TestCase):
+
+    def parse(self, data, size):
+        stream = CSVStream()
+        rows = []
+        for i in range(0, len(data), size):
+            rows.extend(stream.feed(data[i:i + size]))
+        rows.extend(stream.close())
+        self.assertEqual(stream.rows, len(rows))
+        return stream, rows
+
+    def test_001_chunks(self):
+        lines = ['value;replace'] + [
+            '{0};"r{0}\nnext; line"'.format(i) if i % 7 == 0
+            else '{0};r{0}'.format(i)
+            for i in range(500)
+        ]
+        data = '\r\n'.join(lines).encode()
+        expected = [
+            [str(i), 'r{}\nnext; line'.format(i) if i % 7 == 0
+             else 'r{}'.format(i)]
+            for i in range(500)
+        ]
+        for size in (1, 7, 100, len(data)):
+            stream, rows = self.parse(data, size)
+            self.assertEqual(stream.dialect.delimiter, ';')
+            self.assertEqual(stream.header, ['value', 'replace'])
+            self.assertEqual(rows, expected)
+
+    def test_002_encoding(self):
+        lines = ['a{0},b{0}'.format(i) for i in range(200)]
+        lines.append('caf\xe9,th\xe9')
+        data = '\n'.join(lines)
+        stream, rows = self.parse(data.encode('latin-1'), 64)
+        self.assertEqual(stream.encoding, 'latin-1')
+        self.assertEqual(rows[-1], ['caf\xe9', 'th\xe9'])
+        stream, rows = self.parse(data.encode(), 3)
+        self.assertEqual(stream.encoding, 'utf-8')
+        self.assertEqual(rows[-1], ['caf\xe9', 'th\xe9'])
+        self.assertEqual(len(rows), 201)
+
+    def test_003_errors(self):
+        with self.assertRaises(csv.Error):
+            CSVStream().close()
+        # Not utf-8 after some utf-8 characters
+        stream = CSVStream()
+        stream.feed('caf\xe9,th\xe9\n'.encode() * 100)
+        with self.assertRaises(UnicodeDecodeError):
+            stream.feed('caf\xe9,th\xe9\n'.encode('latin-1'))
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    async def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+
+    """
+    The few Mongo queries and updates used by `LookupCollection`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+        self.fail_insert = None
+
+    @staticmethod
+    def match(doc, query):
+        for key, value in (query or {}).items():
+            if isinstance(value, dict):
+                if doc.get(key) == value['$ne']:
+                    return False
+            elif doc.get(key) != value:
+                return False
+        return True
+
+    async def create_index(self, *args, **kwargs):
+        pass
+
+    def find(self, query, projection, sort):
+        docs = sorted(
+            (doc for doc in self.docs if self.match(doc, query)),
+            key=lambda doc: doc[sort[0][0]],
+        )
+        return FakeCursor([
+            {key: doc[key] for key in projection if key != '_id'}
+            for doc in docs
+        ])
+
+    async def find_one(self, query, projection):
+        for doc in self.docs:
+            if self.match(doc, query):
+                return dict(doc)
+
+    async def insert_one(self, doc):
+        if self.fail_insert is not None:
+            self.fail_insert -= 1
+            if self.fail_insert < 0:
+                raise AutoReconnect()
+        self.docs.append(dict(doc))
+
+    async def replace_one(self, query, doc, upsert=False):
+        await self.delete_one(query)
+        self.docs.append(dict(doc))
+
+    async def update_one(self, query, update, upsert=False):
+        for doc in self.docs:
+            if self.match(doc, query):
+                doc.update(update.get('$set', {}))
+                for key, value in update.get('$inc', {}).items():
+                    doc[key] += value
+                return
+        if upsert and '$setOnInsert' in update:
+            self.docs.append(dict(update['$setOnInsert']))
+
+    async def delete_one(self, query):
+        for doc in self.docs:
+            if self.match(doc, query):
+                self.docs.remove(doc)
+                return
+
+    async def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not self.match(doc, query)]
+
+
+class TestLookupCollection(asynctest.TestCase):
+
+    def setUp(self):
+        self.db = {
+            name: FakeCollection(name) for name in ('lookups', 'lookup_rows')
+        }
+        self.lookups = LookupCollection(self.db)
+        self.lookups.CHUNK_SIZE = 2
+
+    def table(self, size, prefix='v'):
+        return {
+            'id': 'lkp',
+            'title': 'title',
+            'table': [
+                {'value': '{}{}'.format(prefix, i), 'replace': i}
+                for i in range(size)
+            ],
+        }
+
+    async def test_001_chunked(self):
+        await self.lookups.insert(self.table(5))
+        self.assertEqual(len(self.db['lookup_rows'].docs), 3)
+        pairs = await self.lookups.pairs('lkp')
+        self.assertEqual(pairs, [('v{}'.format(i), i) for i in range(5)])
+        lookup = await self.lookups.get_one('lkp')
+        self.assertEqual(lookup['rows'], 5)
+        self.assertEqual(lookup['table'][4], {'value': 'v4', 'replace': 4})
+
+        # The previous generation's chunks are replaced
+        await self.lookups.insert(self.table(3, 'w'))
+        self.assertEqual(len(self.db['lookup_rows'].docs), 2)
+        self.assertEqual(
+            await self.lookups.pairs('lkp'), [('w0', 0), ('w1', 1), ('w2', 2)]
+        )
+        # Small tables do not use chunks
+        await self.lookups.insert(self.table(2))
+        self.assertEqual(self.db['lookup_rows'].docs, [])
+        self.assertEqual(
+            await self.lookups.pairs('lkp'), [('v0', 0), ('v1', 1)]
+        )
+
+    async def test_002_failed_import(self):
+        await self.lookups.insert(self.table(5))
+        self.db['lookup_rows'].fail_insert = 1
+        with self.assertRaises(AutoReconnect):
+            await self.lookups.insert(self.table(5, 'w'))
+        # The previous table is still served, the new chunks are deleted
+        self.assertEqual(len(self.db['lookup_rows'].docs), 3)
+        self.assertEqual(
+            await self.lookups.pairs('lkp'),
+            [('v{}'.format(i), i) for i in range(5)],
+        )
+
+        # A new table is deleted
+        self.db['lookup_rows'].fail_insert = 1
+        data = self.table(5)
+        data['id'] = 'other'
+        with self.assertRaises(AutoReconnect):
+            await self.lookups.insert(data)
+        self.assertIsNone(await self.lookups.get_one('other', importing=True))
+        self.assertEqual(len(self.db['lookup_rows'].docs), 3)
+
+    async def test_003_importing(self):
+        generation = await self.lookups.start_import('lkp', 'title')
+        await self.lookups.insert_rows('lkp', generation, 0, [['a', 1]])
+        # Not readable until the end of the import
+        self.assertIsNone(await self.lookups.pairs('lkp'))
+        self.assertIsNone(await self.lookups.get_one('lkp'))
+        lookup = await self.lookups.get_one('lkp', importing=True)
+        self.assertEqual(lookup['rows'], 1)
+
+        await self.lookups.insert_rows('lkp', generation, 1, [['b', 2]])
+        await self.lookups.end_import('lkp', generation, 2, 'new')
+        self.assertEqual(await self.lookups.pairs('lkp'), [('a', 1), ('b', 2)])
+        self.assertEqual((await self.lookups.get_one('lkp'))['title'], 'new')
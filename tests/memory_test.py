@@ -0,0 +1,57 @@
+import pickle
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+from nyuki.memory import CheckpointCodec, CodecError, MsgpackCodec
+
+
+class TestMsgpackCodec(TestCase):
+
+    def setUp(self):
+        self.codec = MsgpackCodec(compress_threshold=1024)
+        self.report = {
+            'exec': {
+                'id': 'abc',
+                'start': datetime(2017, 1, 1, 12, 30, 10, 123456, timezone.utc),
+                'end': None,
+            },
+            'tasks': [
+                {'id': 't1', 'exec': {'outputs': {'value': 12.5}}},
+                {'id': 't2', 'exec': None},
+            ],
+        }
+
+    def test_001_roundtrip(self):
+        data = self.codec.encode(self.report)
+        self.assertTrue(data.startswith(CheckpointCodec.MAGIC))
+        self.assertEqual(self.codec.decode(data), self.report)
+        self.assertEqual(self.codec.stats['encoded'], 1)
+        self.assertEqual(self.codec.stats['decoded'], 1)
+
+    def test_002_datetimes(self):
+        naive = datetime(2017, 1, 1, 12, 30)
+        shifted = datetime(2017, 1, 1, 12, 30, tzinfo=timezone(timedelta(hours=2)))
+        decoded = self.codec.decode(self.codec.encode([naive, shifted]))
+        self.assertEqual(decoded, [naive, shifted])
+        self.assertIsNone(decoded[0].tzinfo)
+        self.assertEqual(decoded[1].utcoffset(), timedelta(hours=2))
+
+    def test_003_compression(self):
+        self.report['tasks'][0]['exec']['outputs']['value'] = 'x' * 10000
+        data = self.codec.encode(self.report)
+        self.assertLess(len(data), 10000)
+        self.assertEqual(self.codec.stats['compressed'], 1)
+        self.assertEqual(self.codec.decode(data), self.report)
+
+    def test_004_unknown_objects(self):
+        decoded = self.codec.decode(self.codec.encode({'obj': object()}))
+        self.assertEqual(decoded['obj'], "Internal server data: <class 'object'>")
+
+    def test_005_legacy_pickle(self):
+        data = pickle.dumps(self.report)
+        self.assertEqual(self.codec.decode(data), self.report)
+        self.assertEqual(self.codec.stats['legacy_decoded'], 1)
+
+        codec = MsgpackCodec(legacy_pickle=False)
+        with self.assertRaises(CodecError):
+            codec.decode(data)
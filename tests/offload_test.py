@@ -0,0 +1,79 @@
+import re
+from asynctest import TestCase, ignore_loop
+
+from nyuki.utils.lookup import LookupTable
+from nyuki.workflow.offload import FactoryOffload, OffloadError
+from nyuki.workflow.rules import Pipeline
+from nyuki.utils import Converter
+
+
+RULES = [
+    {'type': 'sub', 'fieldname': 'body', 'pattern': re.compile(r'\d+'),
+     'repl': '#'},
+    {'type': 'lookup', 'fieldname': 'level',
+     'table': LookupTable([('minor', 'MINOR')])},
+    {'type': 'condition-block', 'conditions': [
+        {'type': 'if', 'condition': "@level == 'MINOR'", 'rules': [
+            {'type': 'union', 'fieldname': 'tags',
+             'operand1': '@tags', 'operand2': ['b']},
+        ]},
+    ]},
+]
+
+
+class TestFactoryOffload(TestCase):
+
+    async def setUp(self):
+        self.offload = FactoryOffload(workers=1, offload_size=100)
+        self.pipeline = Pipeline(
+            (0, 'rules'), Converter.from_dict({'rules': RULES}), RULES
+        )
+
+    async def tearDown(self):
+        self.offload.stop()
+
+    @ignore_loop
+    def test_001_cost(self):
+        data = {'body': 'x' * 90, 'level': 'minor', 'tags': ['a'] * 5}
+        # 'tags' is read twice by the union
+        self.assertEqual(FactoryOffload.cost(RULES, data), 105)
+        # Not started
+        self.assertFalse(self.offload.offloads(RULES, data))
+        self.offload.start()
+        self.assertTrue(self.offload.offloads(RULES, data))
+        self.assertFalse(self.offload.offloads(RULES, {'body': 'x'}))
+        self.assertTrue(
+            self.offload.offloads(RULES, [{'body': 'x'}] * 100, many=True)
+        )
+
+    async def test_002_apply(self):
+        self.offload.start()
+        data = {'body': 'a1b22' * 20, 'level': 'minor', 'tags': ['a']}
+        expected = dict(data)
+        expected_diff = self.pipeline.converter.apply(expected)
+
+        runs = []
+        run = self.offload._run
+
+        async def counted(key, rules, payload):
+            runs.append(rules is not None)
+            return await run(key, rules, payload)
+
+        self.offload._run = counted
+        diff = await self.offload.apply(self.pipeline, data, 'full')
+        self.assertEqual(data, expected)
+        self.assertEqual(diff, expected_diff)
+        # The worker compiled the rules on the first call only
+        self.assertEqual(runs, [False, True])
+        records = [{'body': '1', 'level': 'minor', 'tags': []}]
+        diff = await self.offload.apply(
+            self.pipeline, records, 'summary', many=True
+        )
+        self.assertEqual(runs, [False, True, False])
+        self.assertEqual(records[0]['body'], '#')
+        self.assertEqual(diff['records'], 1)
+
+    async def test_003_unpicklable(self):
+        self.offload.start()
+        with self.assertRaises(OffloadError):
+            await self.offload.apply(self.pipeline, {'f': lambda: 1}, 'full')
@@ -0,0 +1,96 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from nyuki.workflow.registry import TemplateRegistry
+from nyuki.workflow.workflow import ExecRecord, WorkflowInstance
+
+
+class TestTemplateRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = TemplateRegistry()
+
+    def template(self, state='active', version=1):
+        return {
+            'id': 'tmpl', 'version': version, 'state': state,
+            'title': 'title', 'tags': ['a'],
+        }
+
+    def test_001_intern(self):
+        first = self.template()
+        self.assertIs(self.registry.intern(first), first)
+        self.assertIs(self.registry.intern(self.template()), first)
+        self.assertIsNot(self.registry.intern(self.template(version=2)), first)
+        self.assertEqual(len(self.registry), 2)
+
+    def test_002_drafts(self):
+        draft = self.template(state='draft')
+        self.assertIs(self.registry.intern(draft), draft)
+        self.assertIsNot(self.registry.intern(self.template('draft')), draft)
+        self.assertEqual(len(self.registry), 0)
+
+    def test_003_release(self):
+        first = self.registry.intern(self.template())
+        self.registry.intern(self.template())
+        self.registry.release(first)
+        self.assertEqual(len(self.registry), 1)
+        self.registry.release(first)
+        self.assertEqual(len(self.registry), 0)
+        self.assertIsNot(self.registry.intern(self.template()), first)
+
+
+class TestExecRecord(TestCase):
+
+    def test_001_record(self):
+        record = ExecRecord(requester='nyuki://test')
+        self.assertEqual(record.get('requester'), 'nyuki://test')
+        self.assertEqual(record.get('track', []), [])
+        self.assertIsNone(record.get('unknown'))
+        self.assertEqual(record.as_dict(), {'requester': 'nyuki://test'})
+        with self.assertRaises(AttributeError):
+            record.other = 1
+
+
+class TestWorkflowInstance(TestCase):
+
+    def setUp(self):
+        self.template = {
+            'id': 'tmpl', 'version': 1, 'title': 'title',
+            'graph': {'first': ['second'], 'second': []},
+            'tasks': [
+                {'id': 'first', 'name': 'join', 'config': {'rules': [1]}},
+                {'id': 'second', 'name': 'join'},
+            ],
+        }
+        instance = Mock()
+        instance.report.side_effect = lambda: {
+            'exec': {'id': 'wf'},
+            'tasks': [{'id': 'first', 'exec': {'id': 'task', 'state': 'done'}}],
+        }
+        self.workflow = WorkflowInstance(self.template, instance)
+
+    def test_001_report(self):
+        report = self.workflow.report()
+        self.assertEqual(report['id'], 'wf')
+        self.assertEqual(report['template']['graph'], self.template['graph'])
+        first, second = report['template']['tasks']
+        self.assertEqual(first['state'], 'done')
+        self.assertEqual(first['template'], self.template['tasks'][0])
+        self.assertEqual(second['template'], self.template['tasks'][1])
+        # The shared template is never modified
+        first['template']['config']['rules'].append(2)
+        report['template']['graph']['first'].clear()
+        self.assertEqual(self.template['tasks'][0]['config']['rules'], [1])
+        self.assertEqual(self.template['graph']['first'], ['second'])
+
+        report = self.workflow.report(tasks=False)
+        self.assertNotIn('tasks', report['template'])
+        self.assertNotIn('graph', report['template'])
+        self.assertEqual(report['template']['title'], 'title')
+
+        self.workflow._written = {'first': 'task'}
+        report = self.workflow.report(skip_written=True)
+        self.assertEqual(
+            [task['template']['id'] for task in report['template']['tasks']],
+            ['second'],
+        )
@@ -0,0 +1,41 @@
+from unittest import TestCase
+import asynctest
+
+from nyuki.workflow.rescue import assign, RescueClient
+
+
+class TestAssign(TestCase):
+
+    def test_001_weighted(self):
+        assigned = assign(range(100), {'a': 3, 'b': 1, 'c': 0})
+        self.assertEqual(len(assigned['a']), 75)
+        self.assertEqual(len(assigned['b']), 25)
+        self.assertEqual(assigned['c'], [])
+        # Smooth distribution, 'b' is not left for the end
+        self.assertLess(assigned['b'][0], 4)
+
+    def test_002_empty(self):
+        self.assertEqual(assign(['x'], {}), {})
+        self.assertEqual(assign([], {'a': 1}), {'a': []})
+
+
+class TestRescueClient(asynctest.TestCase):
+
+    async def setUp(self):
+        self.client = RescueClient(5558, loop=self.loop)
+
+    async def tearDown(self):
+        await self.client.close()
+
+    async def test_001_unknown_weights(self):
+        loads = {'busy': 1 / 500, 'idle': 1, 'down': None}
+        self.client._weight = asynctest.CoroutineMock(side_effect=loads.get)
+        weights = await self.client.weights(['busy', 'idle', 'down'])
+        self.assertEqual(weights['down'], 1 / 1000)
+        assigned = assign(range(3000), weights)
+        self.assertLess(len(assigned['down']), len(assigned['busy']))
+        self.assertLess(len(assigned['busy']), len(assigned['idle']))
+
+        # No load known at all
+        weights = await self.client.weights(['down', 'down2'])
+        self.assertEqual(weights, {'down': 1, 'down2': 1})
@@ -0,0 +1,106 @@
+import re
+from asynctest import TestCase, Mock, CoroutineMock, patch
+
+from nyuki.utils.transform import DiffMode
+from nyuki.workflow.rules import FactoryRuleCache
+from nyuki.workflow.tasks.factory import FactoryTask
+from nyuki.workflow.tasks.utils import runtime
+
+
+class TestFactoryRuleCache(TestCase):
+
+    async def setUp(self):
+        self.storage = Mock()
+        self.storage.regexes.get_one = CoroutineMock(return_value={
+            'id': 'digits', 'pattern': r'\d+',
+        })
+        self.storage.lookups.pairs = CoroutineMock(
+            return_value=[('minor', 'MINOR')]
+        )
+        self.rules = FactoryRuleCache(self.storage)
+
+    async def test_001_regex(self):
+        regex = await self.rules.regex('digits')
+        self.assertEqual(regex.pattern, r'\d+')
+        self.assertIs(await self.rules.regex('digits'), regex)
+        self.assertEqual(self.storage.regexes.get_one.call_count, 1)
+        icase = await self.rules.regex('digits', re.I)
+        self.assertEqual(icase.flags & re.I, re.I)
+        self.assertEqual(self.storage.regexes.get_one.call_count, 2)
+
+    async def test_002_lookup(self):
+        table = await self.rules.lookup('levels')
+        self.assertEqual(table.get('minor'), 'MINOR')
+        self.assertIs(await self.rules.lookup('levels'), table)
+        self.storage.lookups.pairs.assert_called_once_with('levels')
+        icase = await self.rules.lookup('levels', 'icase')
+        self.assertIs(await self.rules.lookup('levels', icase=True), icase)
+        self.assertEqual(icase.get('MiNoR'), 'MINOR')
+
+    async def test_003_invalidate(self):
+        await self.rules.regex('digits')
+        await self.rules.regex('digits', re.I)
+        await self.rules.lookup('levels')
+        self.rules.invalidate('regexes', 'digits')
+        self.assertEqual(len(self.rules), 1)
+        self.rules.invalidate('lookups')
+        self.assertEqual(len(self.rules), 0)
+        with self.assertRaises(ValueError):
+            self.rules.invalidate('unknown')
+
+    async def test_004_missing(self):
+        self.storage.regexes.get_one.return_value = None
+        with self.assertRaises(RuntimeError):
+            await self.rules.regex('digits')
+        self.assertEqual(len(self.rules), 0)
+
+    async def test_005_converter(self):
+        config = {'rules': [
+            {'type': 'sub', 'fieldname': 'a', 'regex_id': 'digits',
+             'repl': '#'},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': "(@a == '#')", 'rules': [
+                    {'type': 'lookup', 'fieldname': 'b',
+                     'lookup_id': 'levels'},
+                ]},
+            ]},
+        ]}
+        converter = await self.rules.converter(config)
+        self.assertIs(await self.rules.converter(dict(config)), converter)
+        data = {'a': '12', 'b': 'minor'}
+        diff = converter.apply(data)
+        self.assertEqual(data, {'a': '#', 'b': 'MINOR'})
+        self.assertEqual(len(diff['rules'][1]['conditions']), 1)
+        # Diffs are not shared between applications
+        converter.apply({'a': 'x'})
+        self.assertEqual(len(diff['rules'][1]['conditions']), 1)
+        self.rules.invalidate('lookups', 'levels')
+        self.assertIsNot(await self.rules.converter(config), converter)
+
+
+class TestFactoryTask(TestCase):
+
+    async def setUp(self):
+        self.rules = [{'type': 'set', 'fieldname': 'a', 'value': 1}]
+        runtime.rules = FactoryRuleCache(Mock())
+
+    async def tearDown(self):
+        del runtime.rules
+
+    async def test_001_diff_mode(self):
+        task = FactoryTask({'rules': self.rules})
+        self.assertEqual(task.diff_mode, DiffMode.FULL)
+        diff = (await task.execute(Mock(data={})))['diff']
+        self.assertEqual(diff['rules'][0]['changes'], [
+            {'action': 'add', 'key': 'a', 'value': 1},
+        ])
+
+        task = FactoryTask({'rules': self.rules, 'records': 'items'})
+        self.assertEqual(task.diff_mode, DiffMode.SUMMARY)
+        task = FactoryTask({
+            'rules': self.rules, 'records': 'items', 'diff': 'none',
+        })
+        self.assertEqual(task.diff_mode, 'none')
+        with patch.object(FactoryTask, 'apply_many') as apply_many:
+            await task.execute(Mock(data={'items': [{}]}))
+        self.assertEqual(apply_many.call_args[0][2], 'none')
@@ -0,0 +1,43 @@
+from datetime import datetime
+from unittest import TestCase
+
+from nyuki.utils.serialize import bson_safe, TRUNCATED
+
+
+class TestBsonSafe(TestCase):
+
+    def test_001_copy(self):
+        now = datetime.now()
+        data = {'a': 1, 'b': [1.5, None, True], 'c': {'d': now}, 'e': (1, 2)}
+        result = bson_safe(data)
+        self.assertEqual(result, {
+            'a': 1, 'b': [1.5, None, True], 'c': {'d': now}, 'e': [1, 2],
+        })
+        self.assertIsNot(result['c'], data['c'])
+        self.assertEqual(list(result.keys()), ['a', 'b', 'c', 'e'])
+
+    def test_002_unknown_objects(self):
+        result = bson_safe({'list': [object(), {'set': {1}}], 1: b'bytes'})
+        self.assertEqual(result, {
+            'list': [
+                "Internal server data: <class 'object'>",
+                {'set': "Internal server data: <class 'set'>"},
+            ],
+            '1': "Internal server data: <class 'bytes'>",
+        })
+        self.assertEqual(bson_safe([2 ** 64]), [str(2 ** 64)])
+
+    def test_003_max_size(self):
+        result = bson_safe({'out': ['x' * 100, 'y']}, max_size=10)
+        self.assertEqual(result['out'], ['x' * 10 + TRUNCATED, 'y'])
+
+    def test_004_recursion(self):
+        data = {}
+        data['self'] = data
+        result = bson_safe(data)
+        depth = 0
+        while isinstance(result, dict):
+            result = result['self']
+            depth += 1
+        self.assertEqual(depth, 100)
+        self.assertEqual(result, 'Internal server data: max depth reached')
@@ -0,0 +1,98 @@
+from asynctest import TestCase, Mock, patch, ignore_loop
+
+from nyuki.workflow.tasks.task_selector import DecisionTable, TaskSelector
+
+
+RULES = [
+    {'type': 'task-selector', 'tasks': ['default']},
+    {'type': 'condition-block', 'conditions': [
+        {'type': 'if', 'condition': '@level == "major"', 'rules': [
+            {'type': 'task-selector', 'tasks': ['escalate']},
+        ]},
+        {'type': 'elif', 'condition': '@count > 10', 'rules': []},
+        {'type': 'elif', 'condition': '@count > 5', 'rules': [
+            {'type': 'task-selector', 'tasks': ['notify', 'log']},
+        ]},
+        {'type': 'elif', 'condition': '@count > 0', 'rules': []},
+    ]},
+    {'type': 'condition-block', 'conditions': [
+        {'type': 'if', 'condition': '@muted', 'rules': [
+            {'type': 'task-selector', 'tasks': []},
+        ]},
+    ]},
+]
+
+
+class TestDecisionTable(TestCase):
+
+    @ignore_loop
+    def test_001_select(self):
+        table = DecisionTable(RULES)
+        cases = [
+            ({'level': 'major', 'count': 20}, 'rules[1].conditions[0]'),
+            ({'level': 'minor', 'count': 20}, 'rules[0]'),
+            ({'level': 'minor', 'count': 7}, 'rules[1].conditions[2]'),
+            ({'level': 'minor', 'count': 1}, 'rules[0]'),
+            ({'level': 'major', 'muted': True}, 'rules[2].conditions[0]'),
+        ]
+        for data, branch in cases:
+            self.assertEqual(table.select(data)[0], branch)
+        self.assertEqual(table.select({'muted': True}), (
+            'rules[2].conditions[0]', []
+        ))
+        self.assertEqual(table.counts, {
+            'rules[2].conditions[0]': 2,
+            'rules[1].conditions[0]': 1,
+            'rules[1].conditions[1]': 0,
+            'rules[1].conditions[2]': 1,
+            'rules[0]': 2,
+            'none': 0,
+        })
+
+    @ignore_loop
+    def test_002_short_circuit(self):
+        # Blocks before an unconditional selection are never evaluated
+        table = DecisionTable([
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': '@a == 1', 'rules': [
+                    {'type': 'task-selector', 'tasks': ['a']},
+                ]},
+            ]},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': '@b == 1', 'rules': [
+                    {'type': 'task-selector', 'tasks': ['b']},
+                ]},
+                {'type': 'else', 'rules': [
+                    {'type': 'task-selector', 'tasks': ['c']},
+                ]},
+            ]},
+        ])
+        self.assertEqual(list(table.counts), [
+            'rules[1].conditions[0]', 'rules[1].conditions[1]', 'none'
+        ])
+        self.assertEqual(table.select({'a': 1}), (
+            'rules[1].conditions[1]', ['c']
+        ))
+        self.assertEqual(DecisionTable([]).select({}), (None, None))
+
+    @ignore_loop
+    def test_003_shared(self):
+        config = {'rules': RULES}
+        table = DecisionTable.get(config)
+        self.assertIs(DecisionTable.get(config), table)
+        self.assertIsNot(DecisionTable.get({'rules': RULES}), table)
+
+    @patch('nyuki.workflow.tasks.task_selector.asyncio')
+    @patch('nyuki.workflow.tasks.task_selector.Workflow.current_workflow')
+    async def test_004_execute(self, current_workflow, asyncio):
+        config = {'rules': RULES}
+        for data in ({'count': 7}, {'count': 7}):
+            task = TaskSelector(config)
+            await task.execute(Mock(data=data))
+        current_workflow.return_value.set_next_tasks.assert_called_with(
+            ['notify', 'log']
+        )
+        report = task.report()
+        self.assertEqual(report['tasks'], ['notify', 'log'])
+        self.assertEqual(report['branch'], 'rules[1].conditions[2]')
+        self.assertEqual(report['selections']['rules[1].conditions[2]'], 2)
@@ -1,8 +1,11 @@
+import re
+import random
 from unittest import TestCase
 
 from nyuki.utils.transform import (
     Upper, Lower, Lookup, Unset, Set, Sub, Extract, Converter,
-    FactoryConditionBlock, Arithmetic, Union
+    FactoryConditionBlock, Arithmetic, Union, TraceableDict, DiffMode,
+    required_literal
 )
 
 
@@ -172,6 +175,102 @@ class TestTransformCases(TestCase):
         diff = rule.apply(self.data)
         self.assertEqual(diff['error'], 'regexp_rule_error')
 
+    def test_010b_error_rollback(self):
+        data = {'a': 1, 'b': 'string'}
+        rule = Arithmetic('a', '+', '@b', 1)
+        diff = rule.apply(data)
+        self.assertEqual(diff['error'], 'arithmetic_rule_error')
+        self.assertEqual(data, {'a': 1, 'b': 'string'})
+
+    def test_010c_traceable_dict(self):
+        value = {'nested': [1]}
+        data = {'a': value, 'b': 2, 'c': 3}
+        tracker = TraceableDict(data)
+        tracker['a'] = 'new'
+        tracker['d'] = 4
+        tracker['c'] = 3
+        del tracker['b']
+        # Written through
+        self.assertEqual(data, {'a': 'new', 'c': 3, 'd': 4})
+        self.assertEqual(tracker.changes, [
+            {'action': 'update', 'key': 'a',
+             'old_value': {'nested': [1]}, 'new_value': 'new'},
+            {'action': 'add', 'key': 'd', 'value': 4},
+            {'action': 'remove', 'key': 'b', 'value': 2},
+        ])
+        self.assertIsNot(tracker.changes[0]['old_value'], value)
+        tracker.rollback()
+        self.assertEqual(list(data.items()), [('a', value), ('b', 2), ('c', 3)])
+        self.assertIs(data['a'], value)
+
+    def test_010d_diff_modes(self):
+        config = {'rules': [
+            {'type': 'set', 'fieldname': 'new', 'value': 'value'},
+            {'type': 'upper', 'fieldname': 'normal'},
+            {'type': 'extract', 'fieldname': 'regex', 'pattern': r'(.*)'},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': "(@new == 'value')", 'rules': [
+                    {'type': 'unset', 'fieldname': 'none'},
+                ]},
+            ]},
+        ]}
+        converter = Converter.from_dict(config)
+
+        data = dict(self.data)
+        diff = converter.apply(data, 'summary')
+        self.assertTrue(diff['error'])
+        self.assertEqual(diff['rules'][0]['changes'], [
+            {'action': 'add', 'key': 'new'}
+        ])
+        self.assertEqual(diff['rules'][1]['changes'], [
+            {'action': 'update', 'key': 'normal'}
+        ])
+        self.assertEqual(diff['rules'][3]['conditions'][0]['changes'], [
+            {'action': 'remove', 'key': 'none'}
+        ])
+
+        none = dict(self.data)
+        diff = converter.apply(none, DiffMode.NONE)
+        self.assertEqual(none, data)
+        self.assertEqual(diff, {'error': True, 'rules': [{
+            'type': 'extract',
+            'error': 'regexp_rule_error',
+            'error_details': 'regex is invalid, ensure a group is captured',
+        }]})
+
+    def test_010e_apply_many(self):
+        converter = Converter.from_dict({'rules': [
+            {'type': 'upper', 'fieldname': 'name'},
+            {'type': 'extract', 'fieldname': 'name', 'pattern': r'(.*)'},
+            {'type': 'condition-block', 'conditions': [
+                {'type': 'if', 'condition': "(@name == 'A')", 'rules': [
+                    {'type': 'set', 'fieldname': 'first', 'value': True},
+                ]},
+            ]},
+        ]})
+        records = [{'name': 'a'}, {'name': 'b'}, 'invalid', {'name': 'A'}]
+        diff = converter.apply_many(records[:2])
+        diff = converter.apply_many(records[2:], aggregate=diff)
+        self.assertEqual(records[0], {'name': 'A', 'first': True})
+        self.assertEqual(records[1], {'name': 'B'})
+        self.assertEqual(diff, {
+            'records': 3,
+            'skipped': 1,
+            'error': True,
+            'rules': [
+                {'type': 'upper', 'add': 0, 'update': 2, 'remove': 0,
+                 'errors': 0},
+                {'type': 'extract', 'add': 0, 'update': 0, 'remove': 0,
+                 'errors': 3},
+                {'type': 'condition-block', 'add': 2, 'update': 0,
+                 'remove': 0, 'errors': 0},
+            ],
+        })
+
+        diff = converter.apply_many([{'name': 'c'}], DiffMode.NONE)
+        self.assertEqual(diff['rules'][0]['update'], 0)
+        self.assertEqual(diff['rules'][1]['errors'], 1)
+
     def test_011_arithmetic(self):
         data = {
             'string_field_1': 'some string',
@@ -205,6 +304,24 @@ class TestTransformCases(TestCase):
         rule.apply(data)
         self.assertEqual(data['result'], 'some string@some@string')
 
+    def test_011b_arithmetic_lists(self):
+        data = {'prices': [10, 2.5], 'rates': [0.5, 2], 'names': ['a', 'b']}
+        Arithmetic('result', '*', '@prices', 2).apply(data)
+        self.assertEqual(data['result'], [20, 5.0])
+        Arithmetic('result', '-', 1, '@rates').apply(data)
+        self.assertEqual(data['result'], [0.5, -1])
+        Arithmetic('result', '*', '@prices', '@rates').apply(data)
+        self.assertEqual(data['result'], [5.0, 5.0])
+        Arithmetic('result', '+', '@names', '_id').apply(data)
+        self.assertEqual(data['result'], ['a_id', 'b_id'])
+
+        del data['result']
+        diff = Arithmetic('result', '+', '@prices', [1]).apply(data)
+        self.assertEqual(diff['error'], 'arithmetic_rule_error')
+        diff = Arithmetic('result', '+', '@prices', '@names').apply(data)
+        self.assertEqual(diff['error'], 'arithmetic_rule_error')
+        self.assertNotIn('result', data)
+
     def test_012_union(self):
         data = {
             'dict_field_1': {'a': 1, 'b': 2},
@@ -224,3 +341,88 @@ class TestTransformCases(TestCase):
         self.assertEqual(data['result']['a'], 10)
         self.assertEqual(data['result']['b'], 2)
         self.assertEqual(data['result']['c'], 3)
+
+    def test_012b_union_order(self):
+        a = [3, 'x', {'k': 1}, [1], 1.0]
+        b = [1, 'y', 'y', {'k': 1}, [2], 3, (1,)]
+        # Same result as the quadratic union, duplicates of b are kept
+        expected = a + [item for item in b if item not in a]
+        self.assertEqual(Union._list_union(a, b), expected)
+        self.assertEqual(
+            expected, [3, 'x', {'k': 1}, [1], 1.0, 'y', 'y', [2], (1,)]
+        )
+        self.assertEqual(Union._list_union([], b), b)
+        self.assertEqual(Union._list_union(a, []), a)
+
+
+class TestRegexpPrefilter(TestCase):
+
+    def literal(self, pattern, flags=0):
+        return required_literal(re.compile(pattern, flags))
+
+    def test_001_required_literal(self):
+        cases = [
+            (r'Ticket \d+', 'Ticket '),
+            (r'device (?P<device>\w+) at', 'device '),
+            # Groups are inlined
+            (r'(?P<ref>REF-(?:00)42)', 'REF-0042'),
+            # Alternations, classes and repeats break the runs
+            (r'err(or|eur) code', ' code'),
+            (r'(abc|xyz)', None),
+            (r'[abc]def', 'def'),
+            (r'abcd?ef', 'abc'),
+            (r'(abcd)*ef', 'ef'),
+            (r'(?:abcd){2}x', 'x'),
+            (r'a.bcde', 'bcde'),
+            # Lookarounds are not matched text
+            (r'(?=lookahead)ab', 'ab'),
+            (r'(?<!behind)ab', 'ab'),
+            (r'ab(?!ahead)', 'ab'),
+            (r'\d+', None),
+            (r'', None),
+        ]
+        for pattern, literal in cases:
+            self.assertEqual(self.literal(pattern), literal, pattern)
+
+    def test_002_ignorecase(self):
+        self.assertIsNone(self.literal(r'Ticket \d+', re.IGNORECASE))
+        self.assertIsNone(self.literal(r'(?i)Ticket \d+'))
+        self.assertEqual(self.literal(r'(?i:Ticket) number'), ' number')
+        self.assertIsNone(self.literal(rb'Ticket'))
+        rule = Extract('msg', r'(?i)(?P<ticket>TICKET \d+)')
+        data = {'msg': 'ticket 12'}
+        rule.apply(data)
+        self.assertEqual(data['ticket'], 'ticket 12')
+
+    def test_003_same_results(self):
+        """
+        Extract and Sub give the same results with and without the
+        prefilter, on random strings and patterns.
+        """
+        rand = random.Random(42)
+        alphabet = 'ab-c1 '
+        atoms = [
+            'a', 'b', 'c', '-', '1', ' ', r'\d', '.', '[ab]', 'a?', 'b*',
+            '(?:ab|ba)', '(?=a)', '(?!b)', '(?:c1)+',
+        ]
+        for _ in range(500):
+            pattern = '(?P<g>{})'.format(
+                ''.join(rand.choice(atoms) for _ in range(rand.randint(1, 6)))
+            )
+            extract = Extract('field', pattern)
+            sub = Sub('field', pattern, '#')
+            for _ in range(10):
+                string = ''.join(
+                    rand.choice(alphabet) for _ in range(rand.randint(0, 12))
+                )
+                results = []
+                for literal in (extract._literal, None):
+                    extract._literal = sub._literal = literal
+                    results.append((
+                        extract._run_regexp(string),
+                        sub._run_regexp(string),
+                    ))
+                self.assertEqual(results[0], results[1], (pattern, string))
+                extract._literal = sub._literal = required_literal(
+                    extract.regexp
+                )
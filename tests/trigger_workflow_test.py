@@ -0,0 +1,143 @@
+from asynctest import TestCase, Mock, CoroutineMock
+
+from nyuki.workflow.remote import RemoteEngines
+from nyuki.workflow.tasks.trigger_workflow import TriggerWorkflowTask
+from nyuki.workflow.tasks.utils import runtime
+from nyuki.workflow.tasks.utils.uri import URI
+
+
+TEMPLATE = {
+    'id': 'child',
+    'version': 2,
+    'title': 'child',
+    'tasks': [
+        {'id': 'first', 'name': 'join', 'config': {'value': '{message}'}},
+        {'id': 'second', 'name': 'join', 'config': {'data': ['@level']}},
+    ],
+    'graph': {'first': ['second'], 'second': []},
+}
+
+
+class TestTriggerWorkflow(TestCase):
+
+    async def setUp(self):
+        self.previous = runtime.config, runtime.bus
+        runtime.config = {'service': 'pipeline'}
+        runtime.bus = Mock()
+        runtime.bus.name = 'pipeline-1'
+        runtime.nyuki = Mock()
+        runtime.nyuki.storage.get_template = CoroutineMock(
+            return_value=TEMPLATE
+        )
+        self.wflow = Mock(uid='abcdef0123456789')
+        runtime.nyuki.engine.trigger = CoroutineMock(return_value=self.wflow)
+        self.task = TriggerWorkflowTask({
+            'template': {'service': 'pipeline', 'id': 'child'},
+        })
+        self.task.data = {
+            'message': 'hello', 'level': [1], 'other': True,
+        }
+
+    async def tearDown(self):
+        runtime.config, runtime.bus = self.previous
+        del runtime.nyuki
+
+    async def test_001_local(self):
+        self.assertTrue(self.task.local)
+        other = TriggerWorkflowTask({
+            'template': {'service': 'twilio', 'id': 'child'},
+        })
+        self.assertFalse(other.local)
+
+        track = ['nyuki://parent@pipeline-1/1234']
+        await self.task._trigger_local(False, track, 'nyuki://p@x/5678')
+        runtime.nyuki.engine.trigger.assert_called_once_with(
+            'child', {'message': 'hello', 'level': [1]}
+        )
+        # The child gets its own copy of the data
+        inputs = runtime.nyuki.engine.trigger.call_args[0][1]
+        self.assertIsNot(inputs['level'], self.task.data['level'])
+        runtime.nyuki.new_workflow.assert_called_once_with(
+            TEMPLATE, self.wflow, track=track, requester='nyuki://p@x/5678'
+        )
+        self.assertEqual(self.task.triggered_id, self.wflow.uid)
+        self.assertIs(self.task.async_future, self.wflow)
+
+    async def test_002_local_errors(self):
+        # Workflow loop
+        with self.assertRaisesRegex(RuntimeError, 'Loop detected'):
+            await self.task._trigger_local(
+                False, ['nyuki://child@pipeline-1/1234'], None
+            )
+        # Same template on another nyuki
+        await self.task._trigger_local(
+            False, ['nyuki://child@other-1/1234'], None
+        )
+        runtime.nyuki.engine.trigger.return_value = None
+        with self.assertRaisesRegex(RuntimeError, 'Could not start'):
+            await self.task._trigger_local(False, [], None)
+        runtime.nyuki.storage.get_template.return_value = None
+        with self.assertRaisesRegex(RuntimeError, 'Could not find'):
+            await self.task._trigger_local(False, [], None)
+
+    async def test_003_in_track(self):
+        self.assertFalse(URI.in_track([], 'child'))
+        self.assertFalse(URI.in_track(['invalid', ''], 'child'))
+        self.assertTrue(URI.in_track(
+            ['invalid', 'nyuki://child@pipeline-1/1234'], 'child'
+        ))
+
+
+class Context:
+
+    def __init__(self, response):
+        self.response = response
+
+    async def __aenter__(self):
+        return self.response
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class TestRemoteEngines(TestCase):
+
+    def response(self, status, body=None, etag=None):
+        response = Mock(status=status)
+        response.json = CoroutineMock(return_value=body)
+        response.headers = {'ETag': etag} if etag else {}
+        return Context(response)
+
+    async def test_001_vars(self):
+        remote = RemoteEngines()
+        remote._session = Mock(closed=False)
+        remote._session.get.return_value = self.response(
+            200, ['message'], '"child-2"'
+        )
+        self.assertEqual(await remote.vars('/vars/child'), ['message'])
+        remote._session.get.assert_called_once_with('/vars/child', headers={})
+
+        # Same version
+        remote._session.get.return_value = self.response(304)
+        self.assertEqual(await remote.vars('/vars/child'), ['message'])
+        remote._session.get.assert_called_with(
+            '/vars/child', headers={'If-None-Match': '"child-2"'}
+        )
+
+        # New version
+        remote._session.get.return_value = self.response(
+            200, ['level'], '"child-3"'
+        )
+        self.assertEqual(await remote.vars('/vars/child'), ['level'])
+        self.assertEqual(len(remote), 1)
+
+        # Responses without ETag are not cached
+        remote._session.get.return_value = self.response(200, ['draft'])
+        await remote.vars('/vars/child/draft')
+        self.assertEqual(len(remote), 1)
+
+        remote._session.get.return_value = self.response(404)
+        with self.assertRaises(RuntimeError):
+            await remote.vars('/vars/unknown')
+        await remote.close()
+        self.assertEqual(len(remote), 0)
@@ -0,0 +1,106 @@
+import json
+from asynctest import TestCase, Mock, CoroutineMock
+
+from nyuki.workflow.api.vars import DataInspector
+from nyuki.workflow.db.storage import MongoStorage
+from nyuki.workflow.db.workflow_templates import required_keys
+
+
+TASKS = [
+    {'id': 'first', 'name': 'join', 'config': {'value': '{message}'}},
+    {'id': 'second', 'name': 'factory', 'config': {'rules': [
+        {'type': 'set', 'fieldname': 'status', 'value': '@level'},
+        {'type': 'lower', 'fieldname': 'region', 'count': 2},
+    ]}},
+    {'id': 'third', 'name': 'join'},
+]
+
+
+class TestRequiredKeys(TestCase):
+
+    async def setUp(self):
+        self.storage = MongoStorage()
+        self.storage._workflow_templates = Mock()
+        self.storage._workflow_templates.get_required_keys = CoroutineMock(
+            return_value={
+                'version': 2, 'state': 'active', 'required_keys': ['level'],
+            }
+        )
+        self.storage._workflow_templates.set_required_keys = CoroutineMock()
+        self.storage._task_templates = Mock()
+        self.storage._task_templates.get = CoroutineMock(return_value=TASKS)
+        self.inspector = DataInspector()
+        self.inspector.nyuki = Mock(storage=self.storage)
+
+    async def test_001_required_keys(self):
+        self.assertEqual(required_keys(TASKS), ['level', 'message'])
+        self.assertEqual(required_keys([]), [])
+
+    async def test_002_storage(self):
+        templates = self.storage._workflow_templates
+        keys = await self.storage.get_required_keys('tid')
+        self.assertEqual(keys, {
+            'version': 2, 'draft': False, 'keys': ['level'],
+        })
+        # Published versions are cached
+        self.assertIs(
+            await self.storage.get_required_keys('tid', version=2), keys
+        )
+        # And the active version, until the next publication
+        self.assertIs(await self.storage.get_required_keys('tid'), keys)
+        self.assertEqual(templates.get_required_keys.call_count, 1)
+        templates.publish_draft = CoroutineMock()
+        await self.storage.publish_draft('tid')
+        await self.storage.get_required_keys('tid')
+        self.assertEqual(templates.get_required_keys.call_count, 2)
+
+        # Computed and stored for the templates saved without them
+        templates.get_required_keys.return_value = {
+            'version': 3, 'state': 'draft',
+        }
+        keys = await self.storage.get_required_keys('tid', draft=True)
+        self.assertEqual(keys['keys'], ['level', 'message'])
+        self.assertTrue(keys['draft'])
+        templates.set_required_keys.assert_called_once_with(
+            'tid', 3, ['level', 'message']
+        )
+        self.storage._task_templates.get.assert_called_once_with('tid', 3)
+        # Drafts are not cached
+        await self.storage.get_required_keys('tid', version=3)
+        self.assertEqual(templates.get_required_keys.call_count, 4)
+
+        templates.delete = CoroutineMock()
+        self.storage._task_templates.delete_many = CoroutineMock()
+        self.storage._workflow_metadata = Mock(delete=CoroutineMock())
+        self.storage.triggers = Mock(delete=CoroutineMock())
+        await self.storage.delete_template('tid')
+        self.assertEqual(len(self.storage._required_keys), 0)
+
+    async def test_003_etag(self):
+        request = Mock(headers={})
+        response = await self.inspector.keys_response(request, 'tid')
+        self.assertEqual(json.loads(response.body.decode()), ['level'])
+        etag = response.headers['ETag']
+        self.assertEqual(etag, '"tid-2"')
+
+        request.headers['If-None-Match'] = etag
+        response = await self.inspector.keys_response(request, 'tid')
+        self.assertEqual(response.status, 304)
+        self.assertIsNone(response.body)
+
+        # The ETag of a draft changes with its keys
+        templates = self.storage._workflow_templates
+        templates.get_required_keys.return_value = {
+            'version': 3, 'state': 'draft', 'required_keys': ['level'],
+        }
+        response = await self.inspector.keys_response(
+            request, 'tid', draft=True
+        )
+        draft_etag = response.headers['ETag']
+        self.assertEqual(response.status, 200)
+        self.assertTrue(draft_etag.startswith('"tid-3-'))
+        templates.get_required_keys.return_value['required_keys'] = ['other']
+        response = await self.inspector.keys_response(
+            request, 'tid', draft=True
+        )
+        self.assertNotEqual(response.headers['ETag'], draft_etag)